@@ -4,6 +4,14 @@ from pyramid.view import view_config
 from datetime import datetime
 import threading
 import workflow
+import pipeline
+import supervisor
+import workqueue
+import scheduler
+import resources
+import cache
+import libraries
+import tables
 import json
 import os
 import shutil
@@ -42,6 +50,8 @@ class Ticker(threading.Thread):
                     if "analysis" in state[project]:
                         if project in analysis_threads and analysis_threads[project].isAlive():
                             None
+                        elif analysis_scheduler.queue_position(project):
+                            None
                         else:
                             del state[project]["analysis"]
 
@@ -55,39 +65,36 @@ notifications = []
 
 analysis_events = {}
 
+analysis_scheduler = scheduler.AnalysisScheduler()
+artifact_cache = None
+library_registry = None
+
 
 class AnalysisThread(threading.Thread):
 
-    def __init__(self, data, folder):
+    def __init__(self, data, folder, extend_project=False):
         threading.Thread.__init__(self)
         self.data = data
         self.project_folder = folder
         self.scan = None
+        self.extend_project = extend_project
 
     def get_project_folder(self):
         return self.project_folder
 
-    def get_raw_converter(self, event, log_fh, analysis_state):
-        if os.path.exists("/wineprefix64"):
-            return ("msconvert")
-        if os.path.exists("/opt/ThermoRawFileParser/ThermoRawFileParser.exe"):
-            return ("thermorawparser")
-
-        phaseID = analysis_state.createPhase("Installing ThermoRawFileParser")
-        workflow.install_ThermoRawFileParser(event, log_fh, analysis_state.getPhaseData(phaseID))
-        if os.path.exists("/opt/ThermoRawFileParser/ThermoRawFileParser.exe"):
-            return ("thermorawparser")
-        else:
-            return None
-    
     def run(self):
+        try:
+            self.analyse()
+        finally:
+            analysis_scheduler.finished(self.project_folder)
 
-        max_threads = os.cpu_count()
-        if not max_threads:
-            max_threads = 1
+    def analyse(self):
 
         project = self.project_folder
 
+        # The thread share changes as other analyses start and finish
+        max_threads = lambda: analysis_scheduler.threads_for(project)
+
         cwd = os.path.join(result_root, project)
 
         if self.data:
@@ -113,6 +120,10 @@ class AnalysisThread(threading.Thread):
             max_threads = self.data['threads']
             print ("Forcing max " + str(max_threads) + " threads.")
 
+        search_workers = 1
+        if 'search_workers' in self.data and self.data['search_workers']:
+            search_workers = int(self.data['search_workers'])
+
         delete_tmp_files_flag = True
 
         # Sanity check here
@@ -132,551 +143,31 @@ class AnalysisThread(threading.Thread):
 
         with open(os.path.join(cwd, log_name), "w") as log_fh:
 
-            # Convert DIA data to open format
-
-            extensions = set()
-            for filename in sample_files:
-                extension = os.path.splitext(filename)[1].lower()
-                extensions.add(extension)
-
-            extensions = list(extensions)
-
-            # TODO: Return the actual error
-            if len(extensions) > 1:
-                print("A single input type allowed, multile file types found (" +
-                      ", ".join(extensions) + ")")
-                return
-
-            # TODO: Return the actual error
-            if extension not in [".mzml", ".mzxml", ".raw"]:
-                print("Unknown extension (" + extension + ") found.")
-                return
-
-            if (extension == ".raw"):
-                converter = self.get_raw_converter(event, log_fh, analysis_state)
-
-                if self.scan and "conv_DIA" in self.scan and self.scan["conv_DIA"]:
-                    print("Detected existing converted DIA files.")
-                    None
-
-                else:
-
-                    phaseID = analysis_state.createPhase("Converting RAW DIA files")
-
-                    if converter == "msconvert":
-                        workflow.convertRAW(
-                            event,
-                            log_fh,
-                            analysis_state.getPhaseData(phaseID),
-                            cwd,
-                            sample_files,
-                            False,
-                            "mzml",
-                            "DIA")
-
-                    elif converter == "thermorawparser":
-                        workflow.convertRAW_ThermoRawFileParser(
-                            event,
-                            log_fh,
-                            analysis_state.getPhaseData(phaseID),
-                            cwd,
-                            sample_files,
-                            False,
-                            "mzml",
-                            "DIA")
-                    else:
-                        print ("Error: No, RAW file converter available")
-                        return
-                        
-
-                if event.kill_flag:
-                    return
-
-                # replace sample files with converted versions
-                sample_files = [os.path.join(cwd, "DIA", x)
-                                for x in os.listdir(os.path.join(cwd, "DIA")) if Path(x).suffix in [".mzXML", ".mzML"] ]
-
-            swaths_min = 0
-            swaths_max = 0
-
-            swaths, tswaths = workflow.create_swath_window_files(
-                cwd, sample_files[0])
-            swaths_min = swaths[0][0]
-            swaths_max = swaths[-1][1]
-
-            pseudospectrafiles = []
-
-            if library_files and ("dda_library" in options):
-
-                extensions = set()
-                extension = None
-
-                for filename in library_files:
-                    extension = os.path.splitext(filename)[1].lower()
-                    extensions.add(extension)
-
-                extensions = list(extensions)
-
-                # TODO: Return the actual error
-                if len(extensions) > 1:
-                    print("A single input type allowed, multile file types found (" + ", ".join(extensions) + ")")
-                    return
-
-                # TODO: Return the actual error
-                if extension not in [".mzml", ".mzxml", ".raw"]:
-                    print("Unknown extension (" + extension + ") found.")
-                    return
-
-                if (extension == ".raw"):
-
-                    converter = self.get_raw_converter(event, log_fh, analysis_state)
-
-                    if self.scan and "conv_DDA" in self.scan and self.scan["conv_DDA"]:
-                        print("Detected existing converted DDA files.")
-                        None
-
-                    else:
-                        phaseID = analysis_state.createPhase(
-                            "Converting RAW DDA files (+picking peaks)")
-
-                        if converter == "msconvert":
-                        
-                            workflow.convertRAWqtofpeakpicker(
-                                event,
-                                log_fh,
-                                analysis_state.getPhaseData(phaseID),
-                                cwd,
-                                library_files,
-                                "DDA")
-
-                        elif converter == "thermorawparser":
-
-                            workflow.convertRAW_ThermoRawFileParser(
-                                event,
-                                log_fh,
-                                analysis_state.getPhaseData(phaseID),
-                                cwd,
-                                library_files,
-                                True,
-                                "mzml",
-                                "DDA")
-
-                        else:
-                            print ("Error: No, RAW file converter available")
-                            return
-
-
-                    if event.kill_flag:
-                        return
-
-                    # replace library raw files with converted versions
-                    library_files = [os.path.join(
-                        cwd, "DDA", x) for x in os.listdir(os.path.join(cwd, "DDA")) if Path(x).suffix in [".mzXML", ".mzML"]]
-
-
-            else : # BUILD pseudospectral library instead of spectral library
-
-                if self.scan and "pseudospectra" in self.scan and self.scan["pseudospectra"]:
-                    # print("Detected existing converted DDA files.")
-                    pseudospectrafiles = self.scan["pseudospectrafiles"]
-                    None
-
-                else:
-                    phaseID = analysis_state.createPhase(
-                        "Building pseudospectra")
-                    pseudospectrafiles = workflow.runDiaumpire(
-                        event,
-                        log_fh,
-                        analysis_state.getPhaseData(phaseID),
-                        cwd,
-                        sample_files,
-                        "libfree",
-                        max_threads)
-
-                if event.kill_flag:
-                    return
-
-            # BUILD SEQUENCE DATABASE
-
-            db_filename = "DB.fasta"
-            decoy_db_file = "DB_with_decoys.fasta"
-
-            if self.scan and "DB" in self.scan and self.scan["DB"]:
-                None
-                #print("Detected existing sequence database")
-            else:
-                phaseID = analysis_state.createPhase("Building database")
-                workflow.build_database(
-                    event,
-                    log_fh,
-                    analysis_state.getPhaseData(phaseID),
-                    cwd,
-                    database_files,
-                    db_filename,
-                    decoy_db_file)
-
-                if event.kill_flag:
-                    return
-
-            # BUILD lib & pseudolib peptide files
-
-            libmethod_pepXMLs = []
-            libfreemethod_pepXMLs = []
-
-            param_map = {
-                "precursor_tolerance" : "PRECURSOR_MASS_TOLERANCE",
-                "fragment_tolerance": "FRAGMENT_MASS_TOLERANCE"
-            }    
-
-            if "use_comet_flag" in options:
-
-                comet_cfg = os.path.join(cwd, "comet_settings.xml")
-
-                cfg_txt = None
-                with open("/opt/gladiator/comet_settings_template.xml", "r") as fh:
-                    cfg_txt = fh.read()
-
-                for k in param_map:
-                    placeholder = param_map[k]
-                    target = str(self.data[k])
-                    if k == "precursor_tolerance":
-                        target = "{:.2f}".format(float(target))
-                    cfg_txt = cfg_txt.replace(placeholder, target)
-
-                cfg_txt = cfg_txt.replace("DATABASE_FASTA_FILE", decoy_db_file)
-
-                with open(comet_cfg,"w") as fh:
-                    fh.write(cfg_txt)
-
-                if library_files:
-
-                    if self.scan and "comet_peptides" in self.scan and self.scan["comet_peptides"]:
-                        None
-                        #print("Detected existing Comet spectra search results")
-
-                    else:
-
-                        # Cleanup
-
-                        filenames = \
-                            ["interact_comet_pep-MODELS.html",
-                             "interact_comet_pep.xml",
-                             "interact_comet_pep.xml.index",
-                             "interact_comet_pep.xml.RTcoeff",
-                             "interact_comet_pep.xml.RTstats"]
-
-                        for filename in filenames:
-                            filepath = os.path.join(cwd, filename)
-                            if os.path.isfile(filepath):
-                                os.remove(filepath)
-
-                        # Run Comet
-
-                        existing_pep_xmls = None
-                        if self.scan and "samples_generated_by_comet" in self.scan:
-                            existing_pep_xmls = self.scan["samples_generated_by_comet"]
-
-                        phaseID = analysis_state.createPhase(
-                            "Speclib - Matching sequences [Comet]")
-                        workflow.runComet(
-                            event,
-                            log_fh,
-                            analysis_state.getPhaseData(phaseID),
-                            cwd,
-                            comet_cfg,
-                            library_files,
-                            existing_pep_xmls,
-                            "interact_comet_pep.xml",
-                            cwd)
-
-                    if event.kill_flag:
-                        return
-
-                    libmethod_pepXMLs.append("interact_comet_pep.xml")
-
-                if pseudospectrafiles:
-
-                    if self.scan and "comet_pseudo_peptides" in self.scan and self.scan["comet_pseudo_peptides"]:
-                        None
-                        # print("Detected existing Comet pseudo spectra search results")
-
-                    else:
-
-                        # Cleanup
-
-                        filenames = \
-                            ["interact_comet_pseudo_pep-MODELS.html",
-                             "interact_comet_pseudo_pep.xml",
-                             "interact_comet_pseudo_pep.xml.index",
-                             "interact_comet_pseudo_pep.xml.RTcoeff",
-                             "interact_comet_pseudo_pep.xml.RTstats"]
-
-                        for filename in filenames:
-                            filepath = os.path.join(cwd, filename)
-                            if os.path.isfile(filepath):
-                                os.remove(filepath)
-
-                        existing_pep_xmls = None
-                        if self.scan and "pseudo_samples_generated_by_comet" in self.scan:
-                            existing_pep_xmls = self.scan["pseudo_samples_generated_by_comet"]
-
-                        # Run Comet for speudospectrafiles
-
-                        phaseID = analysis_state.createPhase(
-                            "Pseudospeclib - Matching sequences [Comet]")
-                        workflow.runComet(
-                            event,
-                            log_fh,
-                            analysis_state.getPhaseData(phaseID),
-                            cwd,
-                            comet_cfg,
-                            pseudospectrafiles,
-                            existing_pep_xmls,
-                            "interact_comet_pseudo_pep.xml",
-                            cwd)
-
-                    if event.kill_flag:
-                        return
-
-                    libfreemethod_pepXMLs.append(
-                        "interact_comet_pseudo_pep.xml")
-
-            if "use_xtandem_flag" in options:
-                xtandem_cfg = os.path.join(cwd, "xtandem_settings.xml")
-
-                cfg_txt = None
-                with open("/opt/gladiator/xtandem_settings_template.xml", "r") as fh:
-                    cfg_txt = fh.read()
-
-                for k in param_map:
-                    placeholder = param_map[k]
-                    target = str(self.data[k])
-                    if k == "precursor_tolerance":
-                        target = "{:.2f}".format(float(target))
-                    cfg_txt = cfg_txt.replace(placeholder, target)
-
-                with open(xtandem_cfg,"w") as fh:
-                    fh.write(cfg_txt)
-
-                if library_files:
-
-                    if self.scan and "xtandem_peptides" in self.scan and self.scan["xtandem_peptides"]:
-                        None
-                        # print("Detected existing X!Tandem spectra search results")
-                    else:
-
-                        # Cleanup
-
-                        filenames = [
-                            "interact_xtandem_pep-MODELS.html   ",
-                            "interact_xtandem_pep.xml",
-                            "interact_xtandem_pep.xml.index",
-                            "interact_xtandem_pep.xml.RTcoeff   ",
-                            "interact_xtandem_pep.xml.RTstats   "]
-
-                        for filename in filenames:
-                            filepath = os.path.join(cwd, filename)
-                            if os.path.isfile(filepath):
-                                os.remove(filepath)
-
-                        # Run X!Tandem
-
-                        existing_pep_xmls = None
-                        if self.scan and "samples_generated_by_xtandem" in self.scan:
-                            existing_pep_xmls = self.scan["samples_generated_by_xtandem"]
-
-                        phaseID = analysis_state.createPhase(
-                            "Speclib - Matching sequences [X!Tandem]")
-                        workflow.runXTandem(
-                            event,
-                            log_fh,
-                            analysis_state.getPhaseData(phaseID),
-                            cwd,
-                            xtandem_cfg,
-                            decoy_db_file,
-                            library_files,
-                            existing_pep_xmls,
-                            "interact_xtandem_pep.xml",
-                            cwd,
-                            delete_tmp_files_flag)
-
-                    if event.kill_flag:
-                        return
-
-                    libmethod_pepXMLs.append("interact_xtandem_pep.xml")
-
-                if pseudospectrafiles:
-
-                    if self.scan and "xtandem_pseudo_peptides" in self.scan and self.scan["xtandem_pseudo_peptides"]:
-                        None
-                        # print("Detected existing X!Tandem pseudo spectra search results")
-
-                    else:
-
-                        # Cleanup
-
-                        filenames = [
-                            "interact_xtandem_pseudo_pep-MODELS.html",
-                            "interact_xtandem_pseudo_pep.xml",
-                            "interact_xtandem_pseudo_pep.xml.index",
-                            "interact_xtandem_pseudo_pep.xml.RTcoeff",
-                            "interact_xtandem_pseudo_pep.xml.RTstats"]
-
-                        for filename in filenames:
-                            filepath = os.path.join(cwd, filename)
-                            if os.path.isfile(filepath):
-                                os.remove(filepath)
-
-                        # Run X!Tandem for speudospectrafiles
-
-                        existing_pep_xmls = None
-                        if self.scan and "pseudo_samples_generated_by_xtandem" in self.scan:
-                            existing_pep_xmls = self.scan["pseudo_samples_generated_by_xtandem"]
-
-                        phaseID = analysis_state.createPhase(
-                            "Pseudospeclib - Matching sequences [X!Tandem]")
-                        workflow.runXTandem(
-                            event,
-                            log_fh,
-                            analysis_state.getPhaseData(phaseID),
-                            cwd,
-                            xtandem_cfg,
-                            decoy_db_file,
-                            pseudospectrafiles,
-                            existing_pep_xmls,
-                            "interact_xtandem_pseudo_pep.xml",
-                            cwd,
-                            delete_tmp_files_flag)
-
-                    if event.kill_flag:
-                        return
-
-                    libfreemethod_pepXMLs.append(
-                        "interact_xtandem_pseudo_pep.xml")
-
-            if self.scan and "speclib_cons" in self.scan and self.scan["speclib_cons"]:
-                None
-                #print("Detected existing Spectrum library.")
-
-            else:
-
-                phaseID = analysis_state.createPhase("Building Library")
-
-                # Cleanup
-
-                filenames = \
-                    ["SpecLib_cons_decoy.TraML",
-                     "SpecLib_cons_openswath.tsv",
-                     "SpecLib_cons.pepidx",
-                     "SpecLib_cons.spidx",
-                     "SpecLib_cons.splib",
-                     "SpecLib_cons.sptxt",
-                     "SpecLib_cons.TraML",
-                     "SpecLib_libfree.pepidx",
-                     "SpecLib_libfree.spidx",
-                     "SpecLib_libfree.splib",
-                     "SpecLib_libfree.sptxt",
-                     "SpecLib_lib.pepidx",
-                     "SpecLib_lib.spidx",
-                     "SpecLib_lib.splib",
-                     "SpecLib_lib.sptxt",
-                     "SpecLib_merged.pepidx",
-                     "SpecLib_merged.spidx",
-                     "SpecLib_merged.splib",
-                     "SpecLib_merged.sptxt",
-                     "spectrast.log"]
-
-                for filename in filenames:
-                    filepath = os.path.join(cwd, filename)
-                    if os.path.isfile(filepath):
-                        os.remove(filepath)
-
-                for method in ["lib", "libfree"]:
-                    mayu_folder = method+"_mayu"
-                    directory = os.path.join(cwd, mayu_folder)
-                    if os.path.isdir(directory):
-                        shutil.rmtree(directory)
-
-                workflow.buildlib(
-                    event,
-                    log_fh,
-                    analysis_state.getPhaseData(phaseID),
-                    cwd,
-                    "DECOY_",
-                    decoy_db_file,
-                    str(max_threads),
-                    libmethod_pepXMLs,
-                    libfreemethod_pepXMLs,
-                    "/opt/gladiator/iRT.txt",
-                    "swath-windows.txt",
-                    pvalue,
-                    pvalue,
-                    swaths_min,
-                    swaths_max)
-
-            if event.kill_flag:
+            log_fh.write(resources.describe_resources() + "\n")
+
+            openswath_workers = None
+            if 'openswath_workers' in self.data and self.data['openswath_workers']:
+                openswath_workers = int(self.data['openswath_workers'])
+
+            analysis = pipeline.analysis_pipeline(
+                event,
+                log_fh,
+                analysis_state,
+                cwd,
+                self.data,
+                self.scan,
+                max_threads,
+                search_workers,
+                openswath_workers,
+                delete_tmp_files_flag,
+                artifact_cache,
+                library_registry,
+                self.extend_project)
+
+            if not analysis:
                 return
 
-            if self.scan and "matrices" in self.scan and self.scan["matrices"]:
-                None
-                #print("Detected existing matrices.")
-
-            else:
-
-                # Cleanup
-
-                postfixes = ["-DIA_cutoffs.txt",
-                             "-DIA_dscores_top_decoy_peaks.txt",
-                             "-DIA_dscores_top_target_peaks.txt",
-                             "-DIA_full_stat.csv",
-                             "-DIA_mayu.csv",
-                             "-DIA_mayu.cutoff",
-                             "-DIA_mayu.fasta",
-                             "-DIA_qvalues.txt",
-                             "-DIA_report.pdf",
-                             "-DIA_scorer.bin",
-                             "-DIA_summary_stat.csv",
-                             "-DIA_svalues.txt",
-                             "-DIA.tsv",
-                             "-DIA_weights.txt",
-                             "-DIA_with_dscore-0_0-None.tr",
-                             "-DIA_with_dscore.csv",
-                             "-DIA_with_dscore_filtered.csv"]
-
-                for filename in sample_files:
-                    filepath = os.path.join(cwd, os.path.basename(filename))
-                    for postfix in postfixes:
-                        if filepath.endswith(postfix) and os.path.isfile(filepath):
-                            os.remove(filepath)
-
-                filenames = \
-                    ["DIA-analysis-result.csv",
-                     "DIA-peptide-matrix.tsv",
-                     "DIA-protein-matrix.tsv"]
-
-                for filename in filenames:
-                    filepath = os.path.join(cwd, filename)
-                    if os.path.isfile(filepath):
-                        os.remove(filepath)
-
-                # Run OpenSWATH and building the DIA matrices
-                phaseID = analysis_state.createPhase(
-                    "Searching peptides from DIA spectrum")
-
-                workflow.buildDIAMatrix(
-                    event,
-                    log_fh,
-                    analysis_state.getPhaseData(phaseID),
-                    cwd,
-                    sample_files,
-                    "truncated-swath-windows.txt",
-                    trig_target_pvalue,
-                    trig_max_pvalue,
-                    str(max_threads),
-                    "/opt/gladiator/iRTAssayLibrary.TraML",
-                    None)  # TODO: insert design file here
-
-            if event.kill_flag:
+            if not analysis.run():
                 return
 
             with notification_lock:
@@ -690,7 +181,13 @@ class AnalysisThread(threading.Thread):
             # Create matrix.tsv and annotations.tsv
 
             if 'annotate_peptides' in options:
-                if not (self.scan and "annotations" in self.scan and self.scan["annotations"]):
+
+                # Annotated again whenever the matrices were rewritten, e.g.
+                # after samples were added or the matrices were rerun
+                annotated = False
+
+                if not workflow.annotations_up_to_date(cwd, self.data):
+                    annotated = True
 
                     cwd = os.path.join(result_root, project)
 
@@ -699,6 +196,9 @@ class AnalysisThread(threading.Thread):
                     merge_unimods = False
                     if "annotation_merge_unimods" in self.data:
                         merge_unimods = self.data["annotation_merge_unimods"]
+                    from_openswath = False
+                    if "annotation_from_openswath" in self.data:
+                        from_openswath = self.data["annotation_from_openswath"]
 
                     with open(os.path.join(cwd, "annotation_log.txt"), "w") as log_fh:
 
@@ -724,17 +224,18 @@ class AnalysisThread(threading.Thread):
 
                         df = None
 
-                        df = annotateSwath2stats.read_swaths2stats_peptide_table(
-                            event,
-                            log_fh,
-                            analysis_state.getPhaseData(phaseID),
-                            os.path.join(result_root, project, "DIA-peptide-matrix.tsv"))
-
-                        # df = annotation.read_openswathfile(
-                        #     event,
-                        #     log_fh,
-                        #     analysis_state.getPhaseData(phaseID),
-                        #     os.path.join(result_root, project, "DIA-analysis-result.csv"))
+                        if from_openswath:
+                            df = annotation.read_openswathfile(
+                                event,
+                                log_fh,
+                                analysis_state.getPhaseData(phaseID),
+                                os.path.join(result_root, project, "DIA-analysis-result.csv"))
+                        else:
+                            df = annotateSwath2stats.read_swaths2stats_peptide_table(
+                                event,
+                                log_fh,
+                                analysis_state.getPhaseData(phaseID),
+                                os.path.join(result_root, project, "DIA-peptide-matrix.tsv"))
 
                         if event.kill_flag:
                             return
@@ -756,47 +257,49 @@ class AnalysisThread(threading.Thread):
                         if assign_ambiguous:
                             ambiguous_threshold = 2
 
-                        annotateSwath2stats.annotate_df(
-                            event,
-                            log_fh,
-                            analysis_state.getPhaseData(phaseID),
-                            df,
-                            dicts,
-                            os.path.join(result_root, project, "matrix.tsv"),
-                            os.path.join(result_root, project, "annotations.tsv"),
-                            ambiguous_threshold,
-                            merge_unimods,
-                            None) # Contaminants
-
-                        # annotation.annotate_df(
-                        #     event,
-                        #     log_fh,
-                        #     analysis_state.getPhaseData(phaseID),
-                        #     df,
-                        #     dicts,
-                        #     os.path.join(result_root, project, "matrix.tsv"),
-                        #     os.path.join(result_root, project, "annotations.tsv"),
-                        #     ambiguous_threshold,
-                        #     merge_unimods)
+                        if from_openswath:
+                            annotation.annotate_df(
+                                event,
+                                log_fh,
+                                analysis_state.getPhaseData(phaseID),
+                                df,
+                                dicts,
+                                os.path.join(result_root, project, "matrix.tsv"),
+                                os.path.join(result_root, project, "annotations.tsv"),
+                                ambiguous_threshold,
+                                merge_unimods,
+                                None) # Contaminants
+                        else:
+                            annotateSwath2stats.annotate_df(
+                                event,
+                                log_fh,
+                                analysis_state.getPhaseData(phaseID),
+                                df,
+                                dicts,
+                                os.path.join(result_root, project, "matrix.tsv"),
+                                os.path.join(result_root, project, "annotations.tsv"),
+                                ambiguous_threshold,
+                                merge_unimods,
+                                None) # Contaminants
 
                         if event.kill_flag:
                             return
 
                 # Draw graphs
 
-                if not (self.scan and "figures" in self.scan and self.scan["figures"]):
+                if annotated or not (self.scan and "figures" in self.scan and self.scan["figures"]):
 
                     figures_path = os.path.join(result_root, project, "figures")
 
                     if not os.path.exists(figures_path):
                         os.mkdir(figures_path)
 
-                    annotation_df = pd.read_csv(os.path.join(
-                        result_root, project, "annotations.tsv"), sep="\t", index_col=0)
+                    annotation_columns = tables.read_header(os.path.join(
+                        result_root, project, "annotations.tsv"))[1:]
 
                     with open(os.path.join(cwd, "figures", "figcfg.tsv"), "w") as fh:
                         dict_variable = {
-                            key: None for key in annotation_df.columns.tolist()}
+                            key: None for key in annotation_columns}
                         json.dump(dict_variable, fh)
 
                 with notification_lock:
@@ -817,6 +320,7 @@ def cancel_analysis(request):
     requestData = json.loads(request.body)
     project = requestData['project']
     with big_lock:
+        analysis_scheduler.cancel(project)
         if project in analysis_events:
             analysis_events[project].kill()
 
@@ -851,6 +355,18 @@ def get_status(request):
                 folder = analysis_threads[project].get_project_folder()
                 status[project]["Analysis Folder"] = folder
 
+            else:
+                position = analysis_scheduler.queue_position(project)
+                if position:
+                    if project not in status:
+                        status[project] = {}
+                        status[project]["Annotation Running"] = "No"
+
+                    status[project]["Analysis Running"] = "Queued"
+                    status[project]["Queue Position"] = position
+                    folder = analysis_threads[project].get_project_folder()
+                    status[project]["Analysis Folder"] = folder
+
     status["Status"] = "Success"
     return status
 
@@ -878,6 +394,11 @@ def getProgress(request):
                 if k in state[project]:
                     progress[project][k] = state[project][k].load()
 
+            position = analysis_scheduler.queue_position(project)
+            if position:
+                progress[project]["queued"] = True
+                progress[project]["queue_position"] = position
+
         return progress
 
 
@@ -903,22 +424,97 @@ def rerun(request):
     runData = json.loads(request.body)
     analysis_name = runData['analysis_name']
 
-    analysis_events[analysis_name] = workflow.Event()
+    # Changed settings are stored in the project's configuration, only the
+    # phases depending on them are run again
 
-    global state
+    with big_lock:
 
-    if analysis_name not in state:
-        state[analysis_name] = {}
+        if analysis_scheduler.is_active(analysis_name):
+            return ({"Status": "Failed", "Error": "Project is already queued or running"})
 
-    if "analysis" in state[analysis_name]:
-        state[analysis_name]["analysis"].clear()
-    else:
-        state[analysis_name]["analysis"] = workflow.State(analysis_name)
+        if runData.get('config'):
+            cfg_filename = os.path.join(result_root, analysis_name, "config.txt")
+            if not os.path.isfile(cfg_filename):
+                return ({"Status": "Failed", "Error": "Project has not been analysed"})
+            with open(cfg_filename, "r") as fh:
+                cfg = json.load(fh)
+            for key in runData['config']:
+                if key not in ['analysis_name', 'files']:
+                    cfg[key] = runData['config'][key]
+            workflow.write_if_changed(cfg_filename, json.dumps(cfg))
+
+        analysis_events[analysis_name] = workflow.Event()
+
+        global state
+
+        if analysis_name not in state:
+            state[analysis_name] = {}
+
+        if "analysis" in state[analysis_name]:
+            state[analysis_name]["analysis"].clear()
+        else:
+            state[analysis_name]["analysis"] = workflow.State(analysis_name)
+
+        # QUEUE ANALYSIS THREAD
+        global analysis_threads
+        analysis_threads[analysis_name] = AnalysisThread(None, analysis_name)
+        analysis_scheduler.submit(
+            analysis_name,
+            analysis_threads[analysis_name].start,
+            analysis_events[analysis_name],
+            runData.get('priority', 0))
+
+    return ({"Status": "Success"})
+
+
+def extend(request):
+
+    # Adds DIA samples to an analysed project, only the new samples are
+    # processed
+
+    runData = json.loads(request.body)
+    analysis_name = runData['analysis_name']
+
+    with big_lock:
+
+        if analysis_scheduler.is_active(analysis_name):
+            return ({"Status": "Failed", "Error": "Project is already queued or running"})
+
+        cfg_filename = os.path.join(result_root, analysis_name, "config.txt")
+        if not os.path.isfile(cfg_filename):
+            return ({"Status": "Failed", "Error": "Project has not been analysed"})
+
+        with open(cfg_filename, "r") as fh:
+            cfg = json.load(fh)
+
+        for filename in runData['samples']:
+            if filename not in cfg['files']['samples']:
+                cfg['files']['samples'].append(filename)
+
+        with open(cfg_filename, "w") as fh:
+            json.dump(cfg, fh)
+
+        analysis_events[analysis_name] = workflow.Event()
+
+        global state
+
+        if analysis_name not in state:
+            state[analysis_name] = {}
+
+        if "analysis" in state[analysis_name]:
+            state[analysis_name]["analysis"].clear()
+        else:
+            state[analysis_name]["analysis"] = workflow.State(analysis_name)
+
+        # QUEUE ANALYSIS THREAD
+        global analysis_threads
+        analysis_threads[analysis_name] = AnalysisThread(None, analysis_name, True)
+        analysis_scheduler.submit(
+            analysis_name,
+            analysis_threads[analysis_name].start,
+            analysis_events[analysis_name],
+            runData.get('priority', 0))
 
-    # START ANALYSIS THREAD
-    global analysis_threads
-    analysis_threads[analysis_name] = AnalysisThread(None, analysis_name)
-    analysis_threads[analysis_name].start()
     return ({"Status": "Success"})
 
 
@@ -969,11 +565,15 @@ def run(request):
         else:
             state[analysis_name]["analysis"] = workflow.State(analysis_name)
 
-        # START ANALYSIS THREAD
+        # QUEUE ANALYSIS THREAD
         global analysis_threads
         analysis_threads[analysis_name] = AnalysisThread(
             runData, analysis_name)
-        analysis_threads[analysis_name].start()
+        analysis_scheduler.submit(
+            analysis_name,
+            analysis_threads[analysis_name].start,
+            analysis_events[analysis_name],
+            runData.get('priority', 0))
         return ({"Status": "Success"})
 
 
@@ -989,6 +589,9 @@ def list_projects(request):
     # Scan folders
     projects = []
     for basename in os.listdir(result_root):
+        # Hidden folders hold the artifact cache and work queue
+        if basename.startswith("."):
+            continue
         fullname = os.path.join(result_root, basename)
         if os.path.isdir(fullname):
 
@@ -1081,8 +684,7 @@ def listDirectory(request):
 
 def get_tsv_headers(request):
     data = json.loads(request.body)
-    df = pd.read_csv(data["file"], sep='\t', nrows=1)
-    headers = df.columns.tolist()
+    headers = tables.read_header(data["file"])
     return (headers)
 
 
@@ -1095,6 +697,13 @@ def get_notifications(request):
     return (result)
 
 
+def list_libraries(request):
+    # Pinned spectral libraries, usable as "use_library" of an analysis
+    if not library_registry:
+        return {}
+    return library_registry.names()
+
+
 def scan(request):
     result = workflow.scan_project_phases("PD92-libfree", result_root)
     return result
@@ -1132,10 +741,10 @@ def render_figure(request):
 #            else:
 #                print ("Whoops, figure " + figcfg[annotation_field] + " does not exist. Trying to regenerate.")
 
-        matrix_df = pd.read_csv(os.path.join(
-            result_root, project, "matrix.tsv"), sep="\t", index_col=0)
-        annotation_df = pd.read_csv(os.path.join(
-            result_root, project, "annotations.tsv"), sep="\t", index_col=0)
+        matrix_df = tables.read_table(os.path.join(
+            result_root, project, "matrix.tsv"), index_col=0)
+        annotation_df = tables.read_table(os.path.join(
+            result_root, project, "annotations.tsv"), columns=[annotation_field], index_col=0)
 
         df = matrix_df.merge(annotation_df[[annotation_field]],
                             left_index=True,
@@ -1314,9 +923,15 @@ def main(global_config, **settings):
     config.add_route('rerun', '/rerun')
     config.add_view(rerun, route_name='rerun', renderer="json")
 
+    config.add_route('extend', '/extend')
+    config.add_view(extend, route_name='extend', renderer="json")
+
     config.add_route('load_config', '/load_config')
     config.add_view(load_config, route_name='load_config', renderer="json")
 
+    config.add_route('list_libraries', '/list_libraries')
+    config.add_view(list_libraries, route_name='list_libraries', renderer="json")
+
     config.add_route('get_notifications', '/get_notifications')
     config.add_view(get_notifications,
                     route_name='get_notifications', renderer="json")
@@ -1336,6 +951,28 @@ def main(global_config, **settings):
 
     config.add_static_view(name='/', path="assets/")
 
+    analysis_scheduler.max_running = max(1, int(settings.get("gladiator.max_analyses", 1)))
+
+    # Per-file tasks can be run by worker daemons on other nodes
+    queue_dir = settings.get("gladiator.queue_dir")
+    if queue_dir:
+        supervisor.set_task_executor(workqueue.QueueExecutor(queue_dir))
+
+    # Task outputs are shared between projects through the artifact cache
+    global artifact_cache
+    cache_dir = settings.get("gladiator.cache_dir", cache.DEFAULT_CACHE_DIR)
+    if cache_dir and cache_dir != "none":
+        cache_size = float(settings.get("gladiator.cache_size", cache.DEFAULT_MAX_BYTES / resources.GB))
+        artifact_cache = cache.ArtifactCache(cache_dir, int(cache_size * resources.GB))
+
+    global library_registry
+    library_registry = libraries.LibraryRegistry(\
+        settings.get("gladiator.library_dir", libraries.DEFAULT_LIBRARY_DIR), \
+        int(settings.get("gladiator.max_libraries", libraries.DEFAULT_MAX_LIBRARIES)), \
+        artifact_cache)
+
+    print (resources.describe_resources())
+
     ticker.start()
 
     os.chdir(result_root)
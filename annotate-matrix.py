@@ -51,6 +51,13 @@ if __name__=="__main__":
                         required=False,
                         help='Merge unimods, so that peptides will become unique by their sequences. [Default: No Merge].')
 
+    parser.add_argument('--openswath',
+                        action='store_true',
+                        dest='openswath',
+                        default=False,
+                        required=False,
+                        help='Annotate peptides of the OpenSwath results (DIA-analysis-result.csv) instead of the swaths2stats table. [Default: No].')
+
     parser.add_argument('--cache',
                         action='store_true',
                         dest='cache',
@@ -96,45 +103,50 @@ if __name__=="__main__":
             print ("Done.")
 
 
-        print ("Reading swath2stats table")
-        df = None
-        df = annotateSwath2stats.read_swaths2stats_peptide_table(\
-            None,\
-            log_fh,\
-            None,\
-            os.path.join(result_root, args.project_name, "DIA-peptide-matrix.tsv"))
-        print ("Done")
+        if args.openswath:
+            print ("Reading OpenSwath results")
+            df = None
+            df = annotation.read_openswathfile(\
+                None,\
+                log_fh,\
+                None,\
+                os.path.join(result_root, args.project_name, "DIA-analysis-result.csv"))
+            print ("Done")
 
-        print ("Annotating swaths2stats df")
-        annotateSwath2stats.annotate_df(\
+            print ("Annotating OpenSwath df")
+            annotation.annotate_df(\
+                    None,\
+                    log_fh,\
+                    None,\
+                    df,\
+                    dicts,\
+                    os.path.join(result_root, args.project_name, "matrix.tsv"),\
+                    os.path.join(result_root, args.project_name, "annotations.tsv"),\
+                    args.ambiguous_threshold,\
+                    args.merge_unimods,
+                    args.contaminants)
+            print ("Done")
+
+        else:
+            print ("Reading swath2stats table")
+            df = None
+            df = annotateSwath2stats.read_swaths2stats_peptide_table(\
                 None,\
                 log_fh,\
                 None,\
-                df,\
-                dicts,\
-                os.path.join(result_root, args.project_name, "matrix.tsv"),\
-                os.path.join(result_root, args.project_name, "annotations.tsv"),\
-                args.ambiguous_threshold,\
-                args.merge_unimods,
-                args.contaminants)
-        print ("Done")
-
-        # df = None
-        # df = annotation.read_openswathfile(\
-        #     None,\
-        #     log_fh,\
-        #     None,\
-        #     os.path.join(result_root, args.project_name, "DIA-analysis-result.csv"))
-
-        # annotation.annotate_df(\
-        #         None,\
-        #         log_fh,\
-        #         None,\
-        #         df,\
-        #         dicts,\
-        #         os.path.join(result_root, args.project_name, "matrix.tsv"),\
-        #         os.path.join(result_root, args.project_name, "annotations.tsv"),\
-        #         args.ambiguous_threshold,\
-        #         args.merge_unimods,
-        #         args.contaminants)
+                os.path.join(result_root, args.project_name, "DIA-peptide-matrix.tsv"))
+            print ("Done")
 
+            print ("Annotating swaths2stats df")
+            annotateSwath2stats.annotate_df(\
+                    None,\
+                    log_fh,\
+                    None,\
+                    df,\
+                    dicts,\
+                    os.path.join(result_root, args.project_name, "matrix.tsv"),\
+                    os.path.join(result_root, args.project_name, "annotations.tsv"),\
+                    args.ambiguous_threshold,\
+                    args.merge_unimods,
+                    args.contaminants)
+            print ("Done")
@@ -5,6 +5,8 @@ import pandas as pd
 import re
 
 from progress import Progress
+import annotation
+import tables
 
 
 def read_swaths2stats_peptide_table( event, 
@@ -16,7 +18,7 @@ def read_swaths2stats_peptide_table( event,
 
     step = 0
     n_steps = 2
-    df = pd.read_csv(in_filename, sep='\t')
+    df = tables.read_table(in_filename)
     step += 1
     progress.update_n_of_m(step, n_steps)
     df["Peptide"] = df["ProteinName_FullPeptideName"].apply(lambda x: x.split("_")[-1].strip())
@@ -58,52 +60,17 @@ def annotate_df(
         # df['Proteins'] = df['Proteins'].apply(lambda x: ";".join(set(x.split(';'))))
         # df['FullPeptideName'] = df['FullPeptideName'].apply(lambda x: ";".join(set(x.split(';'))))
 
-    nrows, _ = df.shape
-
-    step = 0
-    n_steps = nrows
+    n_steps = 1
 
     annot_colnames = list(dicts)
 
-    for annot_colname in annot_colnames:
-        df[annot_colname]=["" for x in range(nrows)]
-
+    print ("Annotating rows")
+    values = annotation.annotate_proteins(event, progress, df["Proteins"], dicts, ambiguous_threshold)
+    if values is None:
+        return
 
-    print ("Iterating rows")
-    for index, row in df.iterrows():
-
-        sets = {}
-        
-        for colname in annot_colnames:
-            if colname not in sets:
-                sets[colname] = set()
-
-        for ID in row["Proteins"].split(";"):
-            for k in dicts:
-                if ID in dicts[k]:
-                    sets[k].add(dicts[k][ID])
-
-        L = {}
-        for k in annot_colnames:
-            L[k] = list(sets[k])
-
-            if len(L[k]) > 1 and "unknown" in L[k]:
-                L[k].remove('unknown')
-
-            if len(L[k]) == 1:
-                df.at[df.index[index], k] = L[k][0]
-            elif len(L[k]) > 1:
-                if not ambiguous_threshold or (ambiguous_threshold and len(L[k]) < int(ambiguous_threshold)):
-                    df.at[df.index[index], k] = ";".join(L[k])
-                else:
-                    df.at[df.index[index], k] = "ambiguous"
-            else:
-                df.at[df.index[index], k] = "unknown"
-
-        step += 1
-        progress.update_n_of_m(step, n_steps)
-        if event and event.kill_flag:
-            return
+    for annot_colname in annot_colnames:
+        df[annot_colname] = values[annot_colname]
 
     if contaminants:
         df = df[~df.Proteins.str.contains("|".join(contaminants))]
@@ -117,7 +84,7 @@ def annotate_df(
         annot_df_cols.extend(annot_colnames)
         annot_df = df.filter(items=annot_df_cols)
         #annot_df.rename(columns={use_col:"FullPeptideName"}, inplace=True)
-        annot_df.to_csv(out_annot_filename, sep="\t", index=False)
+        tables.write_table(annot_df, out_annot_filename)
 
     if out_matrix_filename:
         print ("making matrix file")
@@ -126,7 +93,7 @@ def annotate_df(
         df_cols.extend(sorted_samplenames)
         df = df.filter(df_cols)
         #df.rename(columns={use_col:"FullPeptideName"}, inplace=True)
-        df.to_csv(out_matrix_filename, sep="\t", index=False)
+        tables.write_table(df, out_matrix_filename)
 
     progress.update_n_of_m(n_steps, n_steps)
     progress.ready()
@@ -7,6 +7,8 @@ import pandas as pd
 import re
 
 from progress import Progress
+import openswath
+import tables
 
 from Bio import SeqIO
 
@@ -57,39 +59,144 @@ def load_genbank_annotations(gb_file, descriptions, dicts):
     return dicts
 
 
-def load_annotations(event, log_fh, progressData, ID_key, anno_file, dicts):
-    
-    progress = Progress(progressData, "percentage-indicator")
+def load_annotations(event, log_fh, progressData, ID_key, anno_file, dicts, fields=None):
 
-    df = pd.read_csv(anno_file, sep='\t')
+    # Annotations are kept as a table indexed by protein ID with a
+    # categorical column per field, values as strings without surrounding
+    # whitespace and missing ones as NaN. Of duplicated IDs the last row is
+    # used. dicts is the table of the annotation files read before (or
+    # annotations as {field: {ID: value}}), the values of this file override
+    # theirs. Only the given fields are read if fields is set.
 
-    if dicts is None:
-        dicts = {}
+    progress = Progress(progressData, "percentage-indicator")
+    n_steps = 3
 
-    fields = df.columns.tolist()
+    usecols = None
+    if fields:
+        usecols = [ID_key] + [x for x in fields if x != ID_key]
 
-    fields.remove(ID_key)
+    df = tables.read_table(anno_file, columns=usecols, dtype={ID_key: str})
 
-    rows, _ = df.shape
+    progress.update_n_of_m(1, n_steps)
+    if event and event.kill_flag:
+        return
 
-    step = 0
-    n_steps = rows
+    table = annotation_table(df, ID_key)
 
-    for _, row in df.iterrows():
-        ID = row[ID_key]
-        for field in fields:
-            if field not in dicts:
-                dicts[field] = {}
-            dicts[field][ID] = str(row[field]).strip()
-        step += 1
-        progress.update_n_of_m(step, n_steps)
-        if event and event.kill_flag:
-            return
+    progress.update_n_of_m(2, n_steps)
+    if event and event.kill_flag:
+        return
+
+    if dicts is not None:
+        table = merge_annotations(dicts, table)
 
     progress.update_n_of_m(n_steps, n_steps)
     progress.ready()
 
-    return dicts
+    return table
+
+
+def annotation_table(df, ID_key):
+    df = df[df[ID_key].notna()]
+    df = df.drop_duplicates(subset=ID_key, keep="last")
+    table = df.set_index(ID_key)
+    for field in table.columns:
+        table[field] = table[field].map(str).str.strip().astype("category")
+    return table
+
+
+def merge_annotations(old, new):
+
+    # Values of new override those of old, fields are kept in the order
+    # they were first read
+
+    if not isinstance(old, pd.DataFrame):
+        old = pd.DataFrame(old)
+
+    columns = list(old.columns) + [x for x in new.columns if x not in old.columns]
+
+    table = new.astype(object).combine_first(old.astype(object)).reindex(columns=columns)
+    for field in table.columns:
+        table[field] = table[field].astype("category")
+    return table
+
+
+def annotate_proteins(event, progress, proteins, dicts, ambiguous_threshold, split_IDs=False):
+
+    # Annotation values of each row of proteins (";" separated protein IDs)
+    # for every field of dicts. A row gets the field's value of its
+    # proteins if they agree, their values joined by ";" if they differ
+    # ("unknown" is dropped from several values), "ambiguous" if there are
+    # ambiguous_threshold or more different values and "unknown" if none of
+    # its proteins is annotated. With split_IDs the IDs are cut at "|".
+    #
+    # The rows are exploded to (row, protein ID) pairs and joined with each
+    # field at once. Only rows with several values are handled one by one,
+    # building the same set in the same order as a row by row loop would,
+    # so that the values are joined in the same order.
+    #
+    # dicts is an annotation table (see load_annotations) or annotations as
+    # {field: {ID: value}}. Returns {field: values}, None if cancelled.
+
+    proteins = proteins.reset_index(drop=True)
+    nrows = len(proteins)
+
+    IDs = proteins.str.split(";").explode()
+    if split_IDs:
+        IDs = IDs.str.split("|").str[0]
+    rows = IDs.index.to_numpy()
+
+    n_steps = len(dicts)
+
+    values = {}
+    for step, field in enumerate(dicts):
+
+        if isinstance(dicts, pd.DataFrame):
+            mapping = dicts[field].dropna()
+            found = IDs.isin(mapping.index).to_numpy()
+        else:
+            mapping = dicts[field]
+            found = IDs.isin(mapping.keys()).to_numpy()
+
+        hits = pd.DataFrame({
+            "row": rows[found],
+            "value": IDs[found].map(mapping).to_numpy(),
+        }).drop_duplicates()
+
+        hit_rows = hits["row"].to_numpy()
+        hit_values = hits["value"].to_numpy()
+        counts = np.bincount(hit_rows, minlength=nrows)[hit_rows]
+
+        column = np.full(nrows, "unknown", dtype=object)
+
+        single = counts == 1
+        column[hit_rows[single]] = hit_values[single]
+
+        multi_rows = hit_rows[~single]
+        multi_values = hit_values[~single]
+        if len(multi_rows):
+            boundaries = np.flatnonzero(np.diff(multi_rows)) + 1
+            starts = np.concatenate([[0], boundaries])
+            for row, row_values in zip(multi_rows[starts], np.split(multi_values, boundaries)):
+                L = list(set(row_values))
+
+                if len(L) > 1 and "unknown" in L:
+                    L.remove('unknown')
+
+                if len(L) == 1:
+                    column[row] = L[0]
+                elif not ambiguous_threshold or (ambiguous_threshold and len(L) < int(ambiguous_threshold)):
+                    column[row] = ";".join(L)
+                else:
+                    column[row] = "ambiguous"
+
+        values[field] = column
+
+        progress.update_n_of_m(step + 1, n_steps)
+        if event and event.kill_flag:
+            return None
+
+    return values
 
 
 def annotate_df(
@@ -130,54 +237,16 @@ def annotate_df(
         df['Proteins'] = df['Proteins'].apply(lambda x: ";".join(set(x.split(';'))))
         df['Sequence'] = df['Sequence'].apply(lambda x: ";".join(set(x.split(';'))))
 
-    nrows, _ = df.shape
-
-    step = 0
-    n_steps = nrows
+    n_steps = 1
 
     annot_colnames = list(dicts)
 
-    for annot_colname in annot_colnames:
-        df[annot_colname]=["" for x in range(nrows)]
-
-    for _, row in df.iterrows():
+    values = annotate_proteins(event, progress, df["Proteins"], dicts, ambiguous_threshold, split_IDs=True)
+    if values is None:
+        return
 
-        sets = {}
-        
-        for colname in annot_colnames:
-            if colname not in sets:
-                sets[colname] = set()
-
-        l = row["Proteins"].split(";")
-
-        l = [x.split("|")[0] for x in l] # UGLY filtering
-
-        for ID in l:
-            for k in dicts:
-                if ID in dicts[k]:
-                    sets[k].add(dicts[k][ID])
-
-        L = {}
-        for k in annot_colnames:
-            L[k] = list(sets[k])
-
-            if len(L[k]) > 1 and "unknown" in L[k]:
-                L[k].remove('unknown')
-
-            if len(L[k]) == 1:
-                df.at[df.index[index], k] = L[k][0]
-            elif len(L[k]) > 1:
-                if not ambiguous_threshold or (ambiguous_threshold and len(L[k]) < int(ambiguous_threshold)):
-                    df.at[df.index[index], k] = ";".join(L[k])
-                else:
-                    df.at[df.index[index], k] = "ambiguous"
-            else:
-                df.at[df.index[index], k] = "unknown"
-
-        step += 1
-        progress.update_n_of_m(step, n_steps)
-        if event and event.kill_flag:
-            return
+    for annot_colname in annot_colnames:
+        df[annot_colname] = values[annot_colname]
 
     # df.to_csv(out_mixedmatrix_filename, sep="\t", index=False)
  
@@ -186,21 +255,22 @@ def annotate_df(
     else:
         use_col = 'FullPeptideName'
 
-    df = df[~df.Proteins.str.contains("|".join(contaminants))]
+    if contaminants:
+        df = df[~df.Proteins.str.contains("|".join(contaminants))]
 
     if out_annot_filename:
         annot_df_cols = [use_col,'Proteins']
         annot_df_cols.extend(annot_colnames)
         annot_df = df.filter(items=annot_df_cols)
         annot_df.rename(columns={use_col:"FullPeptideName"}, inplace=True)
-        annot_df.to_csv(out_annot_filename, sep="\t", index=False)
+        tables.write_table(annot_df, out_annot_filename)
 
     if out_matrix_filename:
         df_cols = [use_col] 
         df_cols.extend(sorted_samplenames)
         df = df.filter(df_cols)
         df.rename(columns={use_col:"FullPeptideName"}, inplace=True)
-        df.to_csv(out_matrix_filename, sep="\t", index=False)
+        tables.write_table(df, out_matrix_filename)
 
     progress.update_n_of_m(n_steps, n_steps)
     progress.ready()
@@ -216,94 +286,76 @@ def read_openswathfile(
 
     progress = Progress(progressData, "percentage-indicator")
 
-    entries = {}
-    filenames = []
-
-    df = pd.read_csv(in_filename, sep="\t")
-    df = df[df['decoy'] == 0]
+    # Intensities of the target peptides as a (FullPeptideName, Charge) x
+    # sample matrix. The file is read in chunks (see openswath.py) and the
+    # matrix built up chunk by chunk, so that files larger than the memory
+    # can be read. The Sequence and ProteinName of a peptide are taken from
+    # its first row, peptides are in the order they first appear in the
+    # file and missing intensities are 0.
 
-    df['ProteinName'] = df['ProteinName'].apply(lambda x: ";".join(x.split('/')[1:]))
-    
-    nrows, _ = df.shape
+    n_steps = openswath.estimate_chunks(in_filename) + 1
 
-    step = 0
-    n_steps = nrows * 2
+    columns = ["Sequence", "FullPeptideName", "Charge", "Intensity", "ProteinName", "filename"]
+    dtype = {
+        "Sequence": str,
+        "FullPeptideName": str,
+        "Charge": str,
+        "Intensity": np.float64,
+        "ProteinName": str,
+        "filename": str,
+    }
 
-    for i in range(1, nrows):
-        row_df = df.iloc[[i],:]
+    keys = ["FullPeptideName", "Charge"]
 
-        fields = {
-                    "Sequence":None,
-                    "FullPeptideName":None,
-                    "Charge":None,
-                    "m/z":None,
-                    "Intensity":None,
-                    "ProteinName":None,
-                    "filename": None,
-        }
+    filenames = []
+    peptides = []
+    intensities = []
+    n_values = 0
+    n_duplicates = 0
 
-        for field in fields:
-            fields[field] = row_df[field].iloc[0]
+    for step, df in enumerate(openswath.iter_targets(in_filename, columns, dtype)):
 
-        fields['filename'] = os.path.basename(fields['filename']) 
-        if not fields['filename'] in filenames:
-            filenames.append(fields['filename'])
+        df['ProteinName'] = df['ProteinName'].str.split('/').str[1:].str.join(";")
+        df['filename'] = df['filename'].map(os.path.basename)
 
-        indexTuple = (fields['FullPeptideName'], fields['Charge'])
+        filenames.extend(x for x in df['filename'].unique() if x not in filenames)
 
-        if not indexTuple in entries:
-            entries[indexTuple] = {}
+        duplicates = df.duplicated(keys + ["filename"])
+        n_duplicates += duplicates.sum()
+        df = df[~duplicates]
+        n_values += len(df)
 
-        if not fields['filename'] in entries[indexTuple]:
-            entries[indexTuple][fields['filename']] = fields
-        else:
-            print ("Error: already contains following an entry ")
+        peptides.append(df.drop_duplicates(keys)[keys + ["Sequence", "ProteinName"]])
+        intensities.append(df.set_index(keys + ["filename"])["Intensity"].unstack("filename"))
 
-        step += 1
-        progress.update_n_of_m(step, n_steps)
+        # Of values found again in a later chunk the first one is used
+        if len(intensities) >= 8:
+            intensities = [merge_intensities(intensities)]
 
+        progress.update_n_of_m(min(step + 1, n_steps - 1), n_steps)
         if event and event.kill_flag:
             return None
 
+    if not peptides:
+        return pd.DataFrame(columns=["FullPeptideName", "Sequence", "Proteins"])
 
-    #colnames = ["FullPeptideName", "Sequence", "Charge", "m/z" ,"ProteinName"]
-
-    colnames = ["FullPeptideName", "Sequence", "ProteinName"]
-    intensity_df = pd.DataFrame(columns = colnames + filenames)
-
-    n_steps = nrows + len(entries)
-
-    for key_tuple in entries:
-
-        entry = entries[key_tuple]
-        content = {}
-        for filename in filenames:
-
-            if filename in entry:
-
-                for colname in colnames:
+    peptides = pd.concat(peptides).drop_duplicates(keys).reset_index(drop=True)
+    intensities = merge_intensities(intensities)
 
-                        if not colname in content:
-                            content[colname] = entry[filename][colname]
-                        else:
-                            assert entry[filename][colname] == entry[filename][colname]
+    n_duplicates += n_values - intensities.count().sum()
+    if n_duplicates:
+        print ("Error: " + str(n_duplicates) + " peptides found more than once in a sample, using the first")
 
-                content[filename] = entry[filename]["Intensity"]
-            else:
-                content[filename] = 0
+    intensities = intensities \
+        .reindex(index=pd.MultiIndex.from_frame(peptides[keys]), columns=filenames) \
+        .fillna(0) \
+        .reset_index(drop=True)
+    intensities.columns = filenames
 
-        #content["FullPeptideName"] = content["FullPeptideName"] + "_" + str(content["Charge"])
-
-        intensity_df = intensity_df.append(
-            content, 
-            ignore_index=True
-        )
-
-        step += 1
-        progress.update_n_of_m(step, n_steps)
+    #colnames = ["FullPeptideName", "Sequence", "Charge", "m/z" ,"ProteinName"]
 
-        if event and event.kill_flag:
-            return None
+    colnames = ["FullPeptideName", "Sequence", "ProteinName"]
+    intensity_df = pd.concat([peptides[colnames], intensities], axis=1)
 
     intensity_df.rename(columns={"ProteinName":"Proteins"}, inplace=True)
 
@@ -311,3 +363,8 @@ def read_openswathfile(
     progress.ready()
 
     return intensity_df
+
+
+def merge_intensities(intensities):
+    df = pd.concat(intensities, sort=False)
+    return df.groupby(level=[0, 1], sort=False).first()
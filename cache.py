@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+
+
+# Content-addressed cache of pipeline task outputs, shared by all projects.
+#
+# A task's key is a hash of its name, parameters, the versions of the tools
+# it runs and the fingerprints of its inputs. Inputs produced by other
+# tasks are represented by the producing task's key, other inputs by a hash
+# of their content (small files) or of their name, size and mtime (large
+# spectrum files). The outputs of a task are stored under its key as
+#
+#   <cache_dir>/<key[:2]>/<key>/manifest.json
+#   <cache_dir>/<key[:2]>/<key>/files/<output path relative to the project>
+#
+# The outputs are added to the cache by hardlink (reflink or copy across
+# filesystems), so tasks must replace their output files rather than
+# rewrite them in place, which the pipeline tasks do by removing old
+# outputs first. They are restored into a project by reflink or copy, not
+# by hardlink: restored files get the current time, and setting it on an
+# inode shared with the cache would change the mtimes of the outputs of
+# every project linked to the entry.
+# The manifest's mtime records the last use; the least recently used
+# entries are evicted when the cache grows past max_bytes.
+#
+# Outputs that are expensive to hash or build (the sequence databases) use
+# content_hash(), remembered in hashes/, and lock_key() in locks/ so that
+# concurrent analyses wait for one build instead of repeating it.
+
+DEFAULT_CACHE_DIR = "/run-files/.cache"
+DEFAULT_MAX_BYTES = 200 * 1024 ** 3
+
+# Files up to this size are fingerprinted by content
+HASH_CONTENT_LIMIT = 64 * 1024 ** 2
+
+# ioctl request to clone a file's extents (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def hash_file(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_data(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def clone_file(src, dst, link=True):
+
+    # Hardlink (if link), reflink or copy, whichever works first. Only a
+    # file that is not a hardlink may have its times set.
+
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP]:
+                raise
+
+    with open(src, "rb") as src_fh, open(dst, "wb") as dst_fh:
+        try:
+            fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            None
+    shutil.copy2(src, dst)
+
+
+class ArtifactCache:
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+        for subdir in ["tmp", "locks", "hashes"]:
+            os.makedirs(os.path.join(cache_dir, subdir), exist_ok=True)
+
+    def entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def locked(self, exclusive):
+
+        # Serializes stores and evictions between processes sharing the
+        # cache; restores take a shared lock so that an entry being linked
+        # into a project is not evicted underneath.
+
+        fh = open(os.path.join(self.cache_dir, "lock"), "a")
+        fcntl.flock(fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return fh
+
+    def lock_key(self, key, event=None):
+
+        # Exclusive lock on key between processes, so that an output built
+        # by one analysis is waited for by the others instead of being built
+        # twice. Returns the lock file handle (closing it releases the lock),
+        # or None if the event was killed while waiting.
+        #
+        # A held lock is waited for by a helper thread blocking in flock, so
+        # that the lock is taken as soon as it is released and a kill of the
+        # event ends the wait at once. After a kill the helper releases the
+        # lock when it gets it.
+
+        fh = open(os.path.join(self.cache_dir, "locks", key + ".lock"), "a")
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fh
+        except BlockingIOError:
+            None
+
+        if not event:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            return fh
+
+        wake = threading.Event()
+        state = {"locked": False, "cancelled": False}
+        state_lock = threading.Lock()
+
+        def acquire():
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            with state_lock:
+                if state["cancelled"]:
+                    fh.close()
+                else:
+                    state["locked"] = True
+            wake.set()
+
+        threading.Thread(target=acquire, daemon=True).start()
+
+        event.add_kill_callback(wake.set)
+        try:
+            wake.wait()
+        finally:
+            event.remove_kill_callback(wake.set)
+
+        with state_lock:
+            if state["locked"]:
+                return fh
+            state["cancelled"] = True
+        return None
+
+    def content_hash(self, filepath):
+
+        # Hash of the whole file, remembered in hashes/ by path, size and
+        # mtime so that large files are hashed once for all projects
+
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        memo_filename = os.path.join(self.cache_dir, "hashes", \
+            hashlib.sha256(filepath.encode()).hexdigest() + ".json")
+
+        try:
+            with open(memo_filename, "r") as fh:
+                memo = json.load(fh)
+            if memo["size"] == st.st_size and memo["mtime_ns"] == st.st_mtime_ns:
+                return memo["sha256"]
+        except (OSError, ValueError, KeyError):
+            None
+
+        sha = hash_file(filepath)
+
+        tmp_filename = memo_filename + "." + uuid.uuid4().hex
+        with open(tmp_filename, "w") as fh:
+            json.dump({"path": filepath, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha}, fh)
+        os.rename(tmp_filename, memo_filename)
+
+        return sha
+
+    def fingerprint(self, filepath):
+
+        # Memoized by size and mtime, hashing is only redone when the file
+        # changes
+
+        st = os.stat(filepath)
+        memo_key = (filepath, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if memo_key in self.fingerprints:
+                return self.fingerprints[memo_key]
+
+        if st.st_size <= HASH_CONTENT_LIMIT:
+            fingerprint = "sha256:" + hash_file(filepath)
+        else:
+            fingerprint = "stat:" + os.path.basename(filepath) + ":" + str(st.st_size) + ":" + str(st.st_mtime_ns)
+
+        with self.lock:
+            self.fingerprints[memo_key] = fingerprint
+        return fingerprint
+
+    def tool_version(self, tool):
+
+        # Tools are identified by the fingerprint of their executable (or
+        # jar, script), found from PATH if not given as a path
+
+        filepath = tool
+        if not os.path.isabs(tool):
+            filepath = shutil.which(tool)
+        if not filepath or not os.path.isfile(filepath):
+            return tool + ":missing"
+        return tool + ":" + self.fingerprint(filepath)
+
+    def make_key(self, name, params, tools, inputs):
+
+        # inputs is a list of (name, fingerprint) pairs
+
+        return hash_data({
+            "task": name,
+            "params": params,
+            "tools": sorted(self.tool_version(x) for x in tools),
+            "inputs": inputs,
+        })
+
+    def restore(self, key, cwd, outputs):
+
+        # Copies the cached outputs of key into cwd. Returns False if the
+        # entry is missing or incomplete.
+
+        entry = self.entry(key)
+        lock_fh = self.locked(False)
+        try:
+            manifest_filename = os.path.join(entry, "manifest.json")
+            if not os.path.isfile(manifest_filename):
+                return False
+
+            with open(manifest_filename, "r") as fh:
+                manifest = json.load(fh)
+
+            if sorted(manifest["files"]) != sorted(outputs):
+                return False
+
+            for filename, size in manifest["files"].items():
+                src = os.path.join(entry, "files", filename)
+                if not os.path.isfile(src) or os.path.getsize(src) != size:
+                    return False
+
+            for filename in outputs:
+                dst = os.path.join(cwd, filename)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                clone_file(os.path.join(entry, "files", filename), dst, link=False)
+
+            # Restored files get the current time so that they are not
+            # older than inputs that were touched since they were made. They
+            # are not hardlinks, so the cached files keep their times.
+            now = time.time()
+            for filename in outputs:
+                os.utime(os.path.join(cwd, filename), (now, now))
+            os.utime(manifest_filename, None)
+
+        finally:
+            lock_fh.close()
+
+        return True
+
+    def store(self, key, cwd, outputs, description):
+
+        # Adds the outputs of a completed task. Entries are assembled in
+        # tmp/ and renamed into place, a concurrent store of the same key
+        # keeps the first one.
+
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return
+
+        tmp_entry = os.path.join(self.cache_dir, "tmp", key + "-" + uuid.uuid4().hex)
+        files = {}
+        try:
+            for filename in outputs:
+                src = os.path.join(cwd, filename)
+                dst = os.path.join(tmp_entry, "files", filename)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                clone_file(src, dst)
+                files[filename] = os.path.getsize(dst)
+
+            with open(os.path.join(tmp_entry, "manifest.json"), "w") as fh:
+                json.dump({
+                    "key": key,
+                    "created": time.time(),
+                    "files": files,
+                    "description": description,
+                }, fh, indent=1)
+
+            lock_fh = self.locked(True)
+            try:
+                os.makedirs(os.path.dirname(entry), exist_ok=True)
+                if not os.path.isdir(entry):
+                    os.rename(tmp_entry, entry)
+                self.evict()
+            finally:
+                lock_fh.close()
+
+        finally:
+            if os.path.isdir(tmp_entry):
+                shutil.rmtree(tmp_entry)
+
+    def entries(self):
+
+        # Returns [(last use, size, entry path)] of every complete entry
+
+        result = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                manifest_filename = os.path.join(entry, "manifest.json")
+                try:
+                    last_use = os.path.getmtime(manifest_filename)
+                    with open(manifest_filename, "r") as fh:
+                        size = sum(json.load(fh)["files"].values())
+                except (OSError, ValueError, KeyError):
+                    continue
+                result.append((last_use, size, entry))
+        return result
+
+    def evict(self):
+
+        # Called with the exclusive lock held
+
+        if not self.max_bytes:
+            return
+
+        entries = sorted(self.entries())
+        total = sum(x[1] for x in entries)
+        for last_use, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
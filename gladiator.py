@@ -21,6 +21,12 @@ import json
 import threading
 
 import workflow
+import pipeline
+import supervisor
+import workqueue
+import resources
+import cache
+import libraries
 
 from progress import Progress
 
@@ -110,6 +116,65 @@ if __name__=="__main__":
                         default=None,
                         help='Set amount of threads. [default: auto]')
 
+    parser.add_argument('--search-workers', 
+                        action='store',
+                        dest='search_workers',
+                        type=int,
+                        required=False,
+                        default=1,
+                        help='Number of concurrent search engine processes. The thread budget is split between them. [default: 1]')
+
+    parser.add_argument('--openswath-workers', 
+                        action='store',
+                        dest='openswath_workers',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='Number of DIA samples processed concurrently by OpenSwathWorkflow. [default: auto, based on threads and memory]')
+
+    parser.add_argument('--queue-dir', 
+                        action='store',
+                        dest='queue_dir',
+                        required=False,
+                        default=None,
+                        help='Run per-file tasks (searches, DIA-Umpire, OpenSWATH, pyprophet) through worker daemons (workqueue.py) sharing this folder. [default: run locally]')
+
+    parser.add_argument('--cache-dir', 
+                        action='store',
+                        dest='cache_dir',
+                        required=False,
+                        default=cache.DEFAULT_CACHE_DIR,
+                        help='Folder of the artifact cache shared between projects, "none" to disable. [default: ' + cache.DEFAULT_CACHE_DIR + ']')
+
+    parser.add_argument('--cache-size', 
+                        action='store',
+                        dest='cache_size',
+                        type=float,
+                        required=False,
+                        default=cache.DEFAULT_MAX_BYTES / resources.GB,
+                        help='Size of the artifact cache in GB, least recently used outputs are evicted past it. [default: ' + str(int(cache.DEFAULT_MAX_BYTES / resources.GB)) + ']')
+
+    parser.add_argument('--use-library', 
+                        action='store',
+                        dest='use_library',
+                        required=False,
+                        default=None,
+                        help='Quantify against a spectral library pinned by an earlier analysis instead of building one.')
+
+    parser.add_argument('--pin-library', 
+                        action='store',
+                        dest='pin_library',
+                        required=False,
+                        default=None,
+                        help='Pin the spectral library of this analysis under a name for later analyses.')
+
+    parser.add_argument('--extend-project', 
+                        action='store_true',
+                        dest='extend_project',
+                        required=False,
+                        default=False,
+                        help='Add the DIA samples to an analysed project. Samples scored before are reused, the project\'s library and settings are kept.')
+
     parser.add_argument('--design-file', 
                         action='store',
                         dest='design_file',
@@ -138,13 +203,25 @@ if __name__=="__main__":
 
     delete_temp_files_flag = not args.retain_tmp_files
     
-    max_threads = os.cpu_count()
-    if not max_threads:
-        max_threads = 1
+    max_threads = resources.available_cpus()
 
     if args.threads:
         max_threads = args.threads
 
+    if args.queue_dir:
+        supervisor.set_task_executor(workqueue.QueueExecutor(args.queue_dir))
+
+    artifact_cache = None
+    if args.cache_dir and args.cache_dir != "none":
+        artifact_cache = cache.ArtifactCache(args.cache_dir, int(args.cache_size * resources.GB))
+
+    for name in [args.use_library, args.pin_library]:
+        if name and not libraries.valid_name(name):
+            print ("Invalid library name " + name)
+            sys.exit(1)
+
+    library_registry = libraries.LibraryRegistry(artifact_cache=artifact_cache)
+
     result_root = "/run-files"
 
     project = args.project_name
@@ -175,6 +252,12 @@ if __name__=="__main__":
         
     if "xtandem" in args.search_engines:
         options.append("use_xtandem_flag")
+
+    if library_files:
+        options.append("dda_library")
+
+    # The command line has always centroided the DIA data when converting
+    options.append("dia_peak_picking")
         
     delete_tmp_files_flag = not args.retain_tmp_files
 
@@ -183,20 +266,26 @@ if __name__=="__main__":
     scan = None
     data = None
 
-    if not os.path.isfile(cfgfile):
+    cfg = {
+        "analysis_name": analysis_name, 
+        "files": {
+            "samples": sample_files, 
+            "library": library_files, 
+            "database": database_files
+        }, 
+        "pvalue": pvalue,
+        "trig_target_pvalue": trig_target_pvalue, 
+        "trig_max_pvalue": trig_max_pvalue, 
+        "options": options
+    }
+
+    if args.use_library:
+        cfg["use_library"] = args.use_library
+
+    if args.pin_library:
+        cfg["pin_library"] = args.pin_library
 
-        cfg = {
-            "analysis_name": analysis_name, 
-            "files": {
-                "samples": sample_files, 
-                "library": library_files, 
-                "database": database_files
-            }, 
-            "pvalue": pvalue,
-            "trig_target_pvalue": trig_target_pvalue, 
-            "trig_max_pvalue": trig_max_pvalue, 
-            "options": options
-        }
+    if not os.path.isfile(cfgfile):
 
         with open(cfgfile, "w") as fh:
             json.dump(cfg, fh)
@@ -208,6 +297,26 @@ if __name__=="__main__":
             sys.exit(1)
         data = scan["config"]
 
+    # New samples are added to the existing project's configuration
+
+    if args.extend_project:
+        if not data:
+            print ("Project " + project + " has not been analysed, it can not be extended.")
+            sys.exit(1)
+        cfg = data
+        for filename in sample_files:
+            if filename not in cfg["files"]["samples"]:
+                cfg["files"]["samples"].append(filename)
+        with open(cfgfile, "w") as fh:
+            json.dump(cfg, fh)
+
+    elif data:
+
+        # The stored configuration follows the command line, the pipeline
+        # reruns the tasks whose parameters changed
+
+        workflow.write_if_changed(cfgfile, json.dumps(cfg))
+
     # Sanity check here
 
     # 1) At least one DIA file
@@ -224,512 +333,27 @@ if __name__=="__main__":
 
         logline(log_fh, "Pipeline command line: " + " ".join(sys.argv))
         logline(log_fh, "Option list: " + "; ".join(options))
-        
-        # Convert DIA data to open format
-
-        extensions = set()
-        for filename in sample_files:
-            extension = os.path.splitext(filename)[1].lower()
-            extensions.add(extension)
-
-        extensions = list(extensions)
-
-        # TODO: Return the actual error
-        if len(extensions) > 1:
-            print("A single input type allowed, multile file types found (" + ", ".join(extensions) + ")")
-            sys.exit(1)
-
-        # TODO: Return the actual error
-        if extension not in [".mzml", ".mzxml", ".raw"]:
-            print("Unknown extension (" + extension + ") found.")
-            sys.exit(1)
-
-        if (extension == ".raw"):
-
-            if not os.path.exists("/wineprefix64"):
-                print("This version of gladiator does not support raw files.")
-                sys.exit(1)
-
-            if scan and "conv_DIA" in scan and scan["conv_DIA"]:
-                print ("Detected existing converted DIA files.")
-                None
-
-            else:
-                phaseID = analysis_state.createPhase("Converting RAW DIA files")
-                workflow.convertRAW(\
-                    event, \
-                    log_fh,\
-                    analysis_state.getPhaseData(phaseID), \
-                    cwd, \
-                    sample_files, \
-                    True, \
-                    "mzml",
-                    "DIA")
-
-            if event.kill_flag:
-                sys.exit(1)
-
-            # replace sample files with converted versions
-            sample_files = [os.path.join(cwd, "DIA", x) for x in os.listdir(os.path.join(cwd, "DIA"))]
-
-
-        # Convert DDA data to open format
-
-        if library_files:
-
-            extensions = set()
-            extension = None
-
-            for filename in library_files:
-                extension = os.path.splitext(filename)[1].lower()
-                extensions.add(extension)
-
-            extensions = list(extensions)
-
-            # TODO: Return the actual error
-            if len(extensions) > 1:
-                print("A single input type allowed, multile file types found (" + ", ".join(extensions) + ")")
-                sys.exit(1)
-
-            # TODO: Return the actual error
-            if extension not in [".mzml", ".mzxml", ".raw"]:
-                print("Unknown extension (" + extension + ") found.")
-                sys.exit(1)
-
-            if (extension == ".raw"):
-
-                if not os.path.exists("/wineprefix64"):
-                    print("This version of gladiator does not support raw files.")
-                    sys.exit(1)
-
-                if scan and "conv_DDA" in scan and scan["conv_DDA"]:
-                    print ("Detected existing converted DDA files.")
-                    None
-
-                else:
-                    phaseID = analysis_state.createPhase("Converting RAW DDA files (+picking peaks)")
-                    workflow.convertRAWqtofpeakpicker(\
-                        event, \
-                        log_fh, \
-                        analysis_state.getPhaseData(phaseID), \
-                        cwd, \
-                        library_files, \
-                        "DDA")
-
-                if event.kill_flag:
-                    sys.exit(1)
-                            
-                # replace library raw files with converted versions
-                library_files = [os.path.join(cwd, "DDA", x) for x in os.listdir(os.path.join(cwd, "DDA"))]
-
-
-        swaths_min = 0
-        swaths_max = 0
-
-        swaths, tswaths = workflow.create_swath_window_files(cwd, sample_files[0])
-        swaths_min = swaths[0][0]
-        swaths_max = swaths[-1][1]
-
-        pseudospectrafiles = []
-        if not args.library_DDA:
-
-            if scan and "pseudospectra" in scan and scan["pseudospectra"]:
-                print ("Detected existing converted DDA files.")
-                pseudospectrafiles = scan["pseudospectrafiles"]
-                None
-
-            else:
-                phaseID = analysis_state.createPhase("Building pseudospectra")
-                pseudospectrafiles = workflow.runDiaumpire(\
-                    event, \
-                    log_fh, \
-                    analysis_state.getPhaseData(phaseID), \
-                    cwd, \
-                    sample_files, \
-                    "libfree",
-                    max_threads)
-
-            if event.kill_flag:
-                sys.exit(1)
-
-        # BUILD SEQUENCE DATABASE
-
-        db_filename = "DB.fasta"
-        decoy_db_file = "DB_with_decoys.fasta"
-
-        if scan and "DB" in scan and scan["DB"]:
-            print ("Detected existing sequence database")
-        else:
-            phaseID = analysis_state.createPhase("Building database")
-            workflow.build_database(\
-                event, \
-                log_fh, \
-                analysis_state.getPhaseData(phaseID), \
-                cwd, \
-                database_files, \
-                db_filename, \
-                decoy_db_file)
-
-            if event.kill_flag:
-                sys.exit(1)
-
-
-        # BUILD lib & pseudolib peptide files
-
-        libmethod_pepXMLs = []
-        libfreemethod_pepXMLs = []
-
-        if "use_comet_flag" in options:
-
-            comet_cfg = "/opt/gladiator/comet.params.template"
-
-            if library_files:
-
-                if scan and "comet_peptides" in scan and scan["comet_peptides"]:
-                    print ("Detected existing Comet spectra search results")
-
-                else:
-
-                    comet_cfg = os.path.join(cwd, "comet_settings.xml")
-
-                    cfg_txt = None
-                    with open("/opt/gladiator/comet_settings_template.xml", "r") as fh:
-                        cfg_txt = fh.read()
-
-                    param_map = {
-                        "PRECURSOR_MASS_TOLERANCE":"20",
-                        "FRAGMENT_MASS_TOLERANCE": "{:.2f}".format(float("0.02")/2),
-                        "DATABASE_FASTA_FILE": decoy_db_file
-                    }    
-
-                    for k in param_map:
-                        value = param_map[k]
-                        cfg_txt = cfg_txt.replace(k, value)
-
-                    with open(comet_cfg,"w") as fh:
-                        fh.write(cfg_txt)
-
-
-                    # Cleanup
-
-                    filenames = \
-                    ["interact_comet_pep-MODELS.html", \
-                    "interact_comet_pep.xml", \
-                    "interact_comet_pep.xml.index", \
-                    "interact_comet_pep.xml.RTcoeff", \
-                    "interact_comet_pep.xml.RTstats"]
-
-                    for filename in filenames:
-                        filepath = os.path.join(cwd, filename)
-                        if os.path.isfile(filepath):
-                            os.remove(filepath)
-
-                    # Run Comet
-
-                    existing_pep_xmls = None
-                    if scan and "samples_generated_by_comet" in scan:
-                        existing_pep_xmls = scan["samples_generated_by_comet"]
-
-                    phaseID = analysis_state.createPhase("Speclib - Matching sequences [Comet]")
-                    workflow.runComet(\
-                        event, \
-                        log_fh, \
-                        analysis_state.getPhaseData(phaseID), \
-                        cwd, \
-                        comet_cfg, \
-                        library_files, \
-                        existing_pep_xmls, \
-                        "interact_comet_pep.xml", \
-                        cwd)
-
-                if event.kill_flag:
-                    sys.exit(1)
-
-                libmethod_pepXMLs.append("interact_comet_pep.xml")
-
-            if pseudospectrafiles:
-
-                if scan and "comet_pseudo_peptides" in scan and scan["comet_pseudo_peptides"]:
-                    print ("Detected existing Comet pseudo spectra search results")
-
-                else:
-
-                    # Cleanup
-
-                    filenames = \
-                    ["interact_comet_pseudo_pep-MODELS.html", \
-                    "interact_comet_pseudo_pep.xml", \
-                    "interact_comet_pseudo_pep.xml.index", \
-                    "interact_comet_pseudo_pep.xml.RTcoeff", \
-                    "interact_comet_pseudo_pep.xml.RTstats"]
-
-                    for filename in filenames:
-                        filepath = os.path.join(cwd, filename)
-                        if os.path.isfile(filepath):
-                            os.remove(filepath)
-
-                    existing_pep_xmls = None
-                    if scan and "pseudo_samples_generated_by_comet" in scan:
-                        existing_pep_xmls = scan["pseudo_samples_generated_by_comet"]
-
-                    # Run Comet for speudospectrafiles
-
-                    #decoy_db_file
-
-                    phaseID = analysis_state.createPhase("Pseudospeclib - Matching sequences [Comet]")
-                    workflow.runComet(\
-                        event, \
-                        log_fh, \
-                        analysis_state.getPhaseData(phaseID), \
-                        cwd, \
-                        comet_cfg, \
-                        pseudospectrafiles, \
-                        existing_pep_xmls, \
-                        "interact_comet_pseudo_pep.xml", \
-                        cwd)
-
-                if event.kill_flag:
-                    sys.exit(1)
-
-                libfreemethod_pepXMLs.append("interact_comet_pseudo_pep.xml")            
-
-        if "use_xtandem_flag" in options:
-            xtandem_cfg = "/opt/gladiator/xtandem_settings.xml"
-            if library_files:
-
-                if scan and "xtandem_peptides" in scan and scan["xtandem_peptides"]:
-                    print ("Detected existing X!Tandem spectra search results")
-                else:
-
-                    xtandem_cfg = os.path.join(cwd, "xtandem_settings.xml")
-
-                    cfg_txt = None
-                    with open("/opt/gladiator/xtandem_settings_template.xml", "r") as fh:
-                        cfg_txt = fh.read()
-
-                    param_map = {
-                        "PRECURSOR_MASS_TOLERANCE":"20",
-                        "FRAGMENT_MASS_TOLERANCE": "{:.2f}".format(float("0.02")/2),
-                        #"DATABASE_FASTA_FILE": decoy_db_file
-                    }    
-
-                    for k in param_map:
-                        value = param_map[k]
-                        cfg_txt = cfg_txt.replace(k, value)
-
-                    with open(xtandem_cfg,"w") as fh:
-                        fh.write(cfg_txt)
-
-
-                    # Cleanup
-
-                    filenames = [\
-                    "interact_xtandem_pep-MODELS.html   ", \
-                    "interact_xtandem_pep.xml", \
-                    "interact_xtandem_pep.xml.index", \
-                    "interact_xtandem_pep.xml.RTcoeff   ", \
-                    "interact_xtandem_pep.xml.RTstats   "]
-
-                    for filename in filenames:
-                        filepath = os.path.join(cwd, filename)
-                        if os.path.isfile(filepath):
-                            os.remove(filepath)
-
-                    # Run X!Tandem
-
-                    existing_pep_xmls = None
-                    if scan and "samples_generated_by_xtandem" in scan:
-                        existing_pep_xmls = scan["samples_generated_by_xtandem"]
-
-                    phaseID = analysis_state.createPhase("Speclib - Matching sequences [X!Tandem]")
-                    workflow.runXTandem(\
-                        event, \
-                        log_fh, \
-                        analysis_state.getPhaseData(phaseID), \
-                        cwd, \
-                        xtandem_cfg, \
-                        decoy_db_file, \
-                        library_files, \
-                        existing_pep_xmls, \
-                        "interact_xtandem_pep.xml", \
-                        cwd, \
-                        delete_tmp_files_flag)
-
-                if event.kill_flag:
-                    sys.exit(1)
-
-                libmethod_pepXMLs.append("interact_xtandem_pep.xml")
-
-            if pseudospectrafiles:
-
-                if scan and "xtandem_pseudo_peptides" in scan and scan["xtandem_pseudo_peptides"]:
-                    print ("Detected existing X!Tandem pseudo spectra search results")
-
-                else:
-
-                    # Cleanup
-
-                    filenames = [\
-                    "interact_xtandem_pseudo_pep-MODELS.html", \
-                    "interact_xtandem_pseudo_pep.xml", \
-                    "interact_xtandem_pseudo_pep.xml.index", \
-                    "interact_xtandem_pseudo_pep.xml.RTcoeff", \
-                    "interact_xtandem_pseudo_pep.xml.RTstats"]
-
-                    for filename in filenames:
-                        filepath = os.path.join(cwd, filename)
-                        if os.path.isfile(filepath):
-                            os.remove(filepath)
-
-                    # Run X!Tandem for speudospectrafiles
-
-                    existing_pep_xmls = None
-                    if scan and "pseudo_samples_generated_by_xtandem" in scan:
-                        existing_pep_xmls = scan["pseudo_samples_generated_by_xtandem"]
-
-                    phaseID = analysis_state.createPhase("Pseudospeclib - Matching sequences [X!Tandem]")
-                    workflow.runXTandem(\
-                        event, \
-                        log_fh, \
-                        analysis_state.getPhaseData(phaseID), \
-                        cwd, \
-                        xtandem_cfg, \
-                        decoy_db_file, \
-                        pseudospectrafiles, \
-                        existing_pep_xmls, \
-                        "interact_xtandem_pseudo_pep.xml",
-                        cwd, \
-                        delete_tmp_files_flag)
-
-                if event.kill_flag:
-                    sys.exit(1)
-
-                libfreemethod_pepXMLs.append("interact_xtandem_pseudo_pep.xml")         
-
-        if scan and "speclib_cons" in scan and scan["speclib_cons"]:
-
-            print ("Detected existing Spectrum library.")
-
-        else:
-
-            phaseID = analysis_state.createPhase("Building Library")
-
-            # Cleanup
-
-            filenames = \
-            ["SpecLib_cons_decoy.TraML",\
-            "SpecLib_cons_openswath.tsv",\
-            "SpecLib_cons.pepidx",\
-            "SpecLib_cons.spidx",\
-            "SpecLib_cons.splib",\
-            "SpecLib_cons.sptxt",\
-            "SpecLib_cons.TraML",\
-            "SpecLib_libfree.pepidx",\
-            "SpecLib_libfree.spidx",\
-            "SpecLib_libfree.splib",\
-            "SpecLib_libfree.sptxt",\
-            "SpecLib_lib.pepidx",\
-            "SpecLib_lib.spidx",\
-            "SpecLib_lib.splib",\
-            "SpecLib_lib.sptxt",\
-            "SpecLib_merged.pepidx",\
-            "SpecLib_merged.spidx",\
-            "SpecLib_merged.splib",\
-            "SpecLib_merged.sptxt",\
-            "spectrast.log"]
-
-            for filename in filenames:
-                filepath = os.path.join(cwd, filename)
-                if os.path.isfile(filepath):
-                    os.remove(filepath)
-
-            for method in ["lib", "libfree"]:
-                mayu_folder = method+"_mayu"
-                directory = os.path.join(cwd, mayu_folder)
-                # print ("DEBUG: CHECKING TO REMOVE DIR " + directory)
-                if os.path.isdir(directory):
-                    shutil.rmtree(directory)
-                    # print ("DEBUG: REMOVED " + directory)
-
-            workflow.buildlib(\
-                event,\
-                log_fh,\
-                analysis_state.getPhaseData(phaseID),\
-                cwd, \
-                "DECOY_", \
-                decoy_db_file, \
-                str(max_threads), \
-                libmethod_pepXMLs, \
-                libfreemethod_pepXMLs, \
-                "/opt/gladiator/iRT.txt", \
-                "swath-windows.txt", \
-                pvalue, \
-                pvalue, \
-                swaths_min, \
-                swaths_max)
-
-        if event.kill_flag:
+        logline(log_fh, resources.describe_resources() + ", using " + str(max_threads) + " threads")
+
+        analysis = pipeline.analysis_pipeline(\
+            event, \
+            log_fh, \
+            analysis_state, \
+            cwd, \
+            cfg, \
+            scan, \
+            max_threads, \
+            args.search_workers, \
+            args.openswath_workers, \
+            delete_tmp_files_flag, \
+            artifact_cache, \
+            library_registry, \
+            args.extend_project)
+
+        if not analysis:
             sys.exit(1)
 
-        if scan and "matrices" in scan and scan["matrices"]:
-
-            print ("Detected existing matrices.")
-        
-        else:
-
-            # Cleanup
-
-            postfixes = ["-DIA_cutoffs.txt",\
-            "-DIA_dscores_top_decoy_peaks.txt",\
-            "-DIA_dscores_top_target_peaks.txt",\
-            "-DIA_full_stat.csv",\
-            "-DIA_mayu.csv",\
-            "-DIA_mayu.cutoff",\
-            "-DIA_mayu.fasta",\
-            "-DIA_qvalues.txt",\
-            "-DIA_report.pdf",\
-            "-DIA_scorer.bin",\
-            "-DIA_summary_stat.csv",\
-            "-DIA_svalues.txt",\
-            "-DIA.tsv",\
-            "-DIA_weights.txt",\
-            "-DIA_with_dscore-0_0-None.tr",\
-            "-DIA_with_dscore.csv",\
-            "-DIA_with_dscore_filtered.csv"]
-
-            for filename in sample_files:
-                filepath = os.path.join(cwd, os.path.basename(filename))
-                for postfix in postfixes:
-                    if filepath.endswith(postfix) and os.path.isfile(filepath):
-                        os.remove(filepath)
-
-            filenames = \
-                ["DIA-analysis-result.csv",\
-                "DIA-peptide-matrix.tsv",\
-                "DIA-protein-matrix.tsv"]
-
-            for filename in filenames:
-                filepath = os.path.join(cwd, filename)
-                if os.path.isfile(filepath):
-                    os.remove(filepath)
-
-            # Run OpenSWATH and building the DIA matrices
-            phaseID = analysis_state.createPhase("Searching peptides from DIA spectrum")
-
-            workflow.buildDIAMatrix(\
-                event, \
-                log_fh, \
-                analysis_state.getPhaseData(phaseID), \
-                cwd, \
-                sample_files, \
-                "truncated-swath-windows.txt", \
-                trig_target_pvalue, \
-                trig_max_pvalue, \
-                str(max_threads), \
-                "/opt/gladiator/iRTAssayLibrary.TraML",\
-                None) # TODO: insert design file here
-
-        if event.kill_flag:
+        if not analysis.run():
             sys.exit(1)
 
         with notification_lock:
@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+
+import cache
+
+
+# Registry of spectral libraries built by earlier analyses, shared by all
+# projects. A library is identified by a fingerprint of what it is built
+# from: the pepXML search results, the decoy database, the iRT file, the
+# swath windows and the FDR cutoffs. The pepXML files record the project's
+# paths and the time of the search, those are left out of their hashes so
+# that searches of the same DDA files in another project match.
+#
+#   <library_dir>/<fingerprint>/SpecLib_cons_decoy.TraML
+#   <library_dir>/<fingerprint>/manifest.json
+#   <library_dir>/names/<name>.json
+#
+# A library can be pinned under a name, later analyses can then quantify
+# against it without building a library at all. Pinned libraries are never
+# evicted, of the others the max_libraries most recently used are kept.
+
+DEFAULT_LIBRARY_DIR = "/run-files/.libraries"
+DEFAULT_MAX_LIBRARIES = 20
+
+LIBRARY_FILENAME = "SpecLib_cons_decoy.TraML"
+
+PEPXML_VOLATILE = re.compile(rb' (date|time)="[^"]*"')
+
+
+def hash_pepxml(filepath, cwd):
+    sha = hashlib.sha256()
+    project_path = os.path.abspath(cwd).encode()
+    with open(filepath, "rb") as fh:
+        for line in fh:
+            line = line.replace(project_path, b"")
+            line = PEPXML_VOLATILE.sub(b"", line)
+            sha.update(line)
+    return sha.hexdigest()
+
+
+def valid_name(name):
+    return re.match(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$", name) is not None
+
+
+class LibraryRegistry:
+
+    def __init__(self, library_dir=DEFAULT_LIBRARY_DIR, max_libraries=DEFAULT_MAX_LIBRARIES, artifact_cache=None):
+        self.library_dir = library_dir
+        self.max_libraries = max_libraries
+        self.artifact_cache = artifact_cache
+        os.makedirs(os.path.join(library_dir, "names"), exist_ok=True)
+        os.makedirs(os.path.join(library_dir, "tmp"), exist_ok=True)
+
+    def content_hash(self, filepath):
+        if self.artifact_cache:
+            return self.artifact_cache.content_hash(filepath)
+        return cache.hash_file(filepath)
+
+    def fingerprint(self, cwd, pepXMLs, decoy_db_filename, iRT_filename, swaths_filename, fdr):
+
+        # pepXMLs are given in the order the library is built from them
+
+        return cache.hash_data({
+            "pepXMLs": [hash_pepxml(os.path.join(cwd, x), cwd) for x in pepXMLs],
+            "decoy_db": self.content_hash(os.path.join(cwd, decoy_db_filename)),
+            "iRT": self.content_hash(os.path.join(cwd, iRT_filename)),
+            "swaths": self.content_hash(os.path.join(cwd, swaths_filename)),
+            "fdr": fdr,
+        })
+
+    def entry(self, fingerprint):
+        return os.path.join(self.library_dir, fingerprint)
+
+    def manifest(self, fingerprint):
+        try:
+            with open(os.path.join(self.entry(fingerprint), "manifest.json"), "r") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self, fingerprint):
+
+        # Path of the registered library, None if there is none
+
+        filepath = os.path.join(self.entry(fingerprint), LIBRARY_FILENAME)
+        if not self.manifest(fingerprint) or not os.path.isfile(filepath):
+            return None
+        os.utime(os.path.join(self.entry(fingerprint), "manifest.json"), None)
+        return filepath
+
+    def link(self, fingerprint, cwd):
+
+        # Copies (reflinks) the registered library into cwd with the current
+        # time. Returns False if there is none. A hardlink would share its
+        # mtime with the registry and the projects linked before, whose
+        # checkpoints and tasks would then see a changed library.
+
+        src = self.lookup(fingerprint)
+        if not src:
+            return False
+        dst = os.path.join(cwd, LIBRARY_FILENAME)
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return True
+        if os.path.lexists(dst):
+            os.remove(dst)
+        cache.clone_file(src, dst, link=False)
+        now = time.time()
+        os.utime(dst, (now, now))
+        return True
+
+    def register(self, fingerprint, cwd, project, swaths_filename):
+
+        if self.lookup(fingerprint):
+            return
+
+        tmp_entry = os.path.join(self.library_dir, "tmp", fingerprint + "-" + uuid.uuid4().hex)
+        os.makedirs(tmp_entry)
+        try:
+            cache.clone_file(os.path.join(cwd, LIBRARY_FILENAME), os.path.join(tmp_entry, LIBRARY_FILENAME))
+            with open(os.path.join(tmp_entry, "manifest.json"), "w") as fh:
+                json.dump({
+                    "fingerprint": fingerprint,
+                    "project": project,
+                    "created": time.time(),
+                    "swaths": self.content_hash(os.path.join(cwd, swaths_filename)),
+                }, fh, indent=1)
+
+            if not os.path.isdir(self.entry(fingerprint)):
+                os.rename(tmp_entry, self.entry(fingerprint))
+        finally:
+            if os.path.isdir(tmp_entry):
+                shutil.rmtree(tmp_entry)
+
+        self.evict()
+
+    def pin(self, name, fingerprint):
+        if not valid_name(name):
+            raise ValueError("Invalid library name " + name)
+        filename = os.path.join(self.library_dir, "names", name + ".json")
+        tmp_filename = filename + "." + uuid.uuid4().hex
+        with open(tmp_filename, "w") as fh:
+            json.dump({"name": name, "fingerprint": fingerprint, "pinned": time.time()}, fh)
+        os.rename(tmp_filename, filename)
+
+    def resolve(self, name):
+
+        # Fingerprint of a pinned library, None if there is no such name
+
+        if not valid_name(name):
+            return None
+        try:
+            with open(os.path.join(self.library_dir, "names", name + ".json"), "r") as fh:
+                return json.load(fh)["fingerprint"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def names(self):
+        result = {}
+        for filename in sorted(os.listdir(os.path.join(self.library_dir, "names"))):
+            if filename.endswith(".json"):
+                name = filename[:-len(".json")]
+                fingerprint = self.resolve(name)
+                if fingerprint:
+                    result[name] = self.manifest(fingerprint)
+        return result
+
+    def evict(self):
+
+        pinned = set(self.resolve(x) for x in self.names())
+
+        unpinned = []
+        for fingerprint in os.listdir(self.library_dir):
+            if fingerprint in ["names", "tmp"] or fingerprint in pinned:
+                continue
+            manifest_filename = os.path.join(self.entry(fingerprint), "manifest.json")
+            if os.path.isfile(manifest_filename):
+                unpinned.append((os.path.getmtime(manifest_filename), fingerprint))
+
+        for last_use, fingerprint in sorted(unpinned, reverse=True)[self.max_libraries:]:
+            shutil.rmtree(self.entry(fingerprint), ignore_errors=True)
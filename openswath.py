@@ -0,0 +1,140 @@
+import os
+import uuid
+
+import pandas as pd
+
+import tables
+
+
+# Streaming access to the aligned OpenSwath results (DIA-analysis-result.csv)
+# which grow to tens of GB for large cohorts. The file is read in chunks of
+# CHUNK_ROWS rows and only the needed columns, so memory use is bounded by
+# the chunk size and not by the size of the file. The Parquet copy of the
+# file (see tables.py) is read instead if there is one.
+
+CHUNK_ROWS = 500000
+
+# Columns used by swaths2stats.R (SWATH2stats reduce_OpenSWATH_output, the
+# matrices and PECA). Keep in sync with the list in swaths2stats.R.
+SWATHS2STATS_COLUMNS = [
+    "transition_group_id",
+    "decoy",
+    "ProteinName",
+    "FullPeptideName",
+    "Sequence",
+    "Charge",
+    "m/z",
+    "aggr_Fragment_Annotation",
+    "aggr_Peak_Area",
+    "filename",
+    "m_score",
+    "peak_group_rank",
+    "Intensity",
+    "RT",
+    "align_runid",
+    "align_origfilename",
+]
+
+
+def read_header(filename):
+    return pd.read_csv(filename, sep="\t", nrows=0).columns.tolist()
+
+
+def estimate_chunks(filename, chunksize=CHUNK_ROWS):
+
+    # Number of chunks the file is read in, estimated from the length of
+    # its first lines (counted in its copy if there is one)
+
+    if tables.has_copy(filename):
+        n_rows = tables.pyarrow.parquet.ParquetFile(tables.copy_filename(filename)).metadata.num_rows
+        return max(1, int(n_rows / chunksize) + 1)
+
+    size = os.path.getsize(filename)
+    n_bytes = 0
+    n_lines = 0
+    with open(filename, "rb") as fh:
+        fh.readline()
+        for line in fh:
+            n_bytes += len(line)
+            n_lines += 1
+            if n_lines >= 1000:
+                break
+
+    if not n_lines:
+        return 1
+    return max(1, int(size / (n_bytes / n_lines) / chunksize) + 1)
+
+
+def is_target(chunk):
+
+    # Rows of targets: not decoys, iRT peptides or DECOY_ proteins
+
+    mask = pd.Series(True, index=chunk.index)
+    if "decoy" in chunk.columns:
+        mask &= pd.to_numeric(chunk["decoy"], errors="coerce") == 0
+    if "ProteinName" in chunk.columns:
+        mask &= ~chunk["ProteinName"].str.contains("iRT", regex=False, na=False)
+        mask &= ~chunk["ProteinName"].str.contains("DECOY_", regex=False, na=False)
+    return mask
+
+
+def iter_targets(filename, columns, dtype=None, text=False, chunksize=CHUNK_ROWS):
+
+    # Yields the target rows of the file chunk by chunk, with those of the
+    # given columns the file has. With text the values are kept as written
+    # in the file (as strings, empty and NA included), from the text file.
+
+    if text:
+        header = read_header(filename)
+    else:
+        header = tables.read_header(filename)
+    usecols = [x for x in columns if x in header]
+    if "decoy" in header and "decoy" not in usecols:
+        usecols.append("decoy")
+
+    if not text and tables.has_copy(filename):
+        reader = tables.iter_batches(filename, usecols, dtype, chunksize)
+    elif text:
+        reader = pd.read_csv(filename, sep="\t", usecols=usecols, dtype=str, \
+            keep_default_na=False, chunksize=chunksize)
+    else:
+        if dtype:
+            dtype = dict((k, v) for k, v in dtype.items() if k in usecols)
+        reader = pd.read_csv(filename, sep="\t", usecols=usecols, dtype=dtype, chunksize=chunksize)
+
+    for chunk in reader:
+        chunk = chunk[is_target(chunk)]
+        yield chunk[[x for x in columns if x in chunk.columns]]
+
+
+def reduce_output(event, in_filename, out_filename, columns=SWATHS2STATS_COLUMNS, progress=None):
+
+    # Writes the target rows and the given columns of in_filename to
+    # out_filename, values as they are. Returns True when done, None if
+    # cancelled.
+
+    n_steps = estimate_chunks(in_filename)
+    tmp_filename = out_filename + "." + uuid.uuid4().hex
+
+    try:
+        header = True
+        for step, chunk in enumerate(iter_targets(in_filename, columns, text=True)):
+            chunk.to_csv(tmp_filename, sep="\t", index=False, header=header, mode="w" if header else "a")
+            header = False
+
+            if progress:
+                progress.update_n_of_m(min(step + 1, n_steps), n_steps)
+            if event and event.kill_flag:
+                return None
+
+        if header:
+            pd.DataFrame(columns=[x for x in columns if x in read_header(in_filename)]) \
+                .to_csv(tmp_filename, sep="\t", index=False)
+
+        os.rename(tmp_filename, out_filename)
+
+    finally:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+    return True
@@ -0,0 +1,907 @@
+import os
+import json
+import shutil
+import threading
+
+import resources
+import workflow
+from progress import Progress
+
+
+# Task graph engine shared by the command line driver and the web UI.
+#
+# Every task declares the tasks it depends on, the files it reads and
+# writes (relative to the project folder unless absolute) and how many
+# threads it can use (None: as many as the budget allows). Tasks whose
+# dependencies are complete are started in their own threads, the free
+# part of the thread budget being split between tasks that become ready at
+# the same time. A task is skipped when all of its outputs exist, none of
+# its inputs is newer than its outputs and none of its dependencies was
+# rerun. Tasks without outputs always run. An optional check(filepath)
+# can reject outputs that exist but are incomplete.
+#
+# A task function is called as func(progressData, threads). Tasks with a
+# phase name get their own entry in the analysis State. The thread budget
+# may be given as a function, in which case it is read again whenever
+# tasks are started (the web UI changes an analysis' share as other
+# analyses start and finish).
+#
+# With an artifact cache (see cache.py) a task that is not up to date is
+# first looked up by a key made of its name, params, the versions of its
+# tools (and of workflow.py) and its inputs, and its outputs are restored
+# from the cache instead of running it. Outputs of tasks that ran are added
+# to the cache. Tasks whose outputs record the project's paths are marked
+# portable=False, which keys them by project folder. Outputs added to the
+# cache are hardlinks to it, so they are removed before their task runs
+# again.
+#
+# The params and the list of inputs of every completed task are recorded in
+# task-params.json in the project. A task whose recorded params differ from
+# the current ones is rerun, and with it only the tasks depending on it
+# (e.g. a new feature alignment FDR reruns the matrices but not the
+# searches). Tasks without a record, from projects analysed before, are
+# judged by their files only.
+#
+# Tasks that resume partial work of an interrupted run (e.g. the searches
+# skip spectrum files already searched) give an on_change() which is called
+# before the task runs again because its inputs, params or dependencies
+# changed, so that results made with the old ones are not reused. It is not
+# called when the outputs are only missing.
+#
+# An optional force() makes a task count as changed when its files and
+# records can not tell (e.g. samples added to a project analysed before
+# there were records, with their original mtimes).
+
+class Task:
+
+    def __init__(self, name, func, deps=None, inputs=None, outputs=None, threads=None, phase=None, check=None, \
+                 params=None, tools=None, portable=True, cached=True, on_change=None, force=None):
+        self.name = name
+        self.func = func
+        self.deps = deps or []
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.threads = threads
+        self.phase = phase
+        self.check = check
+        self.params = params
+        self.tools = tools or []
+        self.portable = portable
+        self.cached = cached
+        self.on_change = on_change
+        self.force = force
+
+
+class Pipeline:
+
+    def __init__(self, event, log_fh, analysis_state, cwd, threads, cache=None):
+        self.event = event
+        self.log_fh = log_fh
+        self.analysis_state = analysis_state
+        self.cwd = cwd
+        self.threads = threads
+        self.cache = cache
+        self.tasks = {}
+        self.cond = threading.Condition()
+        self.params_filename = os.path.join(cwd, "task-params.json")
+        self.recorded = {}
+
+    def add(self, task):
+        if task.name in self.tasks:
+            raise ValueError("Duplicate task " + task.name)
+        for dep in task.deps:
+            if dep not in self.tasks:
+                raise ValueError("Task " + task.name + " depends on unknown task " + dep)
+        self.tasks[task.name] = task
+        return task.name
+
+    def path(self, filename):
+        return os.path.join(self.cwd, filename)
+
+    def relative_outputs(self, task):
+
+        # Outputs as paths relative to the project folder, None if the task
+        # has no outputs or writes outside of the folder
+
+        if not task.outputs:
+            return None
+        outputs = []
+        for filename in task.outputs:
+            relpath = os.path.relpath(self.path(filename), self.cwd)
+            if relpath.startswith(os.pardir):
+                return None
+            outputs.append(relpath)
+        return outputs
+
+    def cache_key(self, task, keys):
+
+        if not self.cache or not task.cached or not self.relative_outputs(task):
+            return None
+
+        producers = {}
+        for name in keys:
+            for filename in self.tasks[name].outputs:
+                producers[os.path.normpath(self.path(filename))] = keys[name]
+
+        inputs = []
+        for filename in task.inputs:
+            filepath = os.path.normpath(self.path(filename))
+            relpath = os.path.relpath(filepath, self.cwd)
+            if relpath.startswith(os.pardir):
+                relpath = os.path.basename(filepath)
+            if filepath in producers:
+                inputs.append((relpath, "task:" + producers[filepath]))
+            elif os.path.isfile(filepath):
+                inputs.append((relpath, self.cache.fingerprint(filepath)))
+            else:
+                inputs.append((relpath, None))
+
+        params = task.params
+        if callable(params):
+            params = params()
+        if not task.portable:
+            params = {"params": params, "cwd": self.cwd}
+
+        return self.cache.make_key(task.name, params, task.tools + [workflow.__file__], inputs)
+
+    def restore(self, task, key):
+        try:
+            return self.cache.restore(key, self.cwd, self.relative_outputs(task))
+        except OSError as e:
+            workflow.logline(self.log_fh, "Restoring task " + task.name + " from cache failed: " + str(e))
+            return False
+
+    def signature(self, task):
+        params = task.params
+        if callable(params):
+            params = params()
+        signature = {
+            "params": params,
+            "inputs": [os.path.normpath(self.path(x)) for x in task.inputs],
+        }
+        # As it reads back from the file
+        return json.loads(json.dumps(signature))
+
+    def load_recorded(self):
+        self.recorded = {}
+        if os.path.isfile(self.params_filename):
+            try:
+                with open(self.params_filename, "r") as fh:
+                    self.recorded = json.load(fh)
+            except ValueError:
+                self.recorded = {}
+
+    def record(self, task):
+
+        # Called with self.cond held
+
+        if not task.outputs:
+            return
+        self.recorded[task.name] = self.signature(task)
+        workflow.write_if_changed(self.params_filename, json.dumps(self.recorded, indent=1, sort_keys=True))
+
+    def params_changed(self, task):
+        if task.name not in self.recorded:
+            return False
+
+        recorded = self.recorded[task.name]
+        current = self.signature(task)
+
+        # Recorded before the task had params, judged by its files
+        if recorded["params"] is None:
+            recorded = dict(recorded, params=current["params"])
+
+        if recorded == current:
+            return False
+
+        changed = []
+        if recorded["inputs"] != current["inputs"]:
+            changed.append("inputs")
+        if isinstance(recorded["params"], dict) and isinstance(current["params"], dict):
+            for name in sorted(set(recorded["params"]) | set(current["params"])):
+                if recorded["params"].get(name) != current["params"].get(name):
+                    changed.append(name)
+        elif recorded["params"] != current["params"]:
+            changed.append("params")
+
+        workflow.logline(self.log_fh, "Task " + task.name + " changed: " + ", ".join(changed))
+        return True
+
+    def complete(self, task):
+
+        if not task.outputs:
+            return False
+
+        for filename in task.outputs:
+            filepath = self.path(filename)
+            if not os.path.exists(filepath):
+                return False
+            if task.check and not task.check(filepath):
+                return False
+
+        return True
+
+    def changed(self, task, ran):
+
+        # Whether a dependency ran, an input is newer than the outputs or
+        # the params changed since the task last completed
+
+        if task.force and task.force():
+            return True
+
+        for dep in task.deps:
+            if dep in ran and self.tasks[dep].outputs:
+                return True
+
+        output_mtimes = [os.path.getmtime(self.path(x)) for x in task.outputs if os.path.exists(self.path(x))]
+        if output_mtimes:
+            for filename in task.inputs:
+                filepath = self.path(filename)
+                if os.path.exists(filepath) and os.path.getmtime(filepath) > min(output_mtimes):
+                    return True
+
+        return self.params_changed(task)
+
+    def budget(self):
+        threads = self.threads
+        if callable(threads):
+            threads = threads()
+        return max(1, int(threads))
+
+    def allocate(self, names, free):
+
+        # Splits the free threads between the ready tasks, smallest
+        # requests first so that their leftovers go to the others.
+
+        budget = self.budget()
+
+        def request(name):
+            threads = self.tasks[name].threads
+            if not threads:
+                return budget
+            return min(int(threads), budget)
+
+        grants = {}
+        ordered = sorted(names, key=request)
+        for i, name in enumerate(ordered):
+            if free <= 0:
+                break
+            share = max(1, free // (len(ordered) - i))
+            grants[name] = min(request(name), share)
+            free -= grants[name]
+
+        return [(name, grants[name]) for name in names if name in grants]
+
+    def unlink_shared_outputs(self, task):
+
+        # Outputs added to the cache are hardlinks to it, they are removed
+        # before the task writes them again in place
+
+        for filename in task.outputs:
+            filepath = self.path(filename)
+            if os.path.isfile(filepath) and os.stat(filepath).st_nlink > 1:
+                os.remove(filepath)
+
+    def run_task(self, task, progressData, threads, state):
+        try:
+            if self.cache:
+                self.unlink_shared_outputs(task)
+            with self.cond:
+                changed = task.name in state["changed"]
+            if task.on_change and changed:
+                task.on_change()
+            task.func(progressData, threads)
+        except BaseException as e:
+            with self.cond:
+                state["errors"].append(e)
+            self.event.kill()
+        else:
+            key = state["keys"].get(task.name)
+            if key and not self.event.kill_flag:
+                try:
+                    self.cache.store(key, self.cwd, self.relative_outputs(task), task.name)
+                except OSError as e:
+                    workflow.logline(self.log_fh, "Adding task " + task.name + " to cache failed: " + str(e))
+
+        with self.cond:
+            del state["running"][task.name]
+            state["used"] -= threads
+            state["done"].add(task.name)
+            state["ran"].add(task.name)
+            if not state["errors"] and not self.event.kill_flag:
+                self.record(task)
+            self.cond.notify_all()
+
+    def run(self):
+
+        # Returns True when every task has completed, False if the analysis
+        # was cancelled. An exception raised by a task cancels the other
+        # tasks and is re-raised here.
+
+        state = {
+            "pending": list(self.tasks),
+            "running": {},
+            "done": set(),
+            "ran": set(),
+            "used": 0,
+            "errors": [],
+            "keys": {},
+            "changed": set(),
+        }
+
+        self.load_recorded()
+
+        with self.cond:
+
+            while state["pending"] or state["running"]:
+
+                if state["errors"] or self.event.kill_flag:
+                    if not state["running"]:
+                        break
+                    self.cond.wait()
+                    continue
+
+                ready = [name for name in state["pending"] \
+                    if all(dep in state["done"] for dep in self.tasks[name].deps)]
+
+                skipped = False
+                for name in ready:
+                    task = self.tasks[name]
+                    key = state["keys"].get(name) or self.cache_key(task, state["keys"])
+                    if key:
+                        state["keys"][name] = key
+                    if self.changed(task, state["ran"]):
+                        state["changed"].add(name)
+                    else:
+                        state["changed"].discard(name)
+                    if self.complete(task) and name not in state["changed"]:
+                        workflow.logline(self.log_fh, "Task " + name + " is up to date, skipping.")
+                        if name not in self.recorded:
+                            self.record(task)
+                        state["pending"].remove(name)
+                        state["done"].add(name)
+                        skipped = True
+                    elif key and self.restore(task, key):
+                        workflow.logline(self.log_fh, "Task " + name + " restored from cache.")
+                        self.record(task)
+                        state["pending"].remove(name)
+                        state["done"].add(name)
+                        state["ran"].add(name)
+                        skipped = True
+
+                if skipped:
+                    continue
+
+                for name, threads in self.allocate(ready, self.budget() - state["used"]):
+                    task = self.tasks[name]
+                    progressData = None
+                    if task.phase:
+                        phaseID = self.analysis_state.createPhase(task.phase)
+                        progressData = self.analysis_state.getPhaseData(phaseID)
+
+                    state["pending"].remove(name)
+                    state["used"] += threads
+                    worker = threading.Thread(target=self.run_task, args=(task, progressData, threads, state))
+                    state["running"][name] = worker
+                    worker.start()
+
+                self.cond.wait()
+
+        if state["errors"]:
+            raise state["errors"][0]
+
+        return not self.event.kill_flag
+
+
+def analysis_pipeline(\
+    event, \
+    log_fh, \
+    analysis_state, \
+    cwd, \
+    cfg, \
+    scan, \
+    threads, \
+    search_workers, \
+    openswath_workers, \
+    delete_tmp_files_flag, \
+    cache=None, \
+    library_registry=None, \
+    extend_project=False):
+
+    # Builds the task graph of a glaDIAtor analysis from its configuration.
+    # Returns None if the input files can not be used. With extend_project
+    # the samples are quantified against the project's existing library,
+    # reusing the results of samples that have already been scored.
+
+    sample_files = cfg["files"]["samples"]
+    library_files = cfg["files"]["library"]
+    database_files = cfg["files"]["database"]
+    pvalue = cfg["pvalue"]
+    options = cfg["options"]
+
+    if not scan:
+        scan = {}
+
+    def basename(filename):
+        return os.path.splitext(os.path.basename(filename))[0]
+
+    sample_extension = workflow.input_extension(sample_files)
+    if not sample_extension:
+        return None
+
+    use_library = library_files and "dda_library" in options
+
+    # Quantifying against a pinned library skips the library build and
+    # everything leading to it
+
+    pinned_library = None
+    if cfg.get("use_library"):
+        if library_registry:
+            pinned_library = library_registry.resolve(cfg["use_library"])
+        if not pinned_library:
+            workflow.logline(log_fh, "Spectral library " + cfg["use_library"] + " not found.")
+            return None
+        use_library = False
+
+    library_extension = None
+    if use_library:
+        library_extension = workflow.input_extension(library_files)
+        if not library_extension:
+            return None
+
+    pipeline = Pipeline(event, log_fh, analysis_state, cwd, threads, cache)
+    results = {}
+
+    # Convert RAW data to open formats
+
+    converter = workflow.find_raw_converter()
+    converter_deps = []
+    converter_tools = ["/opt/tpp/bin/msconvert", "/opt/ThermoRawFileParser/ThermoRawFileParser.exe"]
+
+    if ".raw" in [sample_extension, library_extension] and not converter:
+
+        def install_converter(progressData, threads):
+            workflow.install_ThermoRawFileParser(event, log_fh, progressData)
+
+        converter = "thermorawparser"
+        converter_deps.append(pipeline.add(Task(\
+            "install_converter", \
+            install_converter, \
+            threads=1, \
+            phase="Installing ThermoRawFileParser")))
+
+    def convert_raw(progressData, filenames, peak_picking, folder, workers):
+        converter = workflow.find_raw_converter()
+        if converter == "msconvert":
+            if folder == "DDA":
+                workflow.convertRAWqtofpeakpicker(event, log_fh, progressData, cwd, filenames, folder, workers)
+            else:
+                workflow.convertRAW(event, log_fh, progressData, cwd, filenames, peak_picking, "mzml", folder, workers)
+        elif converter == "thermorawparser":
+            workflow.convertRAW_ThermoRawFileParser(event, log_fh, progressData, cwd, filenames, peak_picking, "mzml", folder, workers)
+        else:
+            print ("Error: No, RAW file converter available")
+            event.kill()
+
+    dia_files = sample_files
+    dia_deps = []
+
+    if sample_extension == ".raw":
+
+        dia_files = [os.path.join(cwd, "DIA", basename(x) + ".mzML") for x in sample_files]
+
+        def convert_dia(progressData, threads):
+            convert_raw(progressData, sample_files, "dia_peak_picking" in options, "DIA", threads)
+
+        dia_deps.append(pipeline.add(Task(\
+            "conv_DIA", \
+            convert_dia, \
+            deps=converter_deps, \
+            inputs=sample_files, \
+            outputs=dia_files, \
+            threads=min(len(sample_files), resources.io_workers(sample_files)), \
+            phase="Converting RAW DIA files", \
+            check=workflow.is_complete_spectrum_file, \
+            params=lambda: {"converter": workflow.find_raw_converter(), "peak_picking": "dia_peak_picking" in options}, \
+            tools=converter_tools)))
+
+    dda_files = []
+    dda_deps = []
+
+    if use_library:
+
+        dda_files = library_files
+
+        if library_extension == ".raw":
+
+            dda_extension = ".mzML"
+            if converter == "msconvert":
+                dda_extension = ".mzXML"
+            dda_files = [os.path.join(cwd, "DDA", basename(x) + dda_extension) for x in library_files]
+
+            def convert_dda(progressData, threads):
+                convert_raw(progressData, library_files, True, "DDA", threads)
+
+            dda_deps.append(pipeline.add(Task(\
+                "conv_DDA", \
+                convert_dda, \
+                deps=converter_deps, \
+                inputs=library_files, \
+                outputs=dda_files, \
+                threads=min(len(library_files), resources.io_workers(library_files)), \
+                phase="Converting RAW DDA files (+picking peaks)", \
+                check=workflow.is_complete_spectrum_file, \
+                params=lambda: {"converter": workflow.find_raw_converter()}, \
+                tools=converter_tools + ["qtofpeakpicker.exe"])))
+
+    # Swath windows are read from every sample, OpenSWATH needs them to be
+    # the same. The window files are written from the first sample, the
+    # results are needed by the library build.
+
+    def swath_windows(progressData, threads):
+        progress = Progress(progressData, "percentage-indicator")
+
+        windows = workflow.read_all_swath_windows(event, cwd, dia_files, threads)
+        if windows is None:
+            return
+
+        mismatching = workflow.mismatching_swath_windows(dia_files, windows)
+        if mismatching:
+            workflow.logline(log_fh, "Swath windows differ from " + dia_files[0] + ": " + ", ".join(mismatching))
+            progress.fail({"swath_windows_differ": mismatching})
+            event.kill()
+            return
+
+        swaths, tswaths = workflow.create_swath_window_files(cwd, dia_files[0], windows[dia_files[0]])
+        results["swaths_min"] = swaths[0][0]
+        results["swaths_max"] = swaths[-1][1]
+        progress.ready()
+
+    swath_task = pipeline.add(Task(\
+        "swath_windows", \
+        swath_windows, \
+        deps=dia_deps, \
+        threads=min(len(dia_files), resources.io_workers(dia_files)), \
+        phase="Reading swath windows"))
+
+    # OpenSWATH and the DIA matrices run against the library built below
+    # or a pinned one
+
+    def add_matrices(speclib_task, force=None):
+
+        def matrices(progressData, threads):
+
+            workflow.remove_files(cwd, \
+                ["DIA-analysis-result.csv", \
+                "DIA-peptide-matrix.tsv", \
+                "DIA-protein-matrix.tsv"])
+
+            workers = openswath_workers
+            if not workers:
+                workers = workflow.choose_openswath_workers(threads, dia_files)
+
+            workflow.buildDIAMatrix(\
+                event, \
+                log_fh, \
+                progressData, \
+                cwd, \
+                dia_files, \
+                "truncated-swath-windows.txt", \
+                cfg["trig_target_pvalue"], \
+                cfg["trig_max_pvalue"], \
+                str(threads), \
+                "/opt/gladiator/iRTAssayLibrary.TraML", \
+                None, \
+                workers, \
+                extend_project) # TODO: insert design file here
+
+        return pipeline.add(Task(\
+            "matrices", \
+            matrices, \
+            deps=[speclib_task, swath_task] + dia_deps, \
+            inputs=["SpecLib_cons_decoy.TraML"] + dia_files, \
+            outputs=["DIA-analysis-result.csv", "DIA-peptide-matrix.tsv", "DIA-protein-matrix.tsv"], \
+            phase="Searching peptides from DIA spectrum", \
+            params={"trig_target_pvalue": cfg["trig_target_pvalue"], "trig_max_pvalue": cfg["trig_max_pvalue"]}, \
+            tools=["OpenSwathWorkflow", "pyprophet", "feature_alignment.py", "/opt/gladiator/swaths2stats.R", \
+                "/opt/gladiator/iRTAssayLibrary.TraML"], \
+            portable=False, \
+            force=force)) # the results name the DIA files
+
+    if pinned_library:
+
+        def link_library(progressData, threads):
+            progress = Progress(progressData, "percentage-indicator")
+            workflow.logline(log_fh, "Using spectral library " + cfg["use_library"] + " (" + pinned_library + ")")
+            if not library_registry.link(pinned_library, cwd):
+                workflow.logline(log_fh, "Spectral library " + cfg["use_library"] + " has been removed.")
+                progress.fail({"library": cfg["use_library"]})
+                event.kill()
+                return
+            manifest = library_registry.manifest(pinned_library)
+            if manifest["swaths"] != library_registry.content_hash(os.path.join(cwd, "swath-windows.txt")):
+                workflow.logline(log_fh, "Warning: the swath windows of the library differ from the samples'.")
+            progress.ready()
+
+        add_matrices(pipeline.add(Task(\
+            "speclib", \
+            link_library, \
+            deps=[swath_task], \
+            threads=1, \
+            phase="Linking Library")))
+
+        return pipeline
+
+    if extend_project:
+
+        if not os.path.isfile(os.path.join(cwd, "SpecLib_cons_decoy.TraML")):
+            workflow.logline(log_fh, "The project has no spectral library to extend.")
+            return None
+
+        # The added samples may keep their original mtimes (cp -p, rsync
+        # -a), and projects analysed before there were task records have
+        # none to compare the list of samples with
+
+        def new_samples():
+            if "matrices" not in pipeline.recorded:
+                return True
+            unscored = [x for x in dia_files if not workflow.is_extended_sample(cwd, x)]
+            if unscored:
+                workflow.logline(log_fh, "Samples added to the project: " + ", ".join(unscored))
+            return len(unscored) > 0
+
+        add_matrices(swath_task, new_samples)
+
+        return pipeline
+
+    # Build pseudospectra when no DDA library is available
+
+    pseudospectrafiles = []
+    pseudo_deps = []
+
+    if not use_library:
+
+        pseudospectrafiles = [os.path.join("libfree-pseudospectra", basename(x) + "_" + stage + ".mzXML") \
+            for x in sample_files for stage in ["Q1", "Q2", "Q3"]]
+
+        def pseudospectra(progressData, threads):
+            workflow.runDiaumpire(event, log_fh, progressData, cwd, dia_files, "libfree", threads)
+
+        pseudo_deps.append(pipeline.add(Task(\
+            "pseudospectra", \
+            pseudospectra, \
+            deps=dia_deps, \
+            inputs=dia_files, \
+            outputs=pseudospectrafiles, \
+            phase="Building pseudospectra", \
+            tools=["/opt/dia-umpire/DIA_Umpire_SE.jar", "/opt/gladiator/diaumpire-params-template.txt", "/opt/tpp/bin/msconvert"])))
+
+    # Build sequence database
+
+    db_filename = "DB.fasta"
+    decoy_db_file = "DB_with_decoys.fasta"
+
+    def build_database(progressData, threads):
+        workflow.build_database(event, log_fh, progressData, cwd, database_files, db_filename, decoy_db_file, cache)
+
+    # build_database keys the databases by the content of the FASTA files
+    # itself, the task is not cached by its inputs' size and mtime
+
+    database_task = pipeline.add(Task(\
+        "DB", \
+        build_database, \
+        inputs=database_files, \
+        outputs=[db_filename, decoy_db_file], \
+        threads=1, \
+        phase="Building database", \
+        cached=False))
+
+    # Search engine settings are only rewritten when they change
+
+    precursor_tolerance = "{:.2f}".format(float(cfg.get("precursor_tolerance", "20")))
+    fragment_tolerance = str(cfg.get("fragment_tolerance", "0.01"))
+
+    settings = {}
+    for engine in ["comet", "xtandem"]:
+        if "use_" + engine + "_flag" in options:
+            settings[engine] = os.path.join(cwd, engine + "_settings.xml")
+
+            with open("/opt/gladiator/" + engine + "_settings_template.xml", "r") as fh:
+                cfg_txt = fh.read()
+
+            cfg_txt = cfg_txt.replace("PRECURSOR_MASS_TOLERANCE", precursor_tolerance)
+            cfg_txt = cfg_txt.replace("FRAGMENT_MASS_TOLERANCE", fragment_tolerance)
+            cfg_txt = cfg_txt.replace("DATABASE_FASTA_FILE", decoy_db_file)
+
+            workflow.write_if_changed(settings[engine], cfg_txt)
+
+    # Library and pseudospectra searches of both engines are independent
+
+    search_tasks = []
+    libmethod_pepXMLs = []
+    libfreemethod_pepXMLs = []
+
+    def add_search(engine, label, spectra_files, pseudo, deps):
+
+        output_base = "interact_" + engine + "_pep"
+        existing_key = "samples_generated_by_" + engine
+        phase = "Speclib - Matching sequences [" + label + "]"
+        if pseudo:
+            output_base = "interact_" + engine + "_pseudo_pep"
+            existing_key = "pseudo_samples_generated_by_" + engine
+            phase = "Pseudospeclib - Matching sequences [" + label + "]"
+        output = output_base + ".xml"
+
+        tools = ["/opt/comet/comet-ms", "/opt/tpp/bin/xinteract"]
+        if engine == "xtandem":
+            tools = ["/opt/tandem/tandem", "/opt/tpp/bin/Tandem2XML", "/opt/tpp/bin/xinteract"]
+
+        # Spectrum files searched by an interrupted run are not searched
+        # again, unless the search is rerun because something changed
+        resume = {"existing": scan.get(existing_key)}
+
+        def on_change():
+            resume["existing"] = None
+
+        def search(progressData, threads):
+
+            workflow.remove_files(cwd, [output_base + x for x in \
+                ["-MODELS.html", ".xml", ".xml.index", ".xml.RTcoeff", ".xml.RTstats"]])
+
+            if engine == "comet":
+                workflow.runComet(\
+                    event, \
+                    log_fh, \
+                    progressData, \
+                    cwd, \
+                    settings[engine], \
+                    spectra_files, \
+                    resume["existing"], \
+                    output, \
+                    cwd, \
+                    threads, \
+                    search_workers)
+            else:
+                workflow.runXTandem(\
+                    event, \
+                    log_fh, \
+                    progressData, \
+                    cwd, \
+                    settings[engine], \
+                    decoy_db_file, \
+                    spectra_files, \
+                    resume["existing"], \
+                    output, \
+                    cwd, \
+                    delete_tmp_files_flag, \
+                    threads, \
+                    search_workers)
+
+        search_tasks.append(pipeline.add(Task(\
+            output_base, \
+            search, \
+            deps=[database_task] + deps, \
+            inputs=[settings[engine], decoy_db_file] + spectra_files, \
+            outputs=[output], \
+            phase=phase, \
+            params={
+                "precursor_tolerance": precursor_tolerance,
+                "fragment_tolerance": fragment_tolerance,
+                "engines": sorted(settings),
+            }, \
+            tools=tools, \
+            portable=False, # pepXML records the spectrum file paths
+            on_change=on_change)))
+
+        if pseudo:
+            libfreemethod_pepXMLs.append(output)
+        else:
+            libmethod_pepXMLs.append(output)
+
+    for engine, label in [("comet", "Comet"), ("xtandem", "X!Tandem")]:
+        if engine in settings:
+            if use_library:
+                add_search(engine, label, dda_files, False, dda_deps)
+            else:
+                add_search(engine, label, pseudospectrafiles, True, pseudo_deps)
+
+    # Build spectral library
+
+    def speclib(progressData, threads):
+
+        workflow.remove_files(cwd, \
+            ["SpecLib_cons_decoy.TraML", \
+            "SpecLib_cons_openswath.tsv", \
+            "SpecLib_cons.pepidx", \
+            "SpecLib_cons.spidx", \
+            "SpecLib_cons.splib", \
+            "SpecLib_cons.sptxt", \
+            "SpecLib_cons.TraML", \
+            "SpecLib_libfree.pepidx", \
+            "SpecLib_libfree.spidx", \
+            "SpecLib_libfree.splib", \
+            "SpecLib_libfree.sptxt", \
+            "SpecLib_lib.pepidx", \
+            "SpecLib_lib.spidx", \
+            "SpecLib_lib.splib", \
+            "SpecLib_lib.sptxt", \
+            "SpecLib_lib.log", \
+            "SpecLib_libfree.log", \
+            "SpecLib_merged.pepidx", \
+            "SpecLib_merged.spidx", \
+            "SpecLib_merged.splib", \
+            "SpecLib_merged.sptxt", \
+            "spectrast.log"])
+
+        for method in ["lib", "libfree"]:
+            directory = os.path.join(cwd, method + "_mayu")
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+        # Another project may already have built the same library
+
+        fingerprint = None
+        if library_registry:
+            fingerprint = library_fingerprint()
+            if library_registry.link(fingerprint, cwd):
+                workflow.logline(log_fh, "Spectral library " + fingerprint + " reused from the registry.")
+                Progress(progressData, "percentage-indicator").ready()
+                return
+
+        workflow.buildlib(\
+            event, \
+            log_fh, \
+            progressData, \
+            cwd, \
+            "DECOY_", \
+            decoy_db_file, \
+            str(threads), \
+            libmethod_pepXMLs, \
+            libfreemethod_pepXMLs, \
+            "/opt/gladiator/iRT.txt", \
+            "swath-windows.txt", \
+            pvalue, \
+            pvalue, \
+            results["swaths_min"], \
+            results["swaths_max"])
+
+        if fingerprint and not event.kill_flag:
+            try:
+                library_registry.register(fingerprint, cwd, os.path.basename(cwd), "swath-windows.txt")
+            except OSError as e:
+                workflow.logline(log_fh, "Registering the spectral library failed: " + str(e))
+
+    def library_fingerprint():
+        return library_registry.fingerprint(cwd, libmethod_pepXMLs + libfreemethod_pepXMLs, \
+            decoy_db_file, "/opt/gladiator/iRT.txt", "swath-windows.txt", {"protFDR": pvalue, "gFDR": pvalue})
+
+    speclib_task = pipeline.add(Task(\
+        "speclib", \
+        speclib, \
+        deps=[swath_task, database_task] + search_tasks, \
+        inputs=[decoy_db_file] + libmethod_pepXMLs + libfreemethod_pepXMLs, \
+        outputs=["SpecLib_cons_decoy.TraML"], \
+        phase="Building Library", \
+        params=lambda: {"pvalue": pvalue, "swaths_min": results["swaths_min"], "swaths_max": results["swaths_max"]}, \
+        tools=["/opt/tpp/bin/InterProphetParser", "/opt/tpp/bin/Mayu.pl", "/opt/tpp/bin/spectrast", \
+            "spectrast2tsv.py", "TargetedFileConverter", "OpenSwathDecoyGenerator", "/opt/gladiator/iRT.txt"]))
+
+    # Pinning also covers a library that was up to date
+
+    if library_registry and cfg.get("pin_library"):
+
+        def pin_library(progressData, threads):
+            fingerprint = library_fingerprint()
+            library_registry.register(fingerprint, cwd, os.path.basename(cwd), "swath-windows.txt")
+            library_registry.pin(cfg["pin_library"], fingerprint)
+            workflow.logline(log_fh, "Spectral library pinned as " + cfg["pin_library"] + " (" + fingerprint + ")")
+
+        pipeline.add(Task(\
+            "pin_library", \
+            pin_library, \
+            deps=[speclib_task], \
+            threads=1))
+
+    add_matrices(speclib_task)
+
+    return pipeline
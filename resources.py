@@ -0,0 +1,305 @@
+import os
+import math
+import threading
+
+import psutil
+
+
+GB = 1024 ** 3
+
+
+# CPU and memory available to this process. In containers the host's
+# numbers (os.cpu_count, psutil) overstate what can be used, so the CPU
+# affinity mask and the cgroup v1/v2 CPU quota and memory limit are taken
+# into account.
+
+def read_cgroup_file(controller, filename):
+
+    # Reads a cgroup control file of this process for the given v1
+    # controller, or from the unified v2 hierarchy when controller is None.
+    # Returns None if there is no such file.
+
+    paths = []
+    try:
+        with open("/proc/self/cgroup") as fh:
+            for line in fh:
+                parts = line.rstrip("\n").split(":", 2)
+                if len(parts) != 3:
+                    continue
+                controllers = parts[1].split(",")
+                if (controller is None and parts[1] == "") or controller in controllers:
+                    paths.append(parts[2])
+    except OSError:
+        None
+
+    roots = ["/sys/fs/cgroup"]
+    if controller:
+        roots = ["/sys/fs/cgroup/" + controller, "/sys/fs/cgroup/cpu,cpuacct"]
+
+    # Inside a container the own cgroup is usually mounted as the root
+    for root in roots:
+        for path in paths + ["/"]:
+            candidate = os.path.join(root, path.lstrip("/"), filename)
+            try:
+                with open(candidate) as fh:
+                    return fh.read().strip()
+            except OSError:
+                None
+
+    return None
+
+
+def cgroup_cpu_limit():
+
+    # CPU quota as a number of CPUs, None if unlimited
+
+    cpu_max = read_cgroup_file(None, "cpu.max")
+    if cpu_max:
+        quota, period = (cpu_max.split() + ["100000"])[:2]
+        if quota != "max" and int(period) > 0:
+            return int(quota) / int(period)
+        return None
+
+    quota = read_cgroup_file("cpu", "cpu.cfs_quota_us")
+    period = read_cgroup_file("cpu", "cpu.cfs_period_us")
+    if quota and period and int(quota) > 0 and int(period) > 0:
+        return int(quota) / int(period)
+
+    return None
+
+
+def affinity_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_cpus():
+    cpus = affinity_cpus()
+    quota = cgroup_cpu_limit()
+    if quota:
+        cpus = min(cpus, int(math.ceil(quota)))
+    return max(1, cpus)
+
+
+def cgroup_memory_limit():
+
+    # Returns (limit, usage) in bytes, limit None if unlimited
+
+    limit = read_cgroup_file(None, "memory.max")
+    usage = read_cgroup_file(None, "memory.current")
+    if limit is None:
+        limit = read_cgroup_file("memory", "memory.limit_in_bytes")
+        usage = read_cgroup_file("memory", "memory.usage_in_bytes")
+
+    if not limit or limit == "max":
+        return None, None
+
+    limit = int(limit)
+    # cgroup v1 reports "no limit" as a huge page aligned number
+    if limit >= 2 ** 60:
+        return None, None
+
+    if usage:
+        usage = int(usage)
+    else:
+        usage = 0
+
+    return limit, usage
+
+
+def available_memory():
+    available = psutil.virtual_memory().available
+    limit, usage = cgroup_memory_limit()
+    if limit:
+        available = min(available, max(0, limit - usage))
+    return available
+
+
+def memory_limit():
+
+    # Memory the process may use in total: the physical memory or the
+    # cgroup limit if lower
+    total = psutil.virtual_memory().total
+    limit, usage = cgroup_memory_limit()
+    if limit:
+        total = min(total, limit)
+    return total
+
+
+def describe_resources():
+    quota = cgroup_cpu_limit()
+    limit, usage = cgroup_memory_limit()
+    text = "Detected " + str(available_cpus()) + " CPUs (affinity " + str(affinity_cpus())
+    if quota:
+        text += ", cgroup quota " + "{:.2f}".format(quota)
+    text += ") and " + "{:.1f}".format(available_memory() / GB) + " GB of available memory"
+    if limit:
+        text += " (cgroup limit " + "{:.1f}".format(limit / GB) + " GB)"
+    return text
+
+
+# Memory needed by the heavy tools, as (fixed GB, multiple of the input
+# size). The values are conservative figures from typical runs and can be
+# tuned here for a site.
+
+MEMORY_ESTIMATES = {
+    "diaumpire": (4, 6.0),
+    "openswath": (2, 2.0),
+    "spectrast": (2, 4.0),
+    "pyprophet": (1, 4.0),
+}
+
+
+# Concurrent jobs that mostly stream large files (e.g. RAW conversions)
+# are limited by the storage the files are on.
+
+IO_WORKERS_ROTATIONAL = 2
+IO_WORKERS_SOLID_STATE = 8
+IO_WORKERS_UNKNOWN = 4
+
+
+def is_rotational(path):
+
+    # Whether path is on a spinning disk, None if it can not be told
+    # (e.g. network filesystems or no /sys).
+
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return None
+
+    block = "/sys/dev/block/" + str(os.major(dev)) + ":" + str(os.minor(dev))
+    for queue in [os.path.join(block, "queue"), os.path.join(block, "..", "queue")]:
+        try:
+            with open(os.path.join(queue, "rotational")) as fh:
+                return fh.read().strip() == "1"
+        except OSError:
+            None
+
+    return None
+
+
+def io_workers(filenames):
+
+    # Concurrency cap for jobs reading filenames: the most restrictive of
+    # the devices the files are on.
+
+    workers = []
+    for filename in filenames:
+        rotational = is_rotational(filename)
+        if rotational is None:
+            workers.append(IO_WORKERS_UNKNOWN)
+        elif rotational:
+            workers.append(IO_WORKERS_ROTATIONAL)
+        else:
+            workers.append(IO_WORKERS_SOLID_STATE)
+
+    if not workers:
+        return IO_WORKERS_UNKNOWN
+    return min(workers)
+
+
+def estimate_memory(tool, filenames):
+
+    # Estimated peak memory of a tool run in bytes, scaled by the size of
+    # the largest input file.
+
+    base, factor = MEMORY_ESTIMATES[tool]
+    sizes = [os.path.getsize(x) for x in filenames if os.path.isfile(x)]
+    largest = 0
+    if sizes:
+        largest = max(sizes)
+    return int(base * GB + factor * largest)
+
+
+# Admission control for memory hungry jobs. The budget is shared by every
+# analysis running in this process (the web UI runs several projects in
+# one process). A job reserves its estimated memory before it is started
+# and releases it when it has exited. The budget is the memory limit, not
+# the memory available when the process starts, so that a server started
+# while the machine is busy does not keep a small budget for its lifetime.
+# Reservations can be made on behalf of an owner (the analysis' Event).
+# If owner_limit is set, owner_limit(owner) gives the owner's fair share
+# (or None for no limit); an owner holding memory can not reserve past its
+# share, but its first job is always admitted so that no analysis starves.
+
+class MemoryBudget:
+
+    def __init__(self, total=None):
+        if not total:
+            total = memory_limit()
+        self.total = int(total)
+        self.reserved = 0
+        self.owners = {}
+        self.owner_limit = None
+        self.cond = threading.Condition()
+
+    def clamp(self, nbytes):
+        # A job larger than the whole budget may still run alone
+        return max(0, min(int(nbytes), self.total))
+
+    def fits(self, nbytes, owner):
+        if self.reserved + nbytes > self.total:
+            return False
+        if owner is not None and self.owner_limit:
+            limit = self.owner_limit(owner)
+            owned = self.owners.get(owner, 0)
+            if limit and owned > 0 and owned + nbytes > limit:
+                return False
+        return True
+
+    def take(self, nbytes, owner):
+        self.reserved += nbytes
+        if owner is not None:
+            self.owners[owner] = self.owners.get(owner, 0) + nbytes
+        return nbytes
+
+    def try_reserve(self, nbytes, owner=None):
+        nbytes = self.clamp(nbytes)
+        with self.cond:
+            if not self.fits(nbytes, owner):
+                return None
+            return self.take(nbytes, owner)
+
+    def reserve(self, nbytes, event=None, owner=None):
+
+        # Blocks until the memory is available. Returns the reserved amount,
+        # or None if the event was killed while waiting. The wait is woken
+        # by releases and by a kill of the event.
+
+        nbytes = self.clamp(nbytes)
+        if event:
+            event.add_kill_callback(self.notify)
+        try:
+            with self.cond:
+                while not self.fits(nbytes, owner):
+                    if event and event.kill_flag:
+                        return None
+                    self.cond.wait()
+                if event and event.kill_flag:
+                    return None
+                return self.take(nbytes, owner)
+        finally:
+            if event:
+                event.remove_kill_callback(self.notify)
+
+    def release(self, nbytes, owner=None):
+        if not nbytes:
+            return
+        with self.cond:
+            self.reserved = max(0, self.reserved - nbytes)
+            if owner in self.owners:
+                self.owners[owner] -= nbytes
+                if self.owners[owner] <= 0:
+                    del self.owners[owner]
+            self.cond.notify_all()
+
+    def notify(self):
+        # Wakes waiting reservations after the shares have changed or an
+        # event was killed
+        with self.cond:
+            self.cond.notify_all()
+
+
+memory_budget = MemoryBudget()
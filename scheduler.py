@@ -0,0 +1,107 @@
+import threading
+
+import resources
+
+
+# Server wide scheduler for the analyses started from the web UI. Analyses
+# wait in a queue until one of max_running slots is free, higher priority
+# first and in submission order within a priority. The running analyses
+# split the thread budget equally and each gets an equal share of the
+# memory budget (see resources.MemoryBudget.owner_limit), so that the
+# shares grow again as other analyses finish.
+
+class AnalysisScheduler:
+
+    def __init__(self, max_running=1, threads=None):
+        self.max_running = max(1, int(max_running))
+        self.threads = threads or resources.available_cpus()
+        self.lock = threading.Lock()
+        self.queue = []
+        self.running = {}
+        self.seq = 0
+        resources.memory_budget.owner_limit = self.memory_share
+
+    def submit(self, project, start, event, priority=0):
+
+        # start() is called once the analysis may run; it must make sure
+        # that finished(project) is called when the analysis ends. Returns
+        # False (and does not queue it) if the project is already queued or
+        # running.
+
+        with self.lock:
+            if self.is_active_locked(project):
+                return False
+            self.queue.append({
+                "project": project,
+                "start": start,
+                "event": event,
+                "priority": int(priority or 0),
+                "seq": self.seq,
+            })
+            self.seq += 1
+        self.dispatch()
+        return True
+
+    def is_active_locked(self, project):
+        return project in self.running or any(x["project"] == project for x in self.queue)
+
+    def is_active(self, project):
+        # Whether the project is queued or running
+        with self.lock:
+            return self.is_active_locked(project)
+
+    def dispatch(self):
+        started = []
+        with self.lock:
+            while self.queue and len(self.running) < self.max_running:
+                entry = min(self.queue, key=lambda x: (-x["priority"], x["seq"]))
+                self.queue.remove(entry)
+                self.running[entry["project"]] = entry
+                started.append(entry)
+
+        for entry in started:
+            entry["start"]()
+
+        if started:
+            resources.memory_budget.notify()
+
+    def finished(self, project):
+        with self.lock:
+            if project in self.running:
+                del self.running[project]
+        resources.memory_budget.notify()
+        self.dispatch()
+
+    def cancel(self, project):
+
+        # Removes a queued analysis. Returns False if it was not queued.
+
+        with self.lock:
+            for entry in self.queue:
+                if entry["project"] == project:
+                    self.queue.remove(entry)
+                    return True
+        return False
+
+    def queue_position(self, project):
+
+        # 1 for the analysis started next, None if not queued.
+
+        with self.lock:
+            ordered = sorted(self.queue, key=lambda x: (-x["priority"], x["seq"]))
+            for i, entry in enumerate(ordered):
+                if entry["project"] == project:
+                    return i + 1
+        return None
+
+    def threads_for(self, project):
+        with self.lock:
+            n_running = max(1, len(self.running))
+        return max(1, self.threads // n_running)
+
+    def memory_share(self, owner):
+        with self.lock:
+            events = [self.running[x]["event"] for x in self.running]
+        if owner not in events:
+            return None
+        return resources.memory_budget.total // len(events)
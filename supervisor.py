@@ -0,0 +1,330 @@
+import collections
+import os
+import selectors
+import subprocess
+import threading
+
+
+# Cancellation primitive shared between an analysis and the external
+# processes it runs. Besides the flag, a kill writes to a pipe so that
+# supervisors blocked in select() wake up immediately, and calls the
+# callbacks registered by waits that do not select (e.g. on a condition).
+
+class Event:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flag = threading.Event()
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+        self.callbacks = []
+
+    def __del__(self):
+        for fd in [self.read_fd, self.write_fd]:
+            try:
+                os.close(fd)
+            except OSError:
+                None
+
+    @property
+    def kill_flag(self):
+        return self.flag.is_set()
+
+    def kill(self):
+        with self.lock:
+            if self.flag.is_set():
+                return
+            self.flag.set()
+            try:
+                os.write(self.write_fd, b"k")
+            except BlockingIOError:
+                None
+            callbacks = list(self.callbacks)
+        # Called without the lock, callbacks may take locks of their own
+        for callback in callbacks:
+            callback()
+
+    def add_kill_callback(self, callback):
+        # Called at once if the event has already been killed
+        with self.lock:
+            self.callbacks.append(callback)
+            killed = self.flag.is_set()
+        if killed:
+            callback()
+
+    def remove_kill_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def reset(self):
+        with self.lock:
+            self.flag.clear()
+            try:
+                while os.read(self.read_fd, 64):
+                    None
+            except BlockingIOError:
+                None
+
+    def wait(self, timeout=None):
+        return self.flag.wait(timeout)
+
+    def fileno(self):
+        return self.read_fd
+
+
+def _exit_fd(proc):
+
+    # A descriptor that becomes readable once proc has exited. pidfd is used
+    # when the kernel and Python support it, otherwise a helper thread reaps
+    # the child and closes the write end of a pipe.
+
+    if getattr(proc, "exit_fd", None) is not None:
+        return proc.exit_fd
+
+    fd = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            fd = os.pidfd_open(proc.pid)
+        except OSError:
+            fd = None
+
+    if fd is None:
+        read_fd, write_fd = os.pipe()
+
+        def reaper():
+            try:
+                proc.wait()
+            finally:
+                os.close(write_fd)
+
+        threading.Thread(target=reaper, daemon=True).start()
+        fd = read_fd
+
+    proc.exit_fd = fd
+    return fd
+
+
+def _close_exit_fd(proc):
+    fd = getattr(proc, "exit_fd", None)
+    if fd is not None:
+        proc.exit_fd = None
+        os.close(fd)
+
+
+def start_process(log_fh, cmd, **kwargs):
+
+    if kwargs.get("shell"):
+        cmd_str = cmd
+    else:
+        cmd_str = " ".join(cmd)
+
+    if log_fh:
+        if "stdout" not in kwargs:
+            kwargs["stdout"] = log_fh
+        if "stderr" not in kwargs:
+            kwargs["stderr"] = log_fh
+        log_fh.write("Running pipeline command: " + cmd_str + "\n")
+        log_fh.flush()
+
+    proc = subprocess.Popen(cmd, **kwargs)
+    _exit_fd(proc)
+    return proc
+
+
+def kill_processes(procs):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.kill()
+    for proc in procs:
+        proc.wait()
+        _close_exit_fd(proc)
+
+
+def wait_processes(event, procs):
+
+    # Blocks until at least one of procs exits or the event is killed,
+    # without any polling interval. Returns the exited processes, or None
+    # when the event was killed first (all procs are killed in that case).
+
+    procs = list(procs)
+
+    with selectors.DefaultSelector() as selector:
+
+        for proc in procs:
+            selector.register(_exit_fd(proc), selectors.EVENT_READ, proc)
+
+        if event:
+            selector.register(event.fileno(), selectors.EVENT_READ, None)
+
+        while True:
+            if event and event.kill_flag:
+                kill_processes(procs)
+                return None
+
+            ready = selector.select()
+
+            exited = [key.data for key, _ in ready if key.data is not None]
+            if exited:
+                for proc in exited:
+                    proc.wait()
+                    _close_exit_fd(proc)
+                return exited
+
+
+# Executors start the jobs of a ProcessPool. The local executor runs them
+# as child processes. Other executors (see workqueue.py) return objects
+# with the same poll/wait/kill/returncode interface and an exit_fd that
+# becomes readable when the job has finished. Per-file tasks use the
+# task executor, which can be switched to a distributed one at startup.
+
+class LocalExecutor:
+
+    local = True
+
+    def start(self, log_fh, cmd, **kwargs):
+        return start_process(log_fh, cmd, **kwargs)
+
+
+local_executor = LocalExecutor()
+_task_executor = local_executor
+
+
+def set_task_executor(executor):
+    global _task_executor
+    _task_executor = executor
+
+
+def task_executor():
+    return _task_executor
+
+
+def run_command(event, log_fh, cmd, **kwargs):
+
+    # Runs a single command to completion. Returns its exit code, or None
+    # if the analysis was cancelled while the command was running.
+
+    proc = start_process(log_fh, cmd, **kwargs)
+    exited = wait_processes(event, [proc])
+    if log_fh:
+        log_fh.flush()
+    if exited is None:
+        return None
+    return proc.returncode
+
+
+# Runs queued commands with at most `workers` of them alive at a time. Each
+# running command holds a worker slot (0..workers-1) that is passed to the
+# command factory, so callers can hand every slot its own settings.
+# Additional lanes with their own worker limits can be added, so that e.g.
+# conversions of finished outputs do not wait for search slots.
+# on_exit(returncode) is called in the thread that called run(); it may
+# submit further jobs. An exception raised from on_exit kills the remaining
+# processes and is propagated.
+# With a memory budget, a job submitted with memory= (bytes) is started
+# only once that much memory has been reserved from the budget, and the
+# reservation is released when the job exits. The budget only applies to
+# jobs run on this machine.
+
+class ProcessPool:
+
+    def __init__(self, event, log_fh, workers, memory_budget=None, executor=None):
+        self.event = event
+        self.log_fh = log_fh
+        self.executor = executor or local_executor
+        self.memory_budget = None
+        if self.executor.local:
+            self.memory_budget = memory_budget
+        self.lanes = {}
+        self.running = {}
+        self.add_lane(None, workers)
+
+    def add_lane(self, lane, workers):
+        workers = max(1, int(workers))
+        self.lanes[lane] = {
+            "workers": workers,
+            "pending": collections.deque(),
+            "free_slots": list(range(workers)),
+        }
+
+    def submit(self, cmd, on_exit=None, lane=None, memory=0, **kwargs):
+        self.lanes[lane]["pending"].append((cmd, on_exit, memory, kwargs))
+
+    def has_pending(self):
+        return any(self.lanes[lane]["pending"] for lane in self.lanes)
+
+    def _start_pending(self):
+        for lane in self.lanes:
+            pending = self.lanes[lane]["pending"]
+            free_slots = self.lanes[lane]["free_slots"]
+            while pending and free_slots:
+                cmd, on_exit, memory, kwargs = pending[0]
+
+                reserved = 0
+                if memory and self.memory_budget:
+                    reserved = self.memory_budget.try_reserve(memory, self.event)
+                    if reserved is None:
+                        # Wait for our own jobs to release memory if any
+                        # are running, otherwise for other users of the
+                        # budget.
+                        if self.running:
+                            break
+                        reserved = self.memory_budget.reserve(memory, self.event, self.event)
+                        if reserved is None:
+                            return
+
+                pending.popleft()
+                slot = free_slots.pop(0)
+                try:
+                    if callable(cmd):
+                        cmd = cmd(slot)
+                    proc = self.executor.start(self.log_fh, cmd, **kwargs)
+                except BaseException:
+                    self._release(reserved)
+                    raise
+                self.running[proc] = (lane, slot, on_exit, reserved)
+
+    def _release(self, reserved):
+        if reserved and self.memory_budget:
+            self.memory_budget.release(reserved, self.event)
+
+    def _clear(self):
+        for proc in self.running:
+            self._release(self.running[proc][3])
+        self.running = {}
+        for lane in self.lanes:
+            self.lanes[lane]["pending"].clear()
+
+    def run(self):
+
+        # Returns True when every job has finished, False if cancelled.
+
+        try:
+            while self.has_pending() or self.running:
+
+                self._start_pending()
+
+                exited = wait_processes(self.event, list(self.running))
+                if exited is None:
+                    self._clear()
+                    return False
+
+                if self.log_fh:
+                    self.log_fh.flush()
+
+                for proc in exited:
+                    lane, slot, on_exit, reserved = self.running.pop(proc)
+                    self._release(reserved)
+                    free_slots = self.lanes[lane]["free_slots"]
+                    free_slots.append(slot)
+                    free_slots.sort()
+                    if on_exit:
+                        on_exit(proc.returncode)
+
+        except BaseException:
+            kill_processes(list(self.running))
+            self._clear()
+            raise
+
+        return True
@@ -0,0 +1,158 @@
+import os
+import uuid
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Typed, compressed Parquet copies of the result tables, written next to
+# each table as <name>.parquet (matrix.tsv -> matrix.parquet). Readers use
+# the copy instead of the text table if it is not older than the table,
+# reading only the columns they need; tables replaced later (e.g. restored
+# from the artifact cache) are read as text until they are copied again.
+# Without pyarrow no copies are written and the text tables are read.
+
+COMPRESSION = "zstd"
+
+# Bytes of a text table converted at once when copying it
+BLOCK_SIZE = 64 * 1024 ** 2
+
+
+def copy_filename(filename):
+    return os.path.splitext(filename)[0] + ".parquet"
+
+
+def has_copy(filename):
+    if not pyarrow:
+        return False
+    try:
+        return os.stat(copy_filename(filename)).st_mtime_ns >= os.stat(filename).st_mtime_ns
+    except OSError:
+        return False
+
+
+def remove_copy(filename):
+    if os.path.isfile(copy_filename(filename)):
+        os.remove(copy_filename(filename))
+
+
+def write_copy(df, filename):
+
+    # Copy of df, written as filename. Returns False if df can not be
+    # stored as Parquet (e.g. columns of mixed types).
+
+    if not pyarrow:
+        return False
+
+    tmp_filename = copy_filename(filename) + "." + uuid.uuid4().hex
+    try:
+        df.to_parquet(tmp_filename, index=False, compression=COMPRESSION)
+        os.rename(tmp_filename, copy_filename(filename))
+        return True
+    except (pyarrow.ArrowException, ValueError, TypeError):
+        remove_copy(filename)
+        return False
+    finally:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def write_table(df, filename):
+    df.to_csv(filename, sep="\t", index=False)
+    write_copy(df, filename)
+
+
+def convert(filename, sep="\t"):
+
+    # Copies a text table written by another tool, streaming it in blocks
+    # so that tables larger than the memory can be copied. Returns False if
+    # it can not be copied (e.g. the types of a column differ between
+    # blocks).
+
+    if not pyarrow:
+        return False
+    if has_copy(filename):
+        return True
+
+    tmp_filename = copy_filename(filename) + "." + uuid.uuid4().hex
+    try:
+        reader = pyarrow.csv.open_csv(filename, \
+            read_options=pyarrow.csv.ReadOptions(block_size=BLOCK_SIZE), \
+            parse_options=pyarrow.csv.ParseOptions(delimiter=sep), \
+            convert_options=pyarrow.csv.ConvertOptions(strings_can_be_null=True))
+        writer = None
+        try:
+            for batch in reader:
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(tmp_filename, reader.schema, compression=COMPRESSION)
+                writer.write_table(pyarrow.Table.from_batches([batch], schema=reader.schema))
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(tmp_filename, reader.schema, compression=COMPRESSION)
+        finally:
+            if writer is not None:
+                writer.close()
+        os.rename(tmp_filename, copy_filename(filename))
+        return True
+    except (pyarrow.ArrowException, OSError):
+        remove_copy(filename)
+        return False
+    finally:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def apply_dtype(df, dtype):
+
+    # Column types of a table read from a copy as read_csv would give them,
+    # missing values staying missing
+
+    if not dtype:
+        return df
+    for column, column_dtype in dtype.items():
+        if column not in df.columns:
+            continue
+        if column_dtype is str:
+            df[column] = df[column].astype(object).where(df[column].isna(), df[column].astype(str))
+        else:
+            df[column] = df[column].astype(column_dtype)
+    return df
+
+
+def read_header(filename, sep="\t"):
+    if has_copy(filename):
+        return pyarrow.parquet.read_schema(copy_filename(filename)).names
+    return pd.read_csv(filename, sep=sep, nrows=0).columns.tolist()
+
+
+def read_table(filename, columns=None, index_col=None, dtype=None, sep="\t"):
+
+    # Reads filename or its copy. index_col is a column name or position,
+    # it is read in addition to columns.
+
+    if index_col is not None and not isinstance(index_col, str):
+        index_col = read_header(filename, sep)[index_col]
+    if columns is not None and index_col is not None:
+        columns = [index_col] + [x for x in columns if x != index_col]
+
+    if has_copy(filename):
+        df = apply_dtype(pd.read_parquet(copy_filename(filename), columns=columns), dtype)
+    else:
+        df = pd.read_csv(filename, sep=sep, usecols=columns, dtype=dtype)
+
+    if index_col is not None:
+        df = df.set_index(index_col)
+    return df
+
+
+def iter_batches(filename, columns, dtype=None, batch_size=500000):
+
+    # Yields the given columns of the copy of filename in chunks of rows
+
+    for batch in pyarrow.parquet.ParquetFile(copy_filename(filename)).iter_batches(batch_size=batch_size, columns=columns):
+        yield apply_dtype(batch.to_pandas(), dtype)
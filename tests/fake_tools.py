@@ -0,0 +1,58 @@
+import os
+
+import supervisor
+
+
+# Executor running a shell script in place of each external tool, chosen by
+# the basename of the command. The arguments of the command are the
+# script's $1, $2, ... Every run appends "start <tool>" and "end <tool>"
+# to a timeline, from which the concurrency of the runs is read.
+
+class FakeTools:
+
+    local = True
+
+    def __init__(self, directory, scripts=None, delay=0.3):
+        self.timeline_filename = os.path.join(str(directory), "timeline.txt")
+        self.scripts = scripts or {}
+        self.delay = delay
+        self.commands = []
+
+    def start(self, log_fh, cmd, **kwargs):
+        name = os.path.basename(cmd[0])
+        self.commands.append(cmd)
+        script = 'echo "start %s" >> %s; sleep %s; %s\nstatus=$?; echo "end %s" >> %s; exit $status' \
+            % (name, self.timeline_filename, self.delay, self.scripts.get(name, "true"), name, self.timeline_filename)
+        return supervisor.start_process(log_fh, ["sh", "-c", script, name] + list(cmd[1:]), \
+            cwd=kwargs.get("cwd"), env=kwargs.get("env"))
+
+    def timeline(self):
+        if not os.path.isfile(self.timeline_filename):
+            return []
+        with open(self.timeline_filename, "r") as fh:
+            return [tuple(line.split()) for line in fh]
+
+    def concurrency(self, names=None):
+
+        # Most runs of the given tools (all if None) alive at a time
+
+        running = 0
+        most = 0
+        for what, name in self.timeline():
+            if names is not None and name not in names:
+                continue
+            running += 1 if what == "start" else -1
+            most = max(most, running)
+        return most
+
+    def started_while_running(self, first, second):
+
+        # Whether a run of second started while a run of first was alive
+
+        running = 0
+        for what, name in self.timeline():
+            if name == first:
+                running += 1 if what == "start" else -1
+            elif name == second and what == "start" and running > 0:
+                return True
+        return False
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import annotation
+from progress import Progress
+
+
+# The vectorized annotation against the row by row version it replaced
+
+
+def annotate_rows(proteins, dicts, ambiguous_threshold, split_IDs=False):
+
+    # The former loop of annotate_df. Several values are joined in the
+    # order of their set, which within an interpreter run only depends on
+    # the order the values were added in.
+
+    values = dict((k, []) for k in dicts)
+    for row in proteins:
+        sets = dict((k, set()) for k in dicts)
+        for ID in row.split(";"):
+            if split_IDs:
+                ID = ID.split("|")[0]
+            for k in dicts:
+                if ID in dicts[k]:
+                    sets[k].add(dicts[k][ID])
+
+        for k in dicts:
+            L = list(sets[k])
+            if len(L) > 1 and "unknown" in L:
+                L.remove('unknown')
+            if len(L) == 1:
+                values[k].append(L[0])
+            elif len(L) > 1:
+                if not ambiguous_threshold or (ambiguous_threshold and len(L) < int(ambiguous_threshold)):
+                    values[k].append(";".join(L))
+                else:
+                    values[k].append("ambiguous")
+            else:
+                values[k].append("unknown")
+    return values
+
+
+def make_annotations():
+    rng = np.random.RandomState(1)
+    IDs = ["P%03d" % i for i in range(60)]
+    dicts = {
+        "organism": dict((ID, ["E. coli", "B. subtilis", "S. aureus", "unknown"][rng.randint(4)]) \
+            for ID in IDs if rng.rand() < 0.8),
+        "EC_number": dict((ID, "%d.%d.1.1" % (rng.randint(1, 7), rng.randint(1, 4))) \
+            for ID in IDs if rng.rand() < 0.5),
+    }
+    proteins = []
+    for i in range(300):
+        row = [IDs[x] for x in rng.choice(70, rng.randint(1, 6), replace=False) if x < 60] or ["Q999"]
+        proteins.append(";".join(x + "|gene" + str(i) if i % 3 == 0 else x for x in row))
+    return pd.Series(proteins, index=range(1000, 1300)), dicts
+
+
+def load_rows(anno_file, ID_key):
+
+    # The former row by row loading of an annotation file
+
+    df = pd.read_csv(anno_file, sep="\t")
+    dicts = {}
+    for _, row in df.iterrows():
+        for field in df.columns:
+            if field != ID_key:
+                dicts.setdefault(field, {})[row[ID_key]] = str(row[field]).strip()
+    return dicts
+
+
+@pytest.mark.parametrize("ambiguous_threshold", [None, 3])
+@pytest.mark.parametrize("split_IDs", [False, True])
+def test_annotate_proteins_as_rows(tmp_path, ambiguous_threshold, split_IDs):
+    proteins, dicts = make_annotations()
+    expected = annotate_rows(proteins, dicts, ambiguous_threshold, split_IDs)
+
+    values = annotation.annotate_proteins(None, Progress(None, "percentage-indicator"), \
+        proteins, dicts, ambiguous_threshold, split_IDs)
+    assert dict((k, list(v)) for k, v in values.items()) == expected
+
+    # From an annotation file, unannotated fields of a protein read as "nan"
+    anno_file = str(tmp_path / "annotations.tsv")
+    pd.DataFrame(dicts).rename_axis("ID").reset_index().to_csv(anno_file, sep="\t", index=False)
+    expected = annotate_rows(proteins, load_rows(anno_file, "ID"), ambiguous_threshold, split_IDs)
+
+    table = annotation.load_annotations(None, None, None, "ID", anno_file, None)
+    values = annotation.annotate_proteins(None, Progress(None, "percentage-indicator"), \
+        proteins, table, ambiguous_threshold, split_IDs)
+    assert dict((k, list(v)) for k, v in values.items()) == expected
+
+
+def test_load_annotations_override(tmp_path):
+    first = str(tmp_path / "first.tsv")
+    second = str(tmp_path / "second.tsv")
+    pd.DataFrame({"ID": ["A", "B", "B"], "organism": [" x ", "y", "z"]}).to_csv(first, sep="\t", index=False)
+    pd.DataFrame({"ID": ["B", "C"], "EC": ["1.1", "2.2"], "organism": ["w", np.nan]}) \
+        .to_csv(second, sep="\t", index=False)
+
+    table = annotation.load_annotations(None, None, None, "ID", first, None)
+    table = annotation.load_annotations(None, None, None, "ID", second, table)
+
+    assert list(table.columns) == ["organism", "EC"]
+    assert table["organism"].to_dict() == {"A": "x", "B": "w", "C": "nan"}
+    assert table["EC"].dropna().to_dict() == {"B": "1.1", "C": "2.2"}
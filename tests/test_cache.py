@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+
+import cache
+import supervisor
+
+
+def write(filepath, data):
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, "w") as fh:
+        fh.write(data)
+
+
+def read(filepath):
+    with open(filepath, "r") as fh:
+        return fh.read()
+
+
+def store(artifact_cache, tmp_path, name, data):
+    project = str(tmp_path / ("project-" + name))
+    write(os.path.join(project, "out", "result.txt"), data)
+    key = artifact_cache.make_key(name, {}, [], [])
+    artifact_cache.store(key, project, ["out/result.txt"], name)
+    return key
+
+
+def test_store_and_restore(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    key = store(artifact_cache, tmp_path, "task", "result\n")
+
+    project = str(tmp_path / "other")
+    write(os.path.join(project, "out", "result.txt"), "stale\n")
+    assert artifact_cache.restore(key, project, ["out/result.txt"])
+    assert read(os.path.join(project, "out", "result.txt")) == "result\n"
+
+    # Other outputs than those stored
+    assert not artifact_cache.restore(key, project, ["out/result.txt", "out/other.txt"])
+    assert not artifact_cache.restore(artifact_cache.make_key("missing", {}, [], []), project, ["out/result.txt"])
+
+
+def test_incomplete_entry_not_restored(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    key = store(artifact_cache, tmp_path, "task", "result\n")
+    write(os.path.join(artifact_cache.entry(key), "files", "out", "result.txt"), "trunc")
+    assert not artifact_cache.restore(key, str(tmp_path / "other"), ["out/result.txt"])
+
+
+def test_keys(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    filepath = str(tmp_path / "input.txt")
+    write(filepath, "a")
+    key = artifact_cache.make_key("task", {"fdr": 0.01}, [], [("input.txt", artifact_cache.fingerprint(filepath))])
+    assert key == artifact_cache.make_key("task", {"fdr": 0.01}, [], [("input.txt", artifact_cache.fingerprint(filepath))])
+    assert key != artifact_cache.make_key("task", {"fdr": 0.05}, [], [("input.txt", artifact_cache.fingerprint(filepath))])
+
+    write(filepath, "b")
+    assert key != artifact_cache.make_key("task", {"fdr": 0.01}, [], [("input.txt", artifact_cache.fingerprint(filepath))])
+
+
+def test_least_recently_used_evicted(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"), max_bytes=25)
+    first = store(artifact_cache, tmp_path, "first", "x" * 10)
+    second = store(artifact_cache, tmp_path, "second", "x" * 10)
+
+    # The first entry used last
+    t = time.time() - 100
+    os.utime(os.path.join(artifact_cache.entry(second), "manifest.json"), (t, t))
+    assert artifact_cache.restore(first, str(tmp_path / "other"), ["out/result.txt"])
+
+    third = store(artifact_cache, tmp_path, "third", "x" * 10)
+    assert os.path.isdir(artifact_cache.entry(first))
+    assert not os.path.isdir(artifact_cache.entry(second))
+    assert os.path.isdir(artifact_cache.entry(third))
+    assert sum(x[1] for x in artifact_cache.entries()) == 20
+
+
+def test_content_hash_remembered(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    filepath = str(tmp_path / "db.fasta")
+    write(filepath, ">a\nPEPTIDE\n")
+    sha = artifact_cache.content_hash(filepath)
+    assert sha == cache.hash_file(filepath)
+    assert len(os.listdir(os.path.join(artifact_cache.cache_dir, "hashes"))) == 1
+    assert artifact_cache.content_hash(filepath) == sha
+
+
+def test_lock_key_waits_for_release(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    held = artifact_cache.lock_key("db")
+    threading.Timer(0.2, held.close).start()
+
+    t0 = time.time()
+    fh = artifact_cache.lock_key("db", supervisor.Event())
+    assert fh is not None
+    assert 0.15 < time.time() - t0 < 0.5
+    fh.close()
+
+
+def test_lock_key_cancel(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    held = artifact_cache.lock_key("db")
+
+    event = supervisor.Event()
+    threading.Timer(0.2, event.kill).start()
+    t0 = time.time()
+    assert artifact_cache.lock_key("db", event) is None
+    assert time.time() - t0 < 0.5
+
+    # The cancelled wait does not keep the lock once it is released
+    held.close()
+    t0 = time.time()
+    fh = artifact_cache.lock_key("db", supervisor.Event())
+    assert fh is not None
+    assert time.time() - t0 < 0.5
+    fh.close()
+
+
+def test_restore_keeps_shared_times(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    key = store(artifact_cache, tmp_path, "task", "result\n")
+
+    # The stored output is a hardlink to the entry
+    stored = str(tmp_path / "project-task" / "out" / "result.txt")
+    os.utime(stored, (1000.0, 1000.0))
+
+    for name in ["b", "c"]:
+        project = str(tmp_path / name)
+        assert artifact_cache.restore(key, project, ["out/result.txt"])
+        restored = os.path.join(project, "out", "result.txt")
+        assert os.stat(restored).st_nlink == 1
+        assert os.path.getmtime(restored) > 1000.0
+
+    assert os.path.getmtime(stored) == 1000.0
+    assert os.path.getmtime(os.path.join(artifact_cache.entry(key), "files", "out", "result.txt")) == 1000.0
@@ -0,0 +1,142 @@
+import os
+import stat
+
+import resources
+import supervisor
+import workflow
+from fake_tools import FakeTools
+from progress import Progress
+
+
+# OpenSwathWorkflow and pyprophet are replaced by scripts that write their
+# outputs, except for samples named "empty" which exit with 0 and write
+# nothing
+
+OPENSWATH = '''#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -in) in="$2"; shift ;;
+        -out_tsv) out="$2"; shift ;;
+    esac
+    shift
+done
+case "$in" in
+    *empty*) exit 0 ;;
+esac
+printf 'transition_group_id\\tdecoy\\n1\\t0\\n' > "$out"
+'''
+
+PYPROPHET = '''#!/bin/sh
+for x in "$@"; do
+    case "$x" in
+        *.tsv) printf 'transition_group_id\\td_score\\n1\\t2.0\\n' > "${x%.tsv}_with_dscore.csv" ;;
+    esac
+done
+'''
+
+
+def install_tools(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, script in [("OpenSwathWorkflow", OPENSWATH), ("pyprophet", PYPROPHET)]:
+        filepath = str(bin_dir / name)
+        with open(filepath, "w") as fh:
+            fh.write(script)
+        os.chmod(filepath, os.stat(filepath).st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+
+
+def make_project(tmp_path, samples):
+    cwd = tmp_path / "project"
+    cwd.mkdir()
+    for name in ["SpecLib_cons_decoy.TraML", "iRT.TraML", "swaths.txt"] + samples:
+        (cwd / name).write_text(name + "\n")
+    return str(cwd)
+
+
+def score(cwd, samples):
+    with open(os.devnull, "w") as log_fh:
+        return workflow.score_DIA_samples(supervisor.Event(), log_fh, Progress(None, "percentage-indicator"), \
+            2 * len(samples), cwd, samples, "swaths.txt", 2, "iRT.TraML", workers=2)
+
+
+def test_sample_without_output_is_skipped(tmp_path, monkeypatch):
+    install_tools(tmp_path, monkeypatch)
+    samples = ["good.mzML", "empty.mzML"]
+    cwd = make_project(tmp_path, samples)
+
+    assert score(cwd, samples) == ["good.mzML"]
+
+    tsv_filename, dscore_filename = workflow.DIA_sample_results("good.mzML")
+    assert workflow.valid_checkpoint(cwd, tsv_filename)
+    assert workflow.valid_checkpoint(cwd, dscore_filename, [tsv_filename])
+    tsv_filename, dscore_filename = workflow.DIA_sample_results("empty.mzML")
+    assert not os.path.exists(os.path.join(cwd, tsv_filename + ".done"))
+    assert not os.path.exists(os.path.join(cwd, dscore_filename + ".done"))
+
+
+def test_scored_samples_resumed(tmp_path, monkeypatch):
+    install_tools(tmp_path, monkeypatch)
+    samples = ["a.mzML", "b.mzML"]
+    cwd = make_project(tmp_path, samples)
+    assert score(cwd, samples) == samples
+
+    # A changed sample is extracted again, the other one is reused
+    with open(os.path.join(cwd, "b.mzML"), "a") as fh:
+        fh.write("more\n")
+    mtimes = dict((x, os.stat(os.path.join(cwd, workflow.DIA_sample_results(x)[1])).st_mtime_ns) for x in samples)
+    assert score(cwd, samples) == samples
+    assert os.stat(os.path.join(cwd, workflow.DIA_sample_results("a.mzML")[1])).st_mtime_ns == mtimes["a.mzML"]
+    assert os.stat(os.path.join(cwd, workflow.DIA_sample_results("b.mzML")[1])).st_mtime_ns != mtimes["b.mzML"]
+
+
+def install_fake_tools(tmp_path, monkeypatch, memory):
+    tools = FakeTools(tmp_path, {"OpenSwathWorkflow": OPENSWATH, "pyprophet": PYPROPHET})
+    monkeypatch.setattr(supervisor, "_task_executor", tools)
+    monkeypatch.setattr(resources, "memory_budget", resources.MemoryBudget(memory))
+    return tools
+
+
+def test_samples_extracted_side_by_side(tmp_path, monkeypatch):
+    tools = install_fake_tools(tmp_path, monkeypatch, 100 * resources.GB)
+    samples = ["a.mzML", "b.mzML", "c.mzML", "d.mzML"]
+    cwd = make_project(tmp_path, samples)
+
+    assert score(cwd, samples) == samples
+    assert tools.concurrency(["OpenSwathWorkflow"]) == 2
+    threads = [cmd[cmd.index("-threads") + 1] for cmd in tools.commands if cmd[0] == "OpenSwathWorkflow"]
+    # score() gives 2 threads, one for each worker
+    assert threads == ["1"] * 4
+
+
+def test_extractions_admitted_by_memory(tmp_path, monkeypatch):
+    tools = install_fake_tools(tmp_path, monkeypatch, 3 * resources.GB)
+    samples = ["a.mzML", "b.mzML", "c.mzML"]
+    cwd = make_project(tmp_path, samples)
+
+    assert score(cwd, samples) == samples
+    assert tools.concurrency(["OpenSwathWorkflow"]) == 1
+
+
+def test_choose_openswath_workers(monkeypatch):
+    samples = ["a.mzML", "b.mzML", "c.mzML", "d.mzML", "e.mzML"]
+    monkeypatch.setattr(resources, "memory_budget", resources.MemoryBudget(100 * resources.GB))
+    assert workflow.choose_openswath_workers(32, samples) == 4
+    assert workflow.choose_openswath_workers(32, samples[:2]) == 2
+    assert workflow.choose_openswath_workers(4, samples) == 1
+    monkeypatch.setattr(resources, "memory_budget", resources.MemoryBudget(5 * resources.GB))
+    assert workflow.choose_openswath_workers(32, samples) == 2
+
+
+def test_scoring_overlaps_extraction(tmp_path, monkeypatch):
+    tools = install_fake_tools(tmp_path, monkeypatch, 100 * resources.GB)
+    tools.scripts["OpenSwathWorkflow"] = 'case "$*" in *slow*) sleep 1 ;; esac\n' + OPENSWATH
+    samples = ["fast.mzML", "slow.mzML"]
+    cwd = make_project(tmp_path, samples)
+
+    # fast is scored while slow is still being extracted
+
+    assert score(cwd, samples) == samples
+    assert tools.started_while_running("OpenSwathWorkflow", "pyprophet")
+    scored = [cmd[3] for cmd in tools.commands if cmd[0] == "pyprophet"]
+    assert scored == [workflow.DIA_sample_results(x)[0] for x in samples]
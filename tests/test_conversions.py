@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+import resources
+import supervisor
+import workflow
+from fake_tools import FakeTools
+
+
+MONO = '''for x in "$@"; do
+    case "$x" in
+        -i=*broken*) exit 1 ;;
+        -b=*) printf '<mzML>\\n</mzML>\\n' > "${x#-b=}" ;;
+    esac
+done
+'''
+
+
+def convert(tmp_path, monkeypatch, names, workers, io_workers, scripts=None):
+    data = tmp_path / "data"
+    data.mkdir()
+    cwd = tmp_path / "project"
+    (cwd / "mzML").mkdir(parents=True)
+    for name in names:
+        (data / name).write_text(name + "\n")
+
+    tools = FakeTools(tmp_path, scripts or {"mono": MONO})
+    monkeypatch.setattr(supervisor, "local_executor", tools)
+    monkeypatch.setattr(resources, "io_workers", lambda filenames: io_workers)
+
+    def run():
+        with open(os.devnull, "w") as log_fh:
+            return workflow.convertRAW_ThermoRawFileParser(supervisor.Event(), log_fh, {}, str(cwd), \
+                [str(data / x) for x in names], True, "mzml", "mzML", workers=workers)
+    return tools, cwd, run
+
+
+def test_conversions_capped_by_storage(tmp_path, monkeypatch):
+    names = ["a.raw", "b.raw", "c.raw", "d.raw"]
+    tools, cwd, run = convert(tmp_path, monkeypatch, names, 4, 2)
+
+    assert run() is True
+    assert tools.concurrency() == 2
+    for name in ["a", "b", "c", "d"]:
+        assert workflow.is_complete_spectrum_file(str(cwd / "mzML" / (name + ".mzML")))
+
+
+def test_complete_outputs_skipped(tmp_path, monkeypatch):
+    names = ["a.raw", "b.raw", "c.raw"]
+    tools, cwd, run = convert(tmp_path, monkeypatch, names, 2, 8)
+    (cwd / "mzML" / "a.mzML").write_text("<mzML>\n</mzML>\n")
+    (cwd / "mzML" / "b.mzML").write_text("<mzML>\n<run>\n")
+
+    # b was left truncated by an earlier run and is converted again
+
+    assert run() is True
+    assert sorted(os.path.basename(cmd[-1]) for cmd in tools.commands) == ["b.mzML", "c.mzML"]
+    assert workflow.is_complete_spectrum_file(str(cwd / "mzML" / "b.mzML"))
+
+
+def test_conversion_error_fails(tmp_path, monkeypatch):
+    tools, cwd, run = convert(tmp_path, monkeypatch, ["a.raw", "broken.raw"], 2, 2)
+
+    with pytest.raises(workflow.NonZeroReturnValueException):
+        run()
+
+
+def test_io_workers(monkeypatch):
+    devices = {"ssd": False, "hdd": True, "nfs": None}
+    monkeypatch.setattr(resources, "is_rotational", lambda path: devices[path])
+
+    assert resources.io_workers(["ssd"]) == resources.IO_WORKERS_SOLID_STATE
+    assert resources.io_workers(["hdd"]) == resources.IO_WORKERS_ROTATIONAL
+    assert resources.io_workers(["nfs"]) == resources.IO_WORKERS_UNKNOWN
+    assert resources.io_workers(["ssd", "nfs", "hdd"]) == resources.IO_WORKERS_ROTATIONAL
+    assert resources.io_workers([]) == resources.IO_WORKERS_UNKNOWN
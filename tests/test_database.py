@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+import pytest
+
+import cache
+import supervisor
+import workflow
+
+
+@pytest.fixture
+def decoy_runs(monkeypatch):
+    runs = []
+
+    def run_command(event, log_fh, cmd, cwd=None, **kwargs):
+        runs.append(cwd)
+        time.sleep(0.2)
+        with open(os.path.join(cwd, cmd[cmd.index("-in") + 1]), "r") as fh:
+            data = fh.read()
+        with open(os.path.join(cwd, cmd[cmd.index("-out") + 1]), "w") as fh:
+            fh.write(data + data.replace(">", ">DECOY_"))
+        return 0
+
+    monkeypatch.setattr(workflow, "run_command", run_command)
+    return runs
+
+
+def write_fastas(tmp_path):
+    fastas = tmp_path / "fastas"
+    fastas.mkdir()
+    (fastas / "a.fasta").write_text(">P1\nPEPTIDE\n>P2\nPEPTIDEK\n")
+    (fastas / "b.fasta").write_text(">P2\nOTHER\n>P3\nPEPTIDER\n")
+    return [str(fastas / "a.fasta"), str(fastas / "b.fasta")]
+
+
+def build(tmp_path, name, fasta_filenames, db_cache):
+    cwd = tmp_path / name
+    cwd.mkdir()
+    with open(os.devnull, "w") as log_fh:
+        workflow.build_database(supervisor.Event(), log_fh, {}, str(cwd), fasta_filenames, \
+            "DB.fasta", "DB_with_decoys.fasta", db_cache)
+    return cwd
+
+
+def test_database_shared_between_projects(tmp_path, decoy_runs):
+    db_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    fasta_filenames = write_fastas(tmp_path)
+
+    first = build(tmp_path, "first", fasta_filenames, db_cache)
+    second = build(tmp_path, "second", fasta_filenames, db_cache)
+
+    # The first of the duplicate IDs is kept
+    assert (first / "DB.fasta").read_text() == ">P1\nPEPTIDE\n>P2\nPEPTIDEK\n>P3\nPEPTIDER\n"
+    assert decoy_runs == [str(first)]
+    for filename in ["DB.fasta", "DB_with_decoys.fasta"]:
+        assert (second / filename).read_text() == (first / filename).read_text()
+
+
+def test_database_keyed_by_file_order(tmp_path, decoy_runs):
+    db_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    fasta_filenames = write_fastas(tmp_path)
+
+    build(tmp_path, "first", fasta_filenames, db_cache)
+    second = build(tmp_path, "second", fasta_filenames[::-1], db_cache)
+
+    assert len(decoy_runs) == 2
+    assert (second / "DB.fasta").read_text() == ">P2\nOTHER\n>P3\nPEPTIDER\n>P1\nPEPTIDE\n"
+
+
+def test_concurrent_builds_wait_for_one(tmp_path, decoy_runs):
+    db_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    fasta_filenames = write_fastas(tmp_path)
+
+    threads = [threading.Thread(target=build, args=(tmp_path, name, fasta_filenames, db_cache)) \
+        for name in ["first", "second"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(decoy_runs) == 1
+    for name in ["first", "second"]:
+        assert (tmp_path / name / "DB_with_decoys.fasta").exists()
+
+
+def test_database_without_cache(tmp_path, decoy_runs):
+    cwd = build(tmp_path, "project", write_fastas(tmp_path), None)
+    assert decoy_runs == [str(cwd)]
+    assert (cwd / "DB_with_decoys.fasta").exists()
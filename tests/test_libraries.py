@@ -0,0 +1,43 @@
+import os
+
+import libraries
+
+
+def make_project(tmp_path, name):
+    cwd = str(tmp_path / name)
+    os.makedirs(cwd)
+    with open(os.path.join(cwd, "swaths.txt"), "w") as fh:
+        fh.write("400\t425\n425\t450\n")
+    return cwd
+
+
+def test_link_keeps_registered_times(tmp_path):
+    registry = libraries.LibraryRegistry(str(tmp_path / "libraries"))
+
+    first = make_project(tmp_path, "a")
+    library = os.path.join(first, libraries.LIBRARY_FILENAME)
+    with open(library, "w") as fh:
+        fh.write("<TraML/>\n")
+    os.utime(library, (1000.0, 1000.0))
+    registry.register("f" * 64, first, "a", "swaths.txt")
+
+    for name in ["b", "c"]:
+        cwd = make_project(tmp_path, name)
+        assert registry.link("f" * 64, cwd)
+        linked = os.path.join(cwd, libraries.LIBRARY_FILENAME)
+        assert os.stat(linked).st_nlink == 1
+        assert os.path.getmtime(linked) > 1000.0
+        with open(linked, "r") as fh:
+            assert fh.read() == "<TraML/>\n"
+
+    assert os.path.getmtime(library) == 1000.0
+    assert os.path.getmtime(registry.lookup("f" * 64)) == 1000.0
+
+    # The project the library was registered from keeps its own
+    assert registry.link("f" * 64, first)
+    assert os.path.getmtime(library) == 1000.0
+
+
+def test_link_unknown(tmp_path):
+    registry = libraries.LibraryRegistry(str(tmp_path / "libraries"))
+    assert not registry.link("0" * 64, make_project(tmp_path, "a"))
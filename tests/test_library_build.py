@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+import pytest
+
+import supervisor
+import workflow
+from progress import Progress
+
+
+def test_methods_built_side_by_side(tmp_path, monkeypatch):
+    cwd = str(tmp_path)
+    lock = threading.Lock()
+    commands = []
+    running = {"now": 0, "max": 0}
+
+    def run_command(event, log_fh, cmd, cwd=None, **kwargs):
+        if cmd[0].endswith("Mayu.pl"):
+            with open(os.path.join(cwd, "x_psm_protFDR0.01_t_1.07.csv"), "w") as fh:
+                fh.write("a,b,c,d,score\n1,2,3,4,0.5\n")
+            return 0
+        with lock:
+            commands.append(cmd)
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.3)
+        with lock:
+            running["now"] -= 1
+        return 0
+
+    monkeypatch.setattr(workflow, "run_command", run_command)
+
+    speclibs = {}
+    log_fh = open(os.devnull, "w")
+
+    def make_branch(method):
+        def branch(threads):
+            speclibs[method] = workflow.build_method_lib(supervisor.Event(), log_fh, cwd, \
+                method, [method + ".pep.xml"], "DECOY_", "DB.fasta", "iRT.txt", 0.01, 0.01, \
+                Progress(None, "percentage-indicator"), threads)
+        return branch
+
+    workflow.run_branches(supervisor.Event(), 4, [make_branch("lib"), make_branch("libfree")])
+    log_fh.close()
+
+    assert speclibs == {"lib": "SpecLib_lib.splib", "libfree": "SpecLib_libfree.splib"}
+    assert running["max"] == 2
+    logs = sorted(x for cmd in commands for x in cmd if x.startswith("-L"))
+    assert logs == ["-LSpecLib_lib.log", "-LSpecLib_libfree.log"]
+    assert all("-cP0.5" in cmd for cmd in commands)
+
+
+def test_branch_error_cancels_the_others():
+    event = supervisor.Event()
+    grants = []
+
+    def failing(threads):
+        grants.append(threads)
+        raise RuntimeError("failed")
+
+    def waiting(threads):
+        grants.append(threads)
+        event.wait(10)
+
+    t0 = time.time()
+    with pytest.raises(RuntimeError):
+        workflow.run_branches(event, 5, [failing, waiting])
+    assert time.time() - t0 < 5
+    assert sorted(grants) == [2, 3]
+    assert event.kill_flag
@@ -0,0 +1,108 @@
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import annotation
+import openswath
+import tables
+
+
+# The chunked reading of the OpenSwath results against a full read
+
+
+def write_openswath_result(filename):
+    rng = np.random.RandomState(2)
+    rows = []
+    samples = ["/data/sample%d.mzML" % i for i in range(4)]
+    for i in range(80):
+        peptide = "PEPT%sIDE" % "".join(rng.choice(list("ACDEFGHKLMN"), 4))
+        proteins = "/".join(["%d" % rng.randint(1, 3)] + ["P%03d" % x for x in rng.choice(50, rng.randint(1, 3))])
+        for charge in [2, 3][:rng.randint(1, 3)]:
+            for sample in samples:
+                if rng.rand() < 0.3:
+                    continue
+                rows.append({
+                    "transition_group_id": "%d_%s_%d" % (i, peptide, charge),
+                    "decoy": int(rng.rand() < 0.1),
+                    "ProteinName": proteins if i % 17 else "1/iRT_protein",
+                    "FullPeptideName": peptide.replace("C", "C(UniMod:4)"),
+                    "Sequence": peptide,
+                    "Charge": charge,
+                    "m/z": 500.5 + i,
+                    "Intensity": float(rng.randint(1, 10 ** 6)),
+                    "filename": sample,
+                    "m_score": rng.rand() / 100,
+                })
+    pd.DataFrame(rows).sample(frac=1, random_state=3).to_csv(filename, sep="\t", index=False)
+
+
+def read_rows(filename):
+
+    # The former row by row reading: the first value of a peptide in a
+    # sample is used, peptides in the order they first appear
+
+    df = pd.read_csv(filename, sep="\t")
+    df = df[openswath.is_target(df)]
+
+    entries = {}
+    filenames = []
+    for _, row in df.iterrows():
+        filename = os.path.basename(row["filename"])
+        if filename not in filenames:
+            filenames.append(filename)
+        entry = entries.setdefault((row["FullPeptideName"], str(row["Charge"])), {})
+        if filename not in entry:
+            entry[filename] = row
+
+    result = []
+    for entry in entries.values():
+        first = next(iter(entry.values()))
+        content = {
+            "FullPeptideName": first["FullPeptideName"],
+            "Sequence": first["Sequence"],
+            "Proteins": ";".join(first["ProteinName"].split("/")[1:]),
+        }
+        for filename in filenames:
+            content[filename] = entry[filename]["Intensity"] if filename in entry else 0.0
+        result.append(content)
+    return pd.DataFrame(result, columns=["FullPeptideName", "Sequence", "Proteins"] + filenames)
+
+
+def as_records(df):
+    return [tuple(x) for x in df.astype(object).itertuples(index=False)]
+
+
+@pytest.mark.parametrize("chunksize", [7, 100, openswath.CHUNK_ROWS])
+def test_read_openswathfile_chunked(tmp_path, monkeypatch, chunksize):
+    filename = str(tmp_path / "DIA-analysis-result.csv")
+    write_openswath_result(filename)
+    expected = read_rows(filename)
+
+    monkeypatch.setattr(openswath, "iter_targets", \
+        functools.partial(openswath.iter_targets, chunksize=chunksize))
+    df = annotation.read_openswathfile(None, None, None, filename)
+
+    assert list(df.columns) == list(expected.columns)
+    assert as_records(df) == as_records(expected)
+
+    if tables.pyarrow:
+        assert tables.convert(filename)
+        df = annotation.read_openswathfile(None, None, None, filename)
+        assert as_records(df) == as_records(expected)
+
+
+def test_reduce_output(tmp_path):
+    filename = str(tmp_path / "DIA-analysis-result.csv")
+    out_filename = str(tmp_path / "reduced.tsv")
+    write_openswath_result(filename)
+
+    openswath.reduce_output(None, filename, out_filename)
+
+    df = pd.read_csv(filename, sep="\t", dtype=str, keep_default_na=False)
+    expected = df[openswath.is_target(df)]
+    expected = expected[[x for x in openswath.SWATHS2STATS_COLUMNS if x in df.columns]]
+    assert pd.read_csv(out_filename, sep="\t", dtype=str, keep_default_na=False) \
+        .equals(expected.reset_index(drop=True))
@@ -0,0 +1,288 @@
+import os
+import threading
+import time
+
+import pytest
+
+import cache
+import pipeline
+import supervisor
+
+
+class Project:
+
+    # Two tasks, "search" writing search.txt from input.txt and "matrix"
+    # writing matrix.txt from search.txt, recording their runs
+
+    def __init__(self, cwd, artifact_cache=None):
+        self.cwd = str(cwd)
+        self.cache = artifact_cache
+        self.tolerance = 10
+        self.ran = []
+        self.on_change = []
+        with open(os.path.join(self.cwd, "input.txt"), "w") as fh:
+            fh.write("input\n")
+
+    def task(self, name, src, dst):
+        def func(progressData, threads):
+            self.ran.append(name)
+            with open(os.path.join(self.cwd, src), "r") as fh:
+                data = fh.read()
+            with open(os.path.join(self.cwd, dst), "w") as fh:
+                fh.write(data + name + " " + str(self.tolerance) + "\n")
+        return func
+
+    def run(self):
+        self.ran = []
+        self.on_change = []
+        with open(os.devnull, "w") as log_fh:
+            p = pipeline.Pipeline(supervisor.Event(), log_fh, None, self.cwd, 2, cache=self.cache)
+            p.add(pipeline.Task("search", self.task("search", "input.txt", "search.txt"), \
+                inputs=["input.txt"], outputs=["search.txt"], \
+                params=lambda: {"tolerance": self.tolerance}, \
+                on_change=lambda: self.on_change.append("search")))
+            p.add(pipeline.Task("matrix", self.task("matrix", "search.txt", "matrix.txt"), deps=["search"], \
+                inputs=["search.txt"], outputs=["matrix.txt"], \
+                on_change=lambda: self.on_change.append("matrix")))
+            return p.run()
+
+    def read(self, filename):
+        with open(os.path.join(self.cwd, filename), "r") as fh:
+            return fh.read()
+
+    def age(self, filename, seconds):
+        filepath = os.path.join(self.cwd, filename)
+        t = os.path.getmtime(filepath) - seconds
+        os.utime(filepath, (t, t))
+
+
+def test_runs_then_skips(tmp_path):
+    project = Project(tmp_path)
+    assert project.run()
+    assert project.ran == ["search", "matrix"]
+    assert project.read("matrix.txt") == "input\nsearch 10\nmatrix 10\n"
+
+    assert project.run()
+    assert project.ran == []
+
+
+def test_params_change_reruns_dependents(tmp_path):
+    project = Project(tmp_path)
+    project.run()
+
+    project.tolerance = 20
+    assert project.run()
+    assert project.ran == ["search", "matrix"]
+    assert project.on_change == ["search", "matrix"]
+    assert project.read("matrix.txt") == "input\nsearch 20\nmatrix 20\n"
+
+    assert project.run()
+    assert project.ran == []
+
+
+def test_rewritten_input_reruns_dependent(tmp_path):
+    project = Project(tmp_path)
+    project.run()
+
+    # Rewritten search output, the search itself is up to date
+    project.age("input.txt", 30)
+    project.age("search.txt", 10)
+    project.age("matrix.txt", 20)
+    assert project.run()
+    assert project.ran == ["matrix"]
+    assert project.on_change == ["matrix"]
+
+
+def test_missing_output_does_not_invalidate(tmp_path):
+    project = Project(tmp_path)
+    project.run()
+
+    os.remove(os.path.join(project.cwd, "search.txt"))
+    assert project.run()
+    assert project.ran == ["search", "matrix"]
+    # The search resumes, only the matrix sees a changed input
+    assert project.on_change == ["matrix"]
+
+
+def test_newer_input_invalidates(tmp_path):
+    project = Project(tmp_path)
+    project.run()
+
+    project.age("search.txt", 10)
+    project.age("matrix.txt", 10)
+    with open(os.path.join(project.cwd, "input.txt"), "a") as fh:
+        fh.write("more\n")
+    assert project.run()
+    assert project.ran == ["search", "matrix"]
+    assert project.on_change == ["search", "matrix"]
+
+
+def test_unrecorded_params_judged_by_files(tmp_path):
+    project = Project(tmp_path)
+    project.run()
+
+    # Recorded by a version that had no params for the task
+    os.remove(os.path.join(project.cwd, "task-params.json"))
+    project.tolerance = 20
+    assert project.run()
+    assert project.ran == []
+
+    project.tolerance = 30
+    assert project.run()
+    assert project.ran == ["search", "matrix"]
+
+
+def test_restored_from_cache(tmp_path):
+    artifact_cache = cache.ArtifactCache(str(tmp_path / "cache"))
+    for name in ["a", "b"]:
+        os.makedirs(str(tmp_path / name))
+
+    first = Project(tmp_path / "a", artifact_cache)
+    assert first.run()
+    assert first.ran == ["search", "matrix"]
+
+    second = Project(tmp_path / "b", artifact_cache)
+    assert second.run()
+    assert second.ran == []
+    assert second.read("matrix.txt") == first.read("matrix.txt")
+
+    # Restored outputs are not written through into the cache
+    second.tolerance = 20
+    assert second.run()
+    assert second.ran == ["search", "matrix"]
+    assert first.read("matrix.txt") == "input\nsearch 10\nmatrix 10\n"
+    assert second.read("matrix.txt") == "input\nsearch 20\nmatrix 20\n"
+
+
+def test_task_error_cancels_and_raises(tmp_path):
+    event = supervisor.Event()
+    started = []
+
+    def fail(progressData, threads):
+        raise RuntimeError("failed")
+
+    def wait(progressData, threads):
+        started.append(True)
+        event.wait(10)
+
+    with open(os.devnull, "w") as log_fh:
+        p = pipeline.Pipeline(event, log_fh, None, str(tmp_path), 2)
+        p.add(pipeline.Task("wait", wait, threads=1))
+        p.add(pipeline.Task("fail", fail, threads=1))
+        p.add(pipeline.Task("after", wait, deps=["fail"]))
+        t0 = time.time()
+        with pytest.raises(RuntimeError):
+            p.run()
+    assert time.time() - t0 < 5
+    assert started == [True]
+
+
+def test_thread_budget_split(tmp_path):
+    grants = {}
+
+    def task(name):
+        def func(progressData, threads):
+            grants[name] = threads
+        return func
+
+    with open(os.devnull, "w") as log_fh:
+        p = pipeline.Pipeline(supervisor.Event(), log_fh, None, str(tmp_path), 8)
+        p.add(pipeline.Task("small", task("small"), threads=2))
+        p.add(pipeline.Task("large", task("large")))
+        assert p.run()
+    assert grants == {"small": 2, "large": 6}
+
+
+def test_forced_task_reruns(tmp_path):
+    ran = []
+    forced = {"matrix": False}
+
+    def matrix(progressData, threads):
+        ran.append("matrix")
+        with open(str(tmp_path / "matrix.txt"), "w") as fh:
+            fh.write("matrix\n")
+
+    def run():
+        with open(os.devnull, "w") as log_fh:
+            p = pipeline.Pipeline(supervisor.Event(), log_fh, None, str(tmp_path), 1)
+            p.add(pipeline.Task("matrix", matrix, outputs=["matrix.txt"], \
+                on_change=lambda: ran.append("changed"), force=lambda: forced["matrix"]))
+            return p.run()
+
+    run()
+    run()
+    assert ran == ["matrix"]
+
+    forced["matrix"] = True
+    run()
+    assert ran == ["matrix", "changed", "matrix"]
+
+
+def test_independent_tasks_run_together(tmp_path):
+    together = threading.Barrier(2, timeout=5)
+    order = []
+
+    def independent(name):
+        def func(progressData, threads):
+            together.wait()
+            order.append(name)
+        return func
+
+    def joined(progressData, threads):
+        order.append("joined")
+
+    with open(os.devnull, "w") as log_fh:
+        p = pipeline.Pipeline(supervisor.Event(), log_fh, None, str(tmp_path), 2)
+        p.add(pipeline.Task("database", independent("database"), threads=1))
+        p.add(pipeline.Task("convert", independent("convert"), threads=1))
+        p.add(pipeline.Task("joined", joined, deps=["database", "convert"]))
+        assert p.run()
+    assert sorted(order[:2]) == ["convert", "database"]
+    assert order[2:] == ["joined"]
+
+
+SEARCHES = ["interact_comet_pep", "interact_comet_pseudo_pep", "interact_xtandem_pep", "interact_xtandem_pseudo_pep"]
+
+
+def test_searches_share_the_thread_budget(tmp_path):
+    together = threading.Barrier(len(SEARCHES), timeout=5)
+    grants = {}
+
+    def search(name):
+        def func(progressData, threads):
+            grants[name] = threads
+            together.wait()
+        return func
+
+    def speclib(progressData, threads):
+        grants["speclib"] = threads
+
+    with open(os.devnull, "w") as log_fh:
+        p = pipeline.Pipeline(supervisor.Event(), log_fh, None, str(tmp_path), 8)
+        for name in SEARCHES:
+            p.add(pipeline.Task(name, search(name)))
+        p.add(pipeline.Task("speclib", speclib, deps=SEARCHES))
+        assert p.run()
+    assert grants == dict([(x, 2) for x in SEARCHES] + [("speclib", 8)])
+
+
+def test_cancelled_search_stops_the_others(tmp_path):
+    event = supervisor.Event()
+    ran = []
+
+    def search(progressData, threads):
+        event.wait(10)
+
+    def cancelled(progressData, threads):
+        event.kill()
+
+    with open(os.devnull, "w") as log_fh:
+        p = pipeline.Pipeline(event, log_fh, None, str(tmp_path), 4)
+        for name in SEARCHES[:-1]:
+            p.add(pipeline.Task(name, search))
+        p.add(pipeline.Task(SEARCHES[-1], cancelled))
+        p.add(pipeline.Task("speclib", lambda progressData, threads: ran.append("speclib"), deps=SEARCHES))
+        t0 = time.time()
+        assert not p.run()
+    assert time.time() - t0 < 5
+    assert ran == []
@@ -0,0 +1,176 @@
+import collections
+import threading
+import time
+
+import resources
+import supervisor
+
+
+def reserve_in_thread(budget, nbytes, event=None, owner=None):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(reserved=budget.reserve(nbytes, event, owner)))
+    thread.start()
+    return thread, result
+
+
+def test_admission():
+    budget = resources.MemoryBudget(100)
+    assert budget.try_reserve(60) == 60
+    assert budget.try_reserve(50) is None
+    assert budget.try_reserve(40) == 40
+    assert budget.try_reserve(1) is None
+
+    budget.release(60)
+    assert budget.reserved == 40
+    assert budget.try_reserve(60) == 60
+
+
+def test_job_larger_than_budget_runs_alone():
+    budget = resources.MemoryBudget(100)
+    assert budget.try_reserve(500) == 100
+    assert budget.try_reserve(1) is None
+    budget.release(100)
+    assert budget.reserved == 0
+
+
+def test_owner_shares():
+    budget = resources.MemoryBudget(100)
+    first, second = object(), object()
+    budget.owner_limit = lambda owner: 50
+
+    # The first job of an owner is admitted past its share
+    assert budget.try_reserve(70, first) == 70
+    assert budget.try_reserve(10, first) is None
+    assert budget.try_reserve(20, second) == 20
+    assert budget.try_reserve(20, second) is None
+
+    budget.owner_limit = lambda owner: None
+    assert budget.try_reserve(10, first) == 10
+    assert budget.owners[first] == 80
+
+
+def test_reservation_woken_by_release():
+    budget = resources.MemoryBudget(100)
+    budget.reserve(80)
+    thread, result = reserve_in_thread(budget, 50, supervisor.Event())
+    time.sleep(0.2)
+    assert thread.is_alive()
+
+    t0 = time.time()
+    budget.release(80)
+    thread.join(5)
+    assert result["reserved"] == 50
+    assert time.time() - t0 < 0.2
+
+
+def test_reservation_woken_by_kill():
+    budget = resources.MemoryBudget(100)
+    budget.reserve(100)
+    event = supervisor.Event()
+    thread, result = reserve_in_thread(budget, 50, event)
+    time.sleep(0.2)
+    assert thread.is_alive()
+
+    t0 = time.time()
+    event.kill()
+    thread.join(5)
+    assert result["reserved"] is None
+    assert time.time() - t0 < 0.2
+    assert budget.reserved == 100
+    assert not event.callbacks
+
+
+def test_reservation_of_killed_event():
+    budget = resources.MemoryBudget(100)
+    event = supervisor.Event()
+    event.kill()
+    budget.reserve(100)
+    assert budget.reserve(50, event) is None
+
+
+def test_reservation_woken_by_share_change():
+    budget = resources.MemoryBudget(100)
+    first, second = object(), object()
+    shares = {"limit": 30}
+    budget.owner_limit = lambda owner: shares["limit"]
+    budget.reserve(30, None, first)
+    thread, result = reserve_in_thread(budget, 30, supervisor.Event(), first)
+    time.sleep(0.2)
+    assert thread.is_alive()
+
+    shares["limit"] = 100
+    budget.notify()
+    thread.join(5)
+    assert result["reserved"] == 30
+
+
+def test_budget_is_the_memory_limit(monkeypatch):
+    monkeypatch.setattr(resources, "cgroup_memory_limit", lambda: (2 * resources.GB, resources.GB))
+    assert resources.memory_limit() == min(2 * resources.GB, resources.psutil.virtual_memory().total)
+    assert resources.MemoryBudget().total == resources.memory_limit()
+
+    # Not what happens to be available at the time
+    monkeypatch.setattr(resources, "cgroup_memory_limit", lambda: (None, None))
+    assert resources.MemoryBudget().total == resources.psutil.virtual_memory().total
+
+
+def fake_cgroup(monkeypatch, files):
+    monkeypatch.setattr(resources, "read_cgroup_file", lambda controller, filename: files.get((controller, filename)))
+
+
+def test_cgroup_v2_cpu_limit(monkeypatch):
+    fake_cgroup(monkeypatch, {(None, "cpu.max"): "250000 100000"})
+    assert resources.cgroup_cpu_limit() == 2.5
+
+    fake_cgroup(monkeypatch, {(None, "cpu.max"): "max 100000"})
+    assert resources.cgroup_cpu_limit() is None
+
+
+def test_cgroup_v1_cpu_limit(monkeypatch):
+    fake_cgroup(monkeypatch, {("cpu", "cpu.cfs_quota_us"): "400000", ("cpu", "cpu.cfs_period_us"): "100000"})
+    assert resources.cgroup_cpu_limit() == 4
+
+    fake_cgroup(monkeypatch, {("cpu", "cpu.cfs_quota_us"): "-1", ("cpu", "cpu.cfs_period_us"): "100000"})
+    assert resources.cgroup_cpu_limit() is None
+
+    fake_cgroup(monkeypatch, {})
+    assert resources.cgroup_cpu_limit() is None
+
+
+def test_available_cpus(monkeypatch):
+    monkeypatch.setattr(resources, "affinity_cpus", lambda: 128)
+    fake_cgroup(monkeypatch, {(None, "cpu.max"): "1550000 100000"})
+    assert resources.available_cpus() == 16
+
+    monkeypatch.setattr(resources, "affinity_cpus", lambda: 8)
+    assert resources.available_cpus() == 8
+
+    fake_cgroup(monkeypatch, {(None, "cpu.max"): "50000 100000"})
+    assert resources.available_cpus() == 1
+
+
+def test_cgroup_v2_memory_limit(monkeypatch):
+    fake_cgroup(monkeypatch, {(None, "memory.max"): str(64 * resources.GB), (None, "memory.current"): str(resources.GB)})
+    assert resources.cgroup_memory_limit() == (64 * resources.GB, resources.GB)
+
+    fake_cgroup(monkeypatch, {(None, "memory.max"): "max", (None, "memory.current"): str(resources.GB)})
+    assert resources.cgroup_memory_limit() == (None, None)
+
+
+def test_cgroup_v1_memory_limit(monkeypatch):
+    fake_cgroup(monkeypatch, {("memory", "memory.limit_in_bytes"): str(4 * resources.GB)})
+    assert resources.cgroup_memory_limit() == (4 * resources.GB, 0)
+
+    # No limit is a huge page aligned number in v1
+    fake_cgroup(monkeypatch, {("memory", "memory.limit_in_bytes"): "9223372036854771712", \
+        ("memory", "memory.usage_in_bytes"): str(resources.GB)})
+    assert resources.cgroup_memory_limit() == (None, None)
+
+
+def test_available_memory_within_limit(monkeypatch):
+    memory = collections.namedtuple("memory", ["total", "available"])
+    monkeypatch.setattr(resources.psutil, "virtual_memory", lambda: memory(16 * resources.GB, 8 * resources.GB))
+    fake_cgroup(monkeypatch, {(None, "memory.max"): str(3 * resources.GB), (None, "memory.current"): str(resources.GB)})
+    assert resources.available_memory() == 2 * resources.GB
+    assert resources.memory_limit() == 3 * resources.GB
+    assert "cgroup limit 3.0 GB" in resources.describe_resources()
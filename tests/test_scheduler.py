@@ -0,0 +1,95 @@
+import pytest
+
+import resources
+import supervisor
+from scheduler import AnalysisScheduler
+
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    budget = resources.MemoryBudget(8 * resources.GB)
+    monkeypatch.setattr(resources, "memory_budget", budget)
+    return budget
+
+
+def submit(scheduler, started, project, priority=0):
+    event = supervisor.Event()
+    return scheduler.submit(project, lambda: started.append(project), event, priority), event
+
+
+def test_analyses_queued_past_max_running():
+    scheduler = AnalysisScheduler(max_running=2, threads=8)
+    started = []
+    for project in ["a", "b", "c"]:
+        assert submit(scheduler, started, project)[0]
+
+    assert started == ["a", "b"]
+    assert scheduler.queue_position("c") == 1
+    assert scheduler.queue_position("a") is None
+    assert scheduler.threads_for("a") == 4
+
+    scheduler.finished("a")
+    assert started == ["a", "b", "c"]
+    assert scheduler.queue_position("c") is None
+    assert not scheduler.is_active("a")
+    assert scheduler.is_active("c")
+
+
+def test_duplicate_rejected():
+    scheduler = AnalysisScheduler(max_running=1)
+    started = []
+    assert submit(scheduler, started, "a")[0]
+    assert submit(scheduler, started, "b")[0]
+
+    # Both while running and while queued
+    assert not submit(scheduler, started, "a")[0]
+    assert not submit(scheduler, started, "b")[0]
+    assert started == ["a"]
+
+
+def test_priority_order():
+    scheduler = AnalysisScheduler(max_running=1)
+    started = []
+    submit(scheduler, started, "running")
+    submit(scheduler, started, "low1")
+    submit(scheduler, started, "high", priority=5)
+    submit(scheduler, started, "low2")
+
+    assert [scheduler.queue_position(x) for x in ["high", "low1", "low2"]] == [1, 2, 3]
+    for project in ["running", "high", "low1"]:
+        scheduler.finished(project)
+    assert started == ["running", "high", "low1", "low2"]
+
+
+def test_cancel_queued():
+    scheduler = AnalysisScheduler(max_running=1)
+    started = []
+    submit(scheduler, started, "a")
+    submit(scheduler, started, "b")
+
+    assert not scheduler.cancel("a")
+    assert scheduler.cancel("b")
+    assert not scheduler.cancel("b")
+    scheduler.finished("a")
+    assert started == ["a"]
+
+
+def test_fair_shares(budget):
+    scheduler = AnalysisScheduler(max_running=2, threads=9)
+    started = []
+    ok, a = submit(scheduler, started, "a")
+    assert scheduler.threads_for("a") == 9
+    assert budget.owner_limit(a) == 8 * resources.GB
+
+    ok, b = submit(scheduler, started, "b")
+    ok, c = submit(scheduler, started, "c")
+    assert scheduler.threads_for("a") == 4
+    assert budget.owner_limit(a) == 4 * resources.GB
+    assert budget.owner_limit(b) == 4 * resources.GB
+    assert budget.owner_limit(c) is None
+
+    # The shares grow again when an analysis finishes
+    scheduler.finished("b")
+    scheduler.finished("c")
+    assert scheduler.threads_for("a") == 9
+    assert budget.owner_limit(a) == 8 * resources.GB
@@ -0,0 +1,147 @@
+import os
+
+import pytest
+
+import supervisor
+import workflow
+from fake_tools import FakeTools
+
+
+COMET = '''cfg="${1#-P}"
+grep '^num_threads' "$cfg" | tr -d ' ' > "${2%.*}.threads"
+touch "${2%.*}.pep.xml"
+'''
+
+
+@pytest.fixture
+def xinteract(monkeypatch):
+    commands = []
+
+    def run_command(event, log_fh, cmd, cwd=None, **kwargs):
+        commands.append(cmd)
+        return 0
+
+    monkeypatch.setattr(workflow, "run_command", run_command)
+    return commands
+
+
+def install(monkeypatch, tools):
+    monkeypatch.setattr(supervisor, "_task_executor", tools)
+
+
+def make_samples(tmp_path, names):
+    data = tmp_path / "data"
+    data.mkdir()
+    filenames = []
+    for name in names:
+        (data / name).write_text(name + "\n")
+        filenames.append(str(data / name))
+    return filenames
+
+
+def test_comet_workers(tmp_path, monkeypatch, xinteract):
+    cwd = tmp_path / "project"
+    cwd.mkdir()
+    (cwd / "comet.params").write_text("database_name = DB.fasta\nnum_threads = 0\n")
+    tools = FakeTools(tmp_path, {"comet-ms": COMET})
+    install(monkeypatch, tools)
+    samples = make_samples(tmp_path, ["a.mzXML", "b.mzXML", "c.mzXML", "d.mzXML"])
+
+    with open(os.devnull, "w") as log_fh:
+        workflow.runComet(supervisor.Event(), log_fh, None, str(cwd), str(cwd / "comet.params"), \
+            samples, ["d.pep.xml"], "comet.pep.xml", str(tmp_path), threads=5, workers=2)
+
+    # d is already searched, the other three share two slots of 3 and 2 threads
+
+    assert sorted(cmd[-1] for cmd in tools.commands) == ["a.mzXML", "b.mzXML", "c.mzXML"]
+    assert tools.concurrency() == 2
+    cfgs = sorted(set(cmd[1] for cmd in tools.commands))
+    assert cfgs == ["-P" + str(cwd / "comet.pep.comet.worker1.xml"), "-P" + str(cwd / "comet.pep.comet.worker2.xml")]
+    assert (cwd / "comet.pep.comet.worker1.xml").read_text() == "database_name = DB.fasta\nnum_threads = 3\n"
+    assert (cwd / "comet.pep.comet.worker2.xml").read_text() == "database_name = DB.fasta\nnum_threads = 2\n"
+    assert (cwd / "comet.params").read_text() == "database_name = DB.fasta\nnum_threads = 0\n"
+    for name in ["a", "b", "c"]:
+        assert (cwd / (name + ".threads")).read_text().strip() in ["num_threads=3", "num_threads=2"]
+    assert len(xinteract) == 1
+    assert xinteract[0][-4:] == ["a.pep.xml", "b.pep.xml", "c.pep.xml", "d.pep.xml"]
+
+
+def test_comet_single_worker_uses_settings(tmp_path, monkeypatch, xinteract):
+    cwd = tmp_path / "project"
+    cwd.mkdir()
+    (cwd / "comet.params").write_text("num_threads = 0\n")
+    tools = FakeTools(tmp_path, {"comet-ms": COMET}, delay=0)
+    install(monkeypatch, tools)
+    samples = make_samples(tmp_path, ["a.mzXML", "b.mzXML"])
+
+    with open(os.devnull, "w") as log_fh:
+        workflow.runComet(supervisor.Event(), log_fh, None, str(cwd), str(cwd / "comet.params"), \
+            samples, [], "comet.pep.xml", str(tmp_path))
+
+    assert [cmd[1] for cmd in tools.commands] == ["-P" + str(cwd / "comet.params")] * 2
+    assert not (cwd / "comet.pep.comet.worker1.xml").exists()
+
+
+def test_comet_error_fails(tmp_path, monkeypatch, xinteract):
+    cwd = tmp_path / "project"
+    cwd.mkdir()
+    (cwd / "comet.params").write_text("num_threads = 0\n")
+    tools = FakeTools(tmp_path, {"comet-ms": 'case "$2" in b*) exit 3 ;; esac'}, delay=0)
+    install(monkeypatch, tools)
+    samples = make_samples(tmp_path, ["a.mzXML", "b.mzXML"])
+
+    with open(os.devnull, "w") as log_fh:
+        with pytest.raises(workflow.NonZeroReturnValueException):
+            workflow.runComet(supervisor.Event(), log_fh, {}, str(cwd), \
+                str(cwd / "comet.params"), samples, [], "comet.pep.xml", str(tmp_path), workers=2)
+    assert xinteract == []
+
+
+TANDEM = '''case "$2" in
+    b.*) sleep 1 ;;
+esac
+touch "$2"
+'''
+
+TANDEM2XML = '''test -f "$1" && touch "$2"
+'''
+
+
+def test_tandem2xml_overlaps_searches(tmp_path, monkeypatch, xinteract):
+    cwd = tmp_path / "project"
+    cwd.mkdir()
+    tools = FakeTools(tmp_path, {"tandem": TANDEM, "Tandem2XML": TANDEM2XML})
+    install(monkeypatch, tools)
+    samples = make_samples(tmp_path, ["a.mzXML", "b.mzXML", "c.mzXML"])
+
+    with open(os.devnull, "w") as log_fh:
+        workflow.runXTandem(supervisor.Event(), log_fh, None, str(cwd), "default_input.xml", "DB.fasta", \
+            samples, ["c.tandem.pep.xml"], "tandem.pep.xml", str(tmp_path), False, threads=4, workers=2)
+
+    # a converts while the slower search of b still runs
+
+    assert tools.concurrency(["tandem"]) == 2
+    assert tools.started_while_running("tandem", "Tandem2XML")
+    assert sorted(cmd[-1] for cmd in tools.commands if cmd[0].endswith("Tandem2XML")) == \
+        ["a.tandem.pep.xml", "b.tandem.pep.xml"]
+    assert (cwd / "a.tandem.pep.xml").exists() and (cwd / "b.tandem.pep.xml").exists()
+    for cmd in tools.commands:
+        if cmd[0].endswith("/tandem"):
+            with open(cmd[1], "r") as fh:
+                assert '<note type="input" label="spectrum, threads">2</note>' in fh.read()
+    assert len(xinteract) == 1
+    assert sorted(xinteract[0][-3:]) == ["a.tandem.pep.xml", "b.tandem.pep.xml", "c.tandem.pep.xml"]
+
+
+def test_tandem2xml_error_fails(tmp_path, monkeypatch, xinteract):
+    cwd = tmp_path / "project"
+    cwd.mkdir()
+    tools = FakeTools(tmp_path, {"tandem": TANDEM, "Tandem2XML": "exit 2"}, delay=0)
+    install(monkeypatch, tools)
+    samples = make_samples(tmp_path, ["a.mzXML", "b.mzXML"])
+
+    with open(os.devnull, "w") as log_fh:
+        with pytest.raises(workflow.NonZeroReturnValueException):
+            workflow.runXTandem(supervisor.Event(), log_fh, {}, str(cwd), "default_input.xml", "DB.fasta", \
+                samples, [], "tandem.pep.xml", str(tmp_path), False, workers=2)
+    assert xinteract == []
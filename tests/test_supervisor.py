@@ -0,0 +1,131 @@
+import threading
+import time
+
+import resources
+import supervisor
+
+
+def kill_later(event, delay):
+    timer = threading.Timer(delay, event.kill)
+    timer.start()
+    return timer
+
+
+def test_run_command_returncode():
+    assert supervisor.run_command(None, None, ["true"]) == 0
+    assert supervisor.run_command(None, None, "exit 3", shell=True) == 3
+
+
+def test_run_command_cancel_latency():
+    event = supervisor.Event()
+    kill_later(event, 0.2)
+    t0 = time.time()
+    assert supervisor.run_command(event, None, ["sleep", "60"]) is None
+    assert time.time() - t0 < 1
+
+
+def test_wait_processes_returns_first_exited():
+    procs = [supervisor.start_process(None, ["sleep", str(t)]) for t in ["0.1", "60"]]
+    try:
+        exited = supervisor.wait_processes(supervisor.Event(), procs)
+        assert exited == [procs[0]]
+        assert procs[0].returncode == 0
+    finally:
+        supervisor.kill_processes(procs)
+
+
+def test_kill_callbacks():
+    event = supervisor.Event()
+    calls = []
+    callback = lambda: calls.append("killed")
+    event.add_kill_callback(callback)
+    event.kill()
+    event.kill()
+    assert calls == ["killed"]
+
+    # Registered after the kill, called at once
+    event.add_kill_callback(callback)
+    assert calls == ["killed", "killed"]
+
+    event.reset()
+    assert not event.kill_flag
+    event.remove_kill_callback(callback)
+    event.remove_kill_callback(callback)
+    event.kill()
+    assert calls == ["killed", "killed"]
+
+
+def test_process_pool_limits_workers(tmp_path):
+    pool = supervisor.ProcessPool(supervisor.Event(), None, 2)
+    returncodes = []
+    for i in range(5):
+        marker = str(tmp_path / str(i))
+        pool.submit(lambda slot, marker=marker: "echo %d > %s; sleep 0.2" % (slot, marker), \
+            on_exit=returncodes.append, shell=True)
+
+    t0 = time.time()
+    assert pool.run()
+    assert returncodes == [0] * 5
+    assert time.time() - t0 >= 0.6
+    for i in range(5):
+        with open(str(tmp_path / str(i))) as fh:
+            assert int(fh.read()) in [0, 1]
+
+
+def test_process_pool_on_exit_submits():
+    pool = supervisor.ProcessPool(supervisor.Event(), None, 1)
+    pool.add_lane("convert", 1)
+    order = []
+
+    def searched(returncode):
+        order.append("search")
+        pool.submit(["true"], on_exit=lambda returncode: order.append("convert"), lane="convert")
+
+    pool.submit(["true"], on_exit=searched)
+    assert pool.run()
+    assert order == ["search", "convert"]
+
+
+def test_process_pool_cancel_latency():
+    event = supervisor.Event()
+    pool = supervisor.ProcessPool(event, None, 2)
+    for i in range(4):
+        pool.submit(["sleep", "60"])
+    kill_later(event, 0.2)
+    t0 = time.time()
+    assert pool.run() is False
+    assert time.time() - t0 < 1
+    assert not pool.running and not pool.has_pending()
+
+
+def test_memory_reservation_cancel_latency():
+    budget = resources.MemoryBudget(100)
+    assert budget.reserve(100) == 100
+
+    event = supervisor.Event()
+    kill_later(event, 0.2)
+    t0 = time.time()
+    assert budget.reserve(50, event) is None
+    assert time.time() - t0 < 0.5
+    assert budget.reserved == 100
+
+
+def test_memory_reservation_woken_by_release():
+    budget = resources.MemoryBudget(100)
+    budget.reserve(80)
+    threading.Timer(0.2, budget.release, [80]).start()
+    t0 = time.time()
+    assert budget.reserve(50, supervisor.Event()) == 50
+    assert time.time() - t0 < 0.5
+
+
+def test_process_pool_releases_memory():
+    budget = resources.MemoryBudget(100)
+    pool = supervisor.ProcessPool(supervisor.Event(), None, 4, memory_budget=budget)
+    for i in range(3):
+        pool.submit(["sleep", "0.2"], memory=60)
+    t0 = time.time()
+    assert pool.run()
+    # Only one of the jobs fits at a time
+    assert time.time() - t0 >= 0.6
+    assert budget.reserved == 0
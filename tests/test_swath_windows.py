@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+
+import supervisor
+import workflow
+
+
+def write_mzML(filepath, targets, repeats=1):
+    spectra = []
+    for i in range(repeats):
+        for target in targets:
+            spectra.append('''
+  <spectrum>
+    <precursorList><precursor>
+      <isolationWindow>
+        <cvParam name="isolation window target m/z" value="%s"/>
+        <cvParam name="isolation window lower offset" value="12.5"/>
+        <cvParam name="isolation window upper offset" value="12.5"/>
+      </isolationWindow>
+      <selectedIonList><selectedIon>
+        <cvParam name="selected ion m/z" value="%s"/>
+      </selectedIon></selectedIonList>
+    </precursor></precursorList>
+  </spectrum>''' % (target, target))
+    with open(filepath, "w") as fh:
+        fh.write('<mzML xmlns="http://psi.hupo.org/ms/mzml"><run><spectrumList>%s\n</spectrumList></run></mzML>\n' \
+            % "".join(spectra))
+
+
+def test_read_in_processes(tmp_path, monkeypatch):
+    cwd = str(tmp_path)
+    files = [os.path.join(cwd, "sample%d.mzML" % i) for i in range(4)]
+    for filepath in files[:3]:
+        write_mzML(filepath, ["412.5", "437.5"])
+    write_mzML(files[3], ["412.5", "462.5"])
+
+    # Read from a thread, as the pipeline does
+    result = {}
+    thread = threading.Thread(target=lambda: result.update( \
+        windows=workflow.read_all_swath_windows(supervisor.Event(), cwd, files, 4)))
+    thread.start()
+    thread.join(60)
+
+    windows = result["windows"]
+    assert windows[files[0]] == {"412.5": ["12.5", "12.5"], "437.5": ["12.5", "12.5"]}
+    assert workflow.mismatching_swath_windows(files, windows) == [files[3]]
+
+    with open(os.path.join(cwd, workflow.SWATH_WINDOWS_CACHE), "r") as fh:
+        assert len(json.load(fh)) == 4
+
+    # Remembered, the files are not read again
+    def read_swath_windows(dia_mzML):
+        raise AssertionError(dia_mzML + " read again")
+    monkeypatch.setattr(workflow, "read_swath_windows", read_swath_windows)
+    assert workflow.read_all_swath_windows(None, cwd, files, 4) == windows
+
+
+def test_cancelled_read(tmp_path):
+    cwd = str(tmp_path)
+    files = [os.path.join(cwd, "sample%d.mzML" % i) for i in range(3)]
+    for filepath in files:
+        write_mzML(filepath, ["412.5", "437.5"])
+
+    event = supervisor.Event()
+    event.kill()
+    assert workflow.read_all_swath_windows(event, cwd, files, 1) is None
+    assert workflow.read_all_swath_windows(event, cwd, files, 3) is None
@@ -0,0 +1,119 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import tables
+import workflow
+
+pytestmark = pytest.mark.skipif(not tables.pyarrow, reason="pyarrow is not installed")
+
+
+def make_table():
+    return pd.DataFrame({
+        "Protein": ["P1", "P2", "P3", "0123"],
+        "sample1": [1.5, np.nan, 3.0, 4.0],
+        "sample2": [10, 20, 30, 40],
+    })
+
+
+def age(filepath, seconds):
+    t = os.path.getmtime(filepath) - seconds
+    os.utime(filepath, (t, t))
+
+
+def test_write_and_read(tmp_path):
+    filename = str(tmp_path / "matrix.tsv")
+    tables.write_table(make_table(), filename)
+    assert os.path.isfile(str(tmp_path / "matrix.parquet"))
+    assert tables.has_copy(filename)
+
+    text = pd.read_csv(filename, sep="\t", dtype={"Protein": str})
+    df = tables.read_table(filename, dtype={"Protein": str})
+    # Newer pandas read str as a string dtype, the copy as object
+    pd.testing.assert_frame_equal(df, text, check_dtype=False)
+
+    df = tables.read_table(filename, columns=["sample2"], index_col=0)
+    pd.testing.assert_frame_equal(df, text.set_index("Protein")[["sample2"]])
+    assert tables.read_header(filename) == ["Protein", "sample1", "sample2"]
+
+
+def test_stale_copy_not_read(tmp_path):
+    filename = str(tmp_path / "matrix.tsv")
+    tables.write_table(make_table(), filename)
+    age(tables.copy_filename(filename), 10)
+
+    # Replaced after the copy was written, e.g. restored from the cache
+    df = make_table()
+    df["sample2"] = [1, 2, 3, 4]
+    df.to_csv(filename, sep="\t", index=False)
+    assert not tables.has_copy(filename)
+    assert tables.read_table(filename)["sample2"].tolist() == [1, 2, 3, 4]
+
+    assert tables.convert(filename)
+    assert tables.has_copy(filename)
+    assert pd.read_parquet(tables.copy_filename(filename))["sample2"].tolist() == [1, 2, 3, 4]
+
+
+def test_copy_of_same_age_is_read(tmp_path):
+    filename = str(tmp_path / "matrix.tsv")
+    tables.write_table(make_table(), filename)
+    st = os.stat(filename)
+    os.utime(tables.copy_filename(filename), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert tables.has_copy(filename)
+
+    os.remove(filename)
+    assert not tables.has_copy(filename)
+
+
+def test_convert_streams_blocks(tmp_path, monkeypatch):
+    filename = str(tmp_path / "DIA-analysis-result.csv")
+    df = pd.DataFrame({
+        "transition_group_id": ["%d_PEPTIDE_2" % i for i in range(5000)],
+        "Intensity": np.arange(5000) * 1.5,
+    })
+    df.to_csv(filename, sep="\t", index=False)
+
+    monkeypatch.setattr(tables, "BLOCK_SIZE", 4096)
+    assert tables.convert(filename)
+    copy = pd.read_parquet(tables.copy_filename(filename))
+    assert copy["transition_group_id"].tolist() == df["transition_group_id"].tolist()
+    assert copy["Intensity"].tolist() == df["Intensity"].tolist()
+
+    batches = list(tables.iter_batches(filename, ["Intensity"], batch_size=1000))
+    assert [len(x) for x in batches] == [1000] * 5
+
+
+def test_unconvertible_table_read_as_text(tmp_path, monkeypatch):
+    filename = str(tmp_path / "matrix.tsv")
+    with open(filename, "w") as fh:
+        fh.write("Protein\tvalue\n" + "".join("P%d\t%d\n" % (i, i) for i in range(2000)) + "P\tx\n")
+
+    # The type of the last block differs from that of the first
+    monkeypatch.setattr(tables, "BLOCK_SIZE", 1024)
+    assert not tables.convert(filename)
+    assert not os.path.exists(tables.copy_filename(filename))
+    assert not [x for x in os.listdir(str(tmp_path)) if x != "matrix.tsv"]
+    assert tables.read_table(filename)["value"].iloc[-1] == "x"
+
+
+def test_copy_result_tables(tmp_path):
+    cwd = str(tmp_path)
+    for name in ["DIA-peptide-matrix.tsv", "DIA-protein-matrix.tsv"]:
+        make_table().to_csv(os.path.join(cwd, name), sep="\t", index=False)
+
+    with open(os.devnull, "w") as log_fh:
+        workflow.copy_result_tables(None, log_fh, cwd, [])
+    for name in ["DIA-peptide-matrix.tsv", "DIA-protein-matrix.tsv"]:
+        assert tables.has_copy(os.path.join(cwd, name))
+
+    # Only the table replaced since is copied again
+    mtime = os.stat(os.path.join(cwd, "DIA-protein-matrix.parquet")).st_mtime_ns
+    make_table().to_csv(os.path.join(cwd, "DIA-peptide-matrix.tsv"), sep="\t", index=False)
+    age(os.path.join(cwd, "DIA-peptide-matrix.parquet"), 10)
+    with open(os.devnull, "w") as log_fh:
+        workflow.copy_result_tables(None, log_fh, cwd, [])
+    assert tables.has_copy(os.path.join(cwd, "DIA-peptide-matrix.tsv"))
+    assert os.stat(os.path.join(cwd, "DIA-protein-matrix.parquet")).st_mtime_ns == mtime
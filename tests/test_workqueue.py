@@ -0,0 +1,167 @@
+import io
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+import workqueue
+
+
+# Runs tasks through two workqueue.py workers on localhost sharing a
+# temporary queue folder, as the workers on several machines would share
+# /run-files/.queue
+
+WORKQUEUE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "workqueue.py")
+
+
+def start_worker(queue_dir, jobs=1):
+    return subprocess.Popen([sys.executable, WORKQUEUE, "--queue-dir", queue_dir, "--jobs", str(jobs)], \
+        stdout=subprocess.DEVNULL)
+
+
+def wait_for(proc, timeout=20):
+    t0 = time.time()
+    while proc.poll() is None:
+        assert time.time() - t0 < timeout, "task did not finish"
+        time.sleep(0.05)
+    return proc.returncode
+
+
+@pytest.fixture
+def workers(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    procs = [start_worker(queue_dir), start_worker(queue_dir)]
+    yield queue_dir, procs
+    for proc in procs:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+
+
+def test_tasks_run_on_both_workers(workers, tmp_path):
+    queue_dir, procs = workers
+    executor = workqueue.QueueExecutor(queue_dir)
+
+    logs = [io.StringIO() for i in range(4)]
+    tasks = [executor.start(log, "sleep 1; echo task " + str(i), cwd=str(tmp_path), shell=True) \
+        for i, log in enumerate(logs)]
+
+    assert [wait_for(task) for task in tasks] == [0, 0, 0, 0]
+
+    names = set()
+    for i, log in enumerate(logs):
+        assert "task " + str(i) + "\n" in log.getvalue()
+        names.update(line.split()[1] for line in log.getvalue().splitlines() if line.startswith("Worker "))
+    assert names == set("%s-%d" % (os.uname()[1], proc.pid) for proc in procs)
+
+    assert os.listdir(os.path.join(queue_dir, "running")) == []
+    assert os.listdir(os.path.join(queue_dir, "done")) == []
+
+
+def test_cancel_running_task(workers, tmp_path):
+    queue_dir, procs = workers
+    executor = workqueue.QueueExecutor(queue_dir)
+
+    task = executor.start(None, ["sleep", "60"], cwd=str(tmp_path))
+    while not os.listdir(os.path.join(queue_dir, "running")):
+        time.sleep(0.05)
+
+    t0 = time.time()
+    task.kill()
+    assert wait_for(task) == -signal.SIGKILL
+    assert time.time() - t0 < 5
+
+
+def test_task_of_dead_worker_fails(tmp_path, monkeypatch):
+    monkeypatch.setattr(workqueue, "WORKER_TIMEOUT", 2)
+    queue_dir = str(tmp_path / "queue")
+    worker = start_worker(queue_dir)
+    try:
+        executor = workqueue.QueueExecutor(queue_dir)
+        log = io.StringIO()
+        task = executor.start(log, ["sleep", "60"], cwd=str(tmp_path))
+        while not os.listdir(os.path.join(queue_dir, "running")):
+            time.sleep(0.05)
+
+        worker.kill()
+        worker.wait()
+
+        assert wait_for(task) == -signal.SIGKILL
+        assert "lost its worker" in log.getvalue()
+        assert os.listdir(os.path.join(queue_dir, "running")) == []
+    finally:
+        if worker.poll() is None:
+            worker.kill()
+        worker.wait()
+
+
+def test_cancelled_task_without_worker_fails(tmp_path, monkeypatch):
+    monkeypatch.setattr(workqueue, "CANCEL_GRACE", 1)
+    queue_dir = str(tmp_path / "queue")
+    executor = workqueue.QueueExecutor(queue_dir)
+    log = io.StringIO()
+    task = executor.start(log, ["true"], cwd=str(tmp_path))
+
+    # Claimed by a worker whose claim was lost before it started the task
+    worker = workqueue.Worker(queue_dir, 1)
+    assert worker.claim()["id"] == task.task_id
+    os.remove(workqueue.claimed_filename(queue_dir, task.task_id, worker.name))
+    task.kill()
+
+    assert wait_for(task) == -signal.SIGKILL
+    assert "cancelled without a worker" in log.getvalue()
+
+
+def test_worker_clock_skew(tmp_path, monkeypatch):
+    monkeypatch.setattr(workqueue, "WORKER_TIMEOUT", 2)
+    queue_dir = str(tmp_path / "queue")
+    executor = workqueue.QueueExecutor(queue_dir)
+    log = io.StringIO()
+    task = executor.start(log, ["true"], cwd=str(tmp_path))
+
+    # Claimed by a worker on a machine whose clock is far behind
+    heartbeat = os.path.join(queue_dir, "workers", "skewed-1")
+    with open(heartbeat, "w"):
+        None
+    os.rename(os.path.join(queue_dir, "pending", task.task_id + ".json"), \
+        workqueue.claimed_filename(queue_dir, task.task_id, "skewed-1"))
+
+    t = 1000.0
+    t0 = time.time()
+    while time.time() - t0 < 4:
+        t += 1
+        os.utime(heartbeat, (t, t))
+        time.sleep(0.2)
+        assert task.poll() is None
+
+    # Stops touching its file
+    assert wait_for(task, 10) == -signal.SIGKILL
+    assert "lost its worker skewed-1" in log.getvalue()
+
+
+def test_failed_task_not_reported_by_worker(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    workqueue.make_queue_dirs(queue_dir)
+    task_id = "1-sleep"
+    workqueue.write_json(os.path.join(queue_dir, "pending", task_id + ".json"), \
+        {"id": task_id, "cmd": ["sleep", "60"], "cwd": str(tmp_path), "env": None, "shell": False})
+
+    worker = workqueue.Worker(queue_dir, 1)
+    worker.step()
+    assert task_id in worker.running
+
+    # Failed by the coordinator
+    os.remove(workqueue.claimed_filename(queue_dir, task_id, worker.name))
+    workqueue.write_json(os.path.join(queue_dir, "done", task_id + ".json"), {"returncode": -signal.SIGKILL})
+
+    t0 = time.time()
+    while task_id in worker.running:
+        assert time.time() - t0 < 5
+        worker.step()
+        time.sleep(0.05)
+    assert workqueue.read_json(os.path.join(queue_dir, "done", task_id + ".json")) == \
+        {"returncode": -signal.SIGKILL}
+    worker.stop()
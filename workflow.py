@@ -19,8 +19,18 @@ import psutil
 import math
 import json
 import threading
+import re
+import concurrent.futures
+import multiprocessing
 
 from progress import Progress
+import resources
+import openswath
+import tables
+from supervisor import Event, ProcessPool, run_command, start_process, task_executor, wait_processes
+
+OPENSWATH_THREADS_PER_WORKER = 8
+DIAUMPIRE_THREADS_PER_WORKER = 8
 
 class NonZeroReturnValueException(Exception):
     def __init__(self, returnvalue, msg):
@@ -29,17 +39,6 @@ class NonZeroReturnValueException(Exception):
         return
 
 
-class Event:
-    def __init__(self):
-        self.kill_flag = False
-    
-    def kill(self):
-        self.kill_flag = True
-
-    def reset(self):
-        self.kill_flag = False
-
-
 class State:
     
     def __init__(self, project):
@@ -96,6 +95,133 @@ def logline(log_fh, text):
     return
 
 
+def input_extension(filenames):
+
+    # Returns the common lower case extension of the input files, or None
+    # (with the reason printed) if it is missing or not supported.
+
+    extensions = set()
+    for filename in filenames:
+        extensions.add(os.path.splitext(filename)[1].lower())
+
+    extensions = list(extensions)
+
+    # TODO: Return the actual error
+    if len(extensions) > 1:
+        print("A single input type allowed, multile file types found (" + ", ".join(extensions) + ")")
+        return None
+
+    # TODO: Return the actual error
+    if not extensions or extensions[0] not in [".mzml", ".mzxml", ".raw"]:
+        print("Unknown extension (" + "".join(extensions) + ") found.")
+        return None
+
+    return extensions[0]
+
+
+def find_raw_converter():
+    if os.path.exists("/wineprefix64"):
+        return ("msconvert")
+    if os.path.exists("/opt/ThermoRawFileParser/ThermoRawFileParser.exe"):
+        return ("thermorawparser")
+    return None
+
+
+def write_if_changed(filename, text):
+
+    # Keeps the modification time of unchanged settings files, so that
+    # the results depending on them are not considered out of date.
+
+    if os.path.isfile(filename):
+        with open(filename, "r") as fh:
+            if fh.read() == text:
+                return False
+
+    with open(filename, "w") as fh:
+        fh.write(text)
+    return True
+
+
+def remove_files(cwd, filenames):
+    for filename in filenames:
+        filepath = os.path.join(cwd, filename)
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+
+def split_threads(threads, workers):
+
+    # Splits a thread budget between concurrent workers, e.g. 10 threads
+    # for 3 workers gives [4, 3, 3]. Every worker gets at least one thread.
+
+    if not threads:
+        threads = resources.available_cpus()
+    threads = int(threads)
+    workers = max(1, int(workers))
+
+    share, extra = divmod(threads, workers)
+    return [max(1, share + (1 if i < extra else 0)) for i in range(workers)]
+
+
+def run_branches(event, threads, branches):
+
+    # Runs independent pipeline branches in parallel threads and waits for
+    # all of them. Every branch is called with threads= set to its share of
+    # the thread budget. If a branch raises, the event is killed so the
+    # other branches stop, and the first exception is re-raised here.
+
+    if not branches:
+        return
+
+    branch_threads = split_threads(threads, len(branches))
+    errors = []
+
+    def run_branch(branch, n_threads):
+        try:
+            branch(threads=n_threads)
+        except BaseException as e:
+            errors.append(e)
+            if event:
+                event.kill()
+
+    workers = []
+    for branch, n_threads in zip(branches, branch_threads):
+        worker = threading.Thread(target=run_branch, args=(branch, n_threads))
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0]
+
+
+def run_reserved_command(event, log_fh, cmd, memory, **kwargs):
+
+    # run_command for memory hungry tools, started once the memory has
+    # been reserved from the shared budget.
+
+    reserved = resources.memory_budget.reserve(memory, event, event)
+    if reserved is None:
+        return None
+    try:
+        return run_command(event, log_fh, cmd, **kwargs)
+    finally:
+        resources.memory_budget.release(reserved, event)
+
+
+def write_comet_cfg_threads(comet_cfg, out_cfg, threads):
+
+    with open(comet_cfg, "r") as fh:
+        cfg_txt = fh.read()
+
+    cfg_txt = re.sub(r"^num_threads\s*=\s*\d+", "num_threads = " + str(threads), cfg_txt, flags=re.MULTILINE)
+
+    with open(out_cfg, "w") as fh:
+        fh.write(cfg_txt)
+
+
 def install_ThermoRawFileParser(event, log_fh, progressData):
 
     progress = Progress(progressData, "percentage-indicator")
@@ -109,30 +235,21 @@ def install_ThermoRawFileParser(event, log_fh, progressData):
 
     ]
 
-    logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-    proc = subprocess.Popen(cmd, cwd="/root", stdout=log_fh, stderr=log_fh)
-
-    while True:
-        try:
-            proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                proc.kill()
-                progress.fail({
-                    "cmd": "Killed",
-                    "returncode": -1, 
-                })
+    returncode = run_command(event, log_fh, cmd, cwd="/root")
+    if returncode is None:
+        progress.fail({
+            "cmd": "Killed",
+            "returncode": -1, 
+        })
 
-                return
+        return
 
-    log_fh.flush()
-    if proc.returncode != 0:
+    if returncode != 0:
         progress.fail({
             "cmd": "Wget returned error",
-            "returncode": proc.returncode, 
+            "returncode": returncode, 
         })
-        raise NonZeroReturnValueException(proc.returncode, 'wget')
+        raise NonZeroReturnValueException(returncode, 'wget')
 
     step += 1
     progress.update_n_of_m(step, n_steps)
@@ -157,29 +274,20 @@ def install_ThermoRawFileParser(event, log_fh, progressData):
 
     ]
 
-    logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-    proc = subprocess.Popen(cmd, cwd="/opt/ThermoRawFileParser", stdout=log_fh, stderr=log_fh)
-
-    while True:
-        try:
-            proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                proc.kill()
-                progress.fail({
-                    "cmd": "Killed",
-                    "returncode": -1, 
-                })
-                return
+    returncode = run_command(event, log_fh, cmd, cwd="/opt/ThermoRawFileParser")
+    if returncode is None:
+        progress.fail({
+            "cmd": "Killed",
+            "returncode": -1, 
+        })
+        return
 
-    log_fh.flush()
-    if proc.returncode != 0:
+    if returncode != 0:
         progress.fail({
             "cmd": "ThermoRawFileParser returned error",
-            "returncode": proc.returncode, 
+            "returncode": returncode, 
         })
-        raise NonZeroReturnValueException(proc.returncode, '/ThermoRawFileParser/ThermoRawFileParser.exe')
+        raise NonZeroReturnValueException(returncode, '/ThermoRawFileParser/ThermoRawFileParser.exe')
 
     step += 1
     progress.update_n_of_m(step, n_steps)
@@ -190,7 +298,71 @@ def install_ThermoRawFileParser(event, log_fh, progressData):
     return
     
 
-def convertRAW_ThermoRawFileParser(event, log_fh, progressData, cwd, filenames, peak_picking, to_format, folder):
+def is_complete_spectrum_file(filename):
+
+    # A converted mzML/mzXML file is complete when it ends with the closing
+    # tag of its root element. Conversions that were killed or failed leave
+    # truncated files behind.
+
+    if not os.path.isfile(filename):
+        return False
+
+    with open(filename, "rb") as fh:
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+        fh.seek(max(0, size - 4096))
+        tail = fh.read().rstrip()
+
+    return tail.endswith(b"</indexedmzML>") \
+        or tail.endswith(b"</mzML>") \
+        or tail.endswith(b"</mzXML>")
+
+
+def run_conversions(event, log_fh, progress, jobs, workers, tool):
+
+    # Runs conversion jobs (input filename, output filename, command, Popen
+    # arguments) at most `workers` at a time, further capped by the storage
+    # of the inputs, skipping outputs that are already complete.
+    # Returns True when done, None if cancelled.
+
+    n_steps = len(jobs)
+    steps = {"done": 0}
+
+    pending = []
+    for filename, outputfilename, cmd, kwargs in jobs:
+        if is_complete_spectrum_file(outputfilename):
+            print (outputfilename + " already exists, skipping conversion.")
+            steps["done"] += 1
+        else:
+            pending.append((filename, cmd, kwargs))
+
+    workers = max(1, min(int(workers), len(pending)))
+    if pending:
+        workers = min(workers, resources.io_workers([x[0] for x in pending]))
+
+    pool = ProcessPool(event, log_fh, workers)
+
+    def on_exit(returncode):
+        if returncode != 0:
+            raise NonZeroReturnValueException(returncode, tool)
+        steps["done"] += 1
+        progress.update_n_of_m(steps["done"], n_steps)
+
+    for filename, cmd, kwargs in pending:
+        pool.submit(cmd, on_exit, **kwargs)
+
+    progress.update_n_of_m(steps["done"], n_steps)
+
+    if not pool.run():
+        return None
+
+    progress.update_n_of_m(n_steps, n_steps)
+    progress.ready()
+
+    return True
+
+
+def convertRAW_ThermoRawFileParser(event, log_fh, progressData, cwd, filenames, peak_picking, to_format, folder, workers=1):
 
     progress = Progress(progressData, "percentage-indicator")
 
@@ -201,13 +373,10 @@ def convertRAW_ThermoRawFileParser(event, log_fh, progressData, cwd, filenames,
         })
         return False
 
-    
-    step = 0
-    n_steps = len(filenames)
-
     if not os.path.exists(os.path.join(cwd, folder)):
         os.mkdir(os.path.join(cwd, folder))
 
+    jobs = []
     for filename in filenames:
 
         outputfilename = os.path.splitext(os.path.basename(filename))[0] + ".mzML"
@@ -225,42 +394,28 @@ def convertRAW_ThermoRawFileParser(event, log_fh, progressData, cwd, filenames,
         if not peak_picking:
             cmd.append("-p")
 
-        logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-        proc = subprocess.Popen(cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-
-        while True:
-            try:
-                proc.wait(1)
-                break
-            except subprocess.TimeoutExpired:
-                if event and event.kill_flag:
-                    proc.kill()
-                    return
+        jobs.append((filename, os.path.join(cwd, folder, outputfilename), cmd, {"cwd": cwd}))
 
-        log_fh.flush()
-        if proc.returncode != 0:
-            raise NonZeroReturnValueException(proc.returncode, '/ThermoRawFileParser/ThermoRawFileParser.exe')
+    return run_conversions(event, log_fh, progress, jobs, workers, '/ThermoRawFileParser/ThermoRawFileParser.exe')
 
-        step += 1
-        progress.update_n_of_m(step, n_steps)
-    
-    progress.update_n_of_m(n_steps, n_steps)
-    progress.ready()
 
-    return True
 
+def wine_env():
+    run_env = os.environ.copy()
+    run_env["WINEPREFIX"] = "/wineprefix64"
+    run_env["WINEDEBUG"]="-all,err+all"
+    run_env["WINEPATH"]="C:\\pwiz"
+    return run_env
 
 
-def convertRAWqtofpeakpicker(event, log_fh, progressData, cwd, filenames, folder):
+def convertRAWqtofpeakpicker(event, log_fh, progressData, cwd, filenames, folder, workers=1):
 
     progress = Progress(progressData, "percentage-indicator")
 
-    step = 0
-    n_steps = len(filenames)
-
     if not os.path.exists(os.path.join(cwd, folder)):
         os.mkdir(os.path.join(cwd, folder))
 
+    jobs = []
     for filename in filenames:
 
         outputfilename = os.path.splitext(os.path.basename(filename))[0] + ".mzXML"
@@ -276,42 +431,15 @@ def convertRAWqtofpeakpicker(event, log_fh, progressData, cwd, filenames, folder
             "--out", os.path.join(cwd, folder, outputfilename)
         ]
 
-        run_env = os.environ.copy()
-        run_env["WINEPREFIX"] = "/wineprefix64"
-        run_env["WINEDEBUG"]="-all,err+all"
-        run_env["WINEPATH"]="C:\pwiz"
+        jobs.append((filename, os.path.join(cwd, folder, outputfilename), cmd, {"env": wine_env(), "cwd": cwd}))
 
-        logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-        proc = subprocess.Popen(cmd, env=run_env, cwd=cwd, stdout=log_fh, stderr=log_fh)
-
-        while True:
-            try:
-                proc.wait(1)
-                break
-            except subprocess.TimeoutExpired:
-                if event and event.kill_flag:
-                    proc.kill()
-                    return
+    return run_conversions(event, log_fh, progress, jobs, workers, 'qtofpeakpicker.exe')
 
-        log_fh.flush()
-        if proc.returncode != 0:
-            raise NonZeroReturnValueException(proc.returncode, 'qtofpeakpicker.exe')
-
-        step += 1
-        progress.update_n_of_m(step, n_steps)
-    
-    progress.update_n_of_m(n_steps, n_steps)
-    progress.ready()
-
-    return True
-
-def convertRAW(event, log_fh, progressData, cwd, filenames, peak_picking, to_format, folder):
+def convertRAW(event, log_fh, progressData, cwd, filenames, peak_picking, to_format, folder, workers=1):
 
     progress = Progress(progressData, "percentage-indicator")
 
-    step = 0
-    n_steps = len(filenames)
-
+    jobs = []
     for filename in filenames:
 
         cmd = [
@@ -325,43 +453,20 @@ def convertRAW(event, log_fh, progressData, cwd, filenames, peak_picking, to_for
 
         if to_format == "mzxml":
             cmd.append("--mzXML")
+            extension = ".mzXML"
         elif to_format == "mzml":
             cmd.append("--mzML")
+            extension = ".mzML"
         else:
             print ("Unknown format " + to_format)
             return False
 
         cmd.extend(["-o", folder])
-        
-        run_env = os.environ.copy()
-        run_env["WINEPREFIX"] = "/wineprefix64"
-        run_env["WINEDEBUG"]="-all,err+all"
-        run_env["WINEPATH"]="C:\pwiz"
 
-        logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-        proc = subprocess.Popen(cmd, env=run_env, cwd=cwd, stdout=log_fh, stderr=log_fh)
+        outputfilename = os.path.splitext(os.path.basename(filename))[0] + extension
+        jobs.append((filename, os.path.join(cwd, folder, outputfilename), cmd, {"env": wine_env(), "cwd": cwd}))
 
-        while True:
-            try:
-                proc.wait(1)
-                break
-            except subprocess.TimeoutExpired:
-                if event and event.kill_flag:
-                    proc.kill()
-                    return
-
-
-        log_fh.flush()
-        if proc.returncode != 0:
-            raise NonZeroReturnValueException(proc.returncode, 'msconvert.exe')
-
-        step += 1
-        progress.update_n_of_m(step, n_steps)
-    
-    progress.update_n_of_m(n_steps, n_steps)
-    progress.ready()
-
-    return True
+    return run_conversions(event, log_fh, progress, jobs, workers, 'msconvert.exe')
 
 
 def runDiaumpire(event, log_fh, progressData, cwd, DIAfiles, outDir, threads):
@@ -378,6 +483,7 @@ def runDiaumpire(event, log_fh, progressData, cwd, DIAfiles, outDir, threads):
     with open("/opt/gladiator/diaumpire-params-template.txt", "r") as fh:
         cfg_txt = fh.read()
 
+    template_txt = cfg_txt
     cfg_txt = cfg_txt.replace("THREADS", str(threads))
 
     with open(diaumpire_cfg,"w") as fh:
@@ -410,21 +516,12 @@ def runDiaumpire(event, log_fh, progressData, cwd, DIAfiles, outDir, threads):
             cmd.append(DIAfile)
             cmd.extend(params)
             
-            logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-            proc = subprocess.Popen(cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-
-            while True:
-                try:
-                    proc.wait(1)
-                    break
-                except subprocess.TimeoutExpired:
-                    if event and event.kill_flag:
-                        proc.kill()
-                        return
+            returncode = run_command(event, log_fh, cmd, cwd=cwd)
+            if returncode is None:
+                return
 
-            log_fh.flush()
-            if proc.returncode != 0:
-                raise NonZeroReturnValueException(proc.returncode, 'msconvert')
+            if returncode != 0:
+                raise NonZeroReturnValueException(returncode, 'msconvert')
 
         else:
             print (mzXMLfile + " already exists, skipping msconvert")
@@ -439,10 +536,15 @@ def runDiaumpire(event, log_fh, progressData, cwd, DIAfiles, outDir, threads):
                 filenames.append(filename)
 
     phase_2_n = len(filenames)
-    phase_2_steps = 0
+    steps = {"done": 0}
     n_steps = phase_1_steps + phase_2_n + 3 * phase_2_n # estimate
 
-    for i, filename in enumerate(filenames):
+    # Several DIA-Umpire runs can go in parallel, each with its share of
+    # the threads (in its own copy of the parameters) and with the JVM heap
+    # sized from its memory reservation rather than from all free memory.
+
+    pending = []
+    for filename in filenames:
         basename = os.path.basename(filename)
         mgf1_file = os.path.join(cwd, "libfree/"+os.path.splitext(basename)[0]+"_Q1.mgf")
         mgf2_file = os.path.join(cwd, "libfree/"+os.path.splitext(basename)[0]+"_Q2.mgf")
@@ -451,46 +553,52 @@ def runDiaumpire(event, log_fh, progressData, cwd, DIAfiles, outDir, threads):
         if not (os.path.exists(mgf1_file) \
             and os.path.exists(mgf2_file) \
             and os.path.exists(mgf3_file)):
+            pending.append(filename)
+        else:
+            print (mgf1_file + ", " + mgf2_file + "," + mgf3_file + " exists, skipping diaumpire")
+            steps["done"] += 1
+
+    workers = max(1, min(len(pending), int(threads) // DIAUMPIRE_THREADS_PER_WORKER))
+
+    slot_cfgs = [diaumpire_cfg]
+    if workers > 1:
+        slot_cfgs = []
+        for slot, n_threads in enumerate(split_threads(threads, workers)):
+            slot_cfg = os.path.join(cwd, "diaumpire-params.worker" + str(slot+1) + ".txt")
+            with open(slot_cfg, "w") as fh:
+                fh.write(template_txt.replace("THREADS", str(n_threads)))
+            slot_cfgs.append(slot_cfg)
+
+    pool = ProcessPool(event, log_fh, workers, resources.memory_budget, executor=task_executor())
+
+    def make_cmd(filename, memory):
+        memory_str = str(max(1, memory // resources.GB))
+        return lambda slot: [
+            "java",
+            "-Xms"+memory_str+"g",
+            "-Xmx"+memory_str+"g",
+            "-jar", "/opt/dia-umpire/DIA_Umpire_SE.jar",
+            os.path.join(cwd, "libfree", filename),
+            slot_cfgs[slot]
+        ]
 
-            free_gigs = psutil.virtual_memory().available / (1024.0 ** 3)
-            memory_str = str(math.trunc(free_gigs))
-            
-            cmd = [
-                "java",
-                "-Xms"+memory_str+"g",
-                "-Xmx"+memory_str+"g",
-                "-jar", "/opt/dia-umpire/DIA_Umpire_SE.jar",
-                
-
-            ]
-            
-            params = [
-                os.path.join(cwd, "libfree", filename),
-                diaumpire_cfg
-            ]
-
-            cmd.extend(params)
-            logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-            proc = subprocess.Popen(cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
+    def on_exit(returncode):
+        if returncode != 0:
+            raise NonZeroReturnValueException(returncode, 'dia-umpire')
+        steps["done"] += 1
+        progress.update_n_of_m(phase_1_steps + steps["done"], n_steps)
 
-            while True:
-                try:
-                    proc.wait(1)
-                    break
-                except subprocess.TimeoutExpired:
-                    if event and event.kill_flag:
-                        proc.kill()
-                        return
+    for filename in pending:
+        memory = resources.estimate_memory("diaumpire", [os.path.join(cwd, "libfree", filename)])
+        memory = min(memory, resources.memory_budget.total)
+        pool.submit(make_cmd(filename, memory), on_exit, memory=memory, cwd=cwd)
 
-            log_fh.flush()
-            if proc.returncode != 0:
-                raise NonZeroReturnValueException(proc.returncode, 'dia-umpire')
+    progress.update_n_of_m(phase_1_steps + steps["done"], n_steps)
 
-        else:
-            print (mgf1_file + ", " + mgf2_file + "," + mgf3_file + " exists, skipping diaumpire")
+    if not pool.run():
+        return
 
-        phase_2_steps += 1
-        progress.update_n_of_m(phase_1_steps + phase_2_steps, n_steps)
+    phase_2_steps = steps["done"]
 
     filenames = []
     for root, dirs, files in os.walk(os.path.join(cwd, "libfree")):
@@ -514,21 +622,12 @@ def runDiaumpire(event, log_fh, progressData, cwd, DIAfiles, outDir, threads):
                 "-o", os.path.join(cwd, "libfree-pseudospectra")
             ]
 
-            logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-            proc = subprocess.Popen(cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-
-            while True:
-                try:
-                    proc.wait(1)
-                    break
-                except subprocess.TimeoutExpired:
-                    if event and event.kill_flag:
-                        proc.kill()
-                        return
+            returncode = run_command(event, log_fh, cmd, cwd=cwd)
+            if returncode is None:
+                return
 
-            log_fh.flush()
-            if proc.returncode != 0:
-                raise NonZeroReturnValueException(proc.returncode, 'msconvert')
+            if returncode != 0:
+                raise NonZeroReturnValueException(returncode, 'msconvert')
 
         else:
             print (pseudospectra_mzXML_file + " already exists, skipping conversion.")
@@ -625,7 +724,9 @@ def runComet(\
     DDA_filenames, \
     existing_pep_xmls, \
     outputfilename, \
-    worktempdir):
+    worktempdir, \
+    threads=None, \
+    workers=1):
 
     progress = Progress(progressData, "percentage-indicator")
     n_steps = len(DDA_filenames) + 1
@@ -659,43 +760,58 @@ def runComet(\
             existing_basename = os.path.splitext(existing_basename)[0] # remove pep
             existing_pep_xmls_by_samplenames.append(existing_basename)
 
-    for i, DDA_basename in enumerate(DDA_basenames):
+    # Each worker slot gets its own copy of the settings with num_threads
+    # set to its share of the thread budget. With a single worker and no
+    # budget the settings are used as is (num_threads = 0, all cores).
+
+    n_pending = len([x for x in DDA_basenames if os.path.splitext(x)[0] not in existing_pep_xmls_by_samplenames])
+    workers = max(1, min(int(workers), n_pending))
+
+    slot_cfgs = [comet_cfg]
+    if workers > 1 or threads:
+        slot_threads = split_threads(threads, workers)
+        slot_cfgs = []
+        for slot, n_threads in enumerate(slot_threads):
+            slot_cfg = os.path.join(cwd, os.path.splitext(outputfilename)[0] + ".comet.worker" + str(slot+1) + ".xml")
+            write_comet_cfg_threads(comet_cfg, slot_cfg, n_threads)
+            slot_cfgs.append(slot_cfg)
+
+    pool = ProcessPool(event, log_fh, len(slot_cfgs), executor=task_executor())
+    steps = {"done": 0}
+
+    def make_cmd(DDA_basename):
+        return lambda slot: [
+            "/opt/comet/comet-ms",
+            "-P"+slot_cfgs[slot],
+            DDA_basename
+        ]
+
+    def make_on_exit(DDA_basename):
+        def on_exit(returncode):
+            if returncode != 0:
+                progress.fail({
+                    "cmd": "/opt/comet/comet-ms " + DDA_basename,
+                    "returncode": returncode, 
+                })
+                raise NonZeroReturnValueException(returncode, 'Comet')
+            steps["done"] += 1
+            progress.update_n_of_m(steps["done"], n_steps)
+        return on_exit
+
+    for DDA_basename in DDA_basenames:
 
         samplename = os.path.splitext(DDA_basename)[0]
 
         if samplename in existing_pep_xmls_by_samplenames:
             # print ("DEBUG: Comet skipping " + basename)
-            None
+            steps["done"] += 1
         else:
+            pool.submit(make_cmd(DDA_basename), make_on_exit(DDA_basename), cwd=cwd)
 
-            # DDA_pep_xml = DDA_basename_to_pep_xml[DDA_basename]
-
-            cmd = [
-                "/opt/comet/comet-ms",
-                "-P"+comet_cfg,
-                ]
-            cmd.append(DDA_basename)
-            logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-            comet_proc = subprocess.Popen(cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-            
-            while True:
-                try:
-                    comet_proc.wait(1)
-                    break
-                except subprocess.TimeoutExpired:
-                    if event and event.kill_flag:
-                        comet_proc.kill()
-                        return
+    progress.update_n_of_m(steps["done"], n_steps)
 
-            log_fh.flush()
-            if comet_proc.returncode != 0:
-                progress.fail({
-                    "cmd": " ".join(cmd),
-                    "returncode": comet_proc.returncode, 
-                })
-                raise NonZeroReturnValueException(comet_proc.returncode, 'Comet')
-
-        progress.update_n_of_m(i+1, n_steps)
+    if not pool.run():
+        return
 
 
     xinteract_cmd = [
@@ -705,24 +821,16 @@ def runComet(\
         "-N" + outputfilename,
         ]
     xinteract_cmd.extend(DDA_pep_xmls)
-    logline(log_fh, "Running pipeline command: "+" ".join(xinteract_cmd))
-    xinteract_proc = subprocess.Popen(xinteract_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    while True:
-        try:
-            xinteract_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                xinteract_proc.kill()
-                return
+    xinteract_returncode = run_command(event, log_fh, xinteract_cmd, cwd=cwd)
+    if xinteract_returncode is None:
+        return
 
-    log_fh.flush()
-    if xinteract_proc.returncode != 0:
+    if xinteract_returncode != 0:
         progress.fail({
             "cmd": " ".join(xinteract_cmd),
-            "returncode": xinteract_proc.returncode, 
+            "returncode": xinteract_returncode, 
         })
-        raise NonZeroReturnValueException(xinteract_proc.returncode, 'xinteract')
+        raise NonZeroReturnValueException(xinteract_returncode, 'xinteract')
 
     progress.update_n_of_m(n_steps, n_steps)
     progress.ready()
@@ -742,7 +850,9 @@ def runXTandem(\
     existing_pep_xmls, \
     outputfilename, \
     worktempdir, \
-    delete_temp_files_flag):
+    delete_temp_files_flag, \
+    threads=None, \
+    workers=1):
 
     progress = Progress(progressData, "percentage-indicator")
     n_steps = len(DDA_filenames) + 1
@@ -775,15 +885,35 @@ def runXTandem(\
             existing_basename = os.path.splitext(existing_basename)[0] # remove tandem
             existing_pep_xmls_by_samplenames.append(existing_basename)
 
-    for i, DDA_filename in enumerate(DDA_filenames):
+    # Searches run in the default lane, several at a time with the thread
+    # budget split between them ("spectrum, threads" is overridden in each
+    # search's input file). Tandem2XML conversion of a finished search runs
+    # in its own lane, concurrently with the following searches.
 
+    pending_samples = []
+    for DDA_filename in DDA_filenames:
         samplename = os.path.splitext(os.path.basename(DDA_filename))[0]
         tandem_outs[DDA_filename] = samplename+".TANDEM.OUTPUT.xml"
-
         if samplename in existing_pep_xmls_by_samplenames:
             # print ("DEBUG: X!Tandem skipping " + samplename)
             None
         else:
+            pending_samples.append(DDA_filename)
+
+    workers = max(1, min(int(workers), len(pending_samples)))
+
+    slot_threads = [None]
+    if workers > 1 or threads:
+        slot_threads = split_threads(threads, workers)
+
+    pool = ProcessPool(event, log_fh, len(slot_threads), executor=task_executor())
+    pool.add_lane("Tandem2XML", len(slot_threads))
+
+    input_tmp_fds = []
+    steps = {"done": len(DDA_filenames) - len(pending_samples)}
+
+    def make_tandem_cmd(DDA_filename):
+        def tandem_cmd(slot):
             input_xml = '<?xml version="1.0"?>\n'
             input_xml += '<bioml>\n'
             input_xml += '<note type="input" label="list path, default parameters">' + xtandem_default_input_filename + '</note>\n'
@@ -791,6 +921,8 @@ def runXTandem(\
             input_xml += '<note type="input" label="protein, taxon">DB</note>\n'
             input_xml += '<note type="input" label="spectrum, path">' + DDA_filename + '</note>\n'
             input_xml += '<note type="input" label="output, path">' + tandem_outs[DDA_filename] + '</note>\n'
+            if slot_threads[slot]:
+                input_xml += '<note type="input" label="spectrum, threads">' + str(slot_threads[slot]) + '</note>\n'
             input_xml += '</bioml>'
             input_tmp_fd = \
                         tempfile.NamedTemporaryFile(dir=worktempdir, \
@@ -798,60 +930,51 @@ def runXTandem(\
                                                     delete=delete_temp_files_flag)
             input_tmp_fd.write(input_xml)
             input_tmp_fd.flush()
-            tandem_cmd = [
+            input_tmp_fds.append(input_tmp_fd)
+            return [
                 "/opt/tandem/tandem",
                 input_tmp_fd.name,
                 tandem_outs[DDA_filename]
                 ]
+        return tandem_cmd
 
-            logline(log_fh, "Running pipeline command: "+" ".join(tandem_cmd))
-            tandem_proc = subprocess.Popen(tandem_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-            while True:
-                try:
-                    tandem_proc.wait(1)
-                    break
-                except subprocess.TimeoutExpired:
-                    if event and event.kill_flag:
-                        tandem_proc.kill()
-                        return
-
-            log_fh.flush()
-            if tandem_proc.returncode != 0:
+    def make_tandemxml_on_exit(tandemxml_cmd):
+        def on_exit(returncode):
+            if returncode != 0:
                 progress.fail({
-                    "cmd": " ".join(tandem_cmd),
-                    "returncode": tandem_proc.returncode, 
+                    "cmd": " ".join(tandemxml_cmd),
+                    "returncode": returncode, 
+                })
+                raise NonZeroReturnValueException(returncode, 'Tandem2XML')
+            steps["done"] += 1
+            progress.update_n_of_m(steps["done"], n_steps)
+        return on_exit
+
+    def make_tandem_on_exit(DDA_filename):
+        def on_exit(returncode):
+            if returncode != 0:
+                progress.fail({
+                    "cmd": "/opt/tandem/tandem " + tandem_outs[DDA_filename],
+                    "returncode": returncode, 
                 })
-                raise NonZeroReturnValueException(tandem_proc.returncode, 'Tandem')
+                raise NonZeroReturnValueException(returncode, 'Tandem')
 
             tandemxml_cmd = [
                 "/opt/tpp/bin/Tandem2XML",
                 tandem_outs[DDA_filename],
                 DDA_pep_xmls[DDA_filename]
                 ]
-            logline(log_fh, "Running pipeline command: "+" ".join(tandemxml_cmd))
-            tandemxml_proc = subprocess.Popen(tandemxml_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-            
-            while True:
-                try:
-                    tandemxml_proc.wait(1)
-                    break
-                except subprocess.TimeoutExpired:
-                    if event and event.kill_flag:
-                        tandemxml_proc.kill()
-                        return
+            pool.submit(tandemxml_cmd, make_tandemxml_on_exit(tandemxml_cmd), lane="Tandem2XML", cwd=cwd)
+        return on_exit
 
-            
-            log_fh.flush()
-            if tandem_proc.returncode != 0:
-                progress.fail({
-                    "cmd": " ".join(tandemxml_cmd),
-                    "returncode": tandemxml_proc.returncode, 
-                })
-                raise NonZeroReturnValueException(tandemxml_proc.returncode, 'Tandem2XML')
+    for DDA_filename in pending_samples:
+        pool.submit(make_tandem_cmd(DDA_filename), make_tandem_on_exit(DDA_filename), cwd=cwd)
 
-        progress.update_n_of_m(i+1, n_steps)
+    progress.update_n_of_m(steps["done"], n_steps)
+
+    if not pool.run():
+        return
 
-       
     xinteract_cmd = [
         "/opt/tpp/bin/xinteract",
         "-OARPd",
@@ -860,25 +983,16 @@ def runXTandem(\
         ]
     xinteract_cmd.extend([DDA_pep_xmls[x] for x in DDA_pep_xmls])
 
-    logline(log_fh, "Running pipeline command: "+" ".join(xinteract_cmd))
-    xinteract_proc = subprocess.Popen(xinteract_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
+    xinteract_returncode = run_command(event, log_fh, xinteract_cmd, cwd=cwd)
+    if xinteract_returncode is None:
+        return
 
-    while True:
-        try:
-            xinteract_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                xinteract_proc.kill()
-                return
-    
-    log_fh.flush()
-    if xinteract_proc.returncode != 0:
+    if xinteract_returncode != 0:
         progress.fail({
             "cmd": " ".join(xinteract_cmd),
-            "returncode": xinteract_proc.returncode, 
+            "returncode": xinteract_returncode, 
         })
-        raise NonZeroReturnValueException(xinteract_proc.returncode, 'xinteract')
+        raise NonZeroReturnValueException(xinteract_returncode, 'xinteract')
 
     progress.update_n_of_m(n_steps, n_steps)
     progress.ready()
@@ -908,26 +1022,16 @@ def combine_search_engine_results(\
     interprophetparser_cmd.extend(pepXMLs)
     interprophetparser_cmd.append(outputFilename)
 
-    logline(log_fh, "Running pipeline command: "+" ".join(interprophetparser_cmd))
-    interprophetparser_proc = subprocess.Popen(interprophetparser_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    
-    while True:
-        try:
-            interprophetparser_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                interprophetparser_proc.kill()
-                return
-
+    interprophetparser_returncode = run_command(event, log_fh, interprophetparser_cmd, cwd=cwd)
+    if interprophetparser_returncode is None:
+        return
 
-    log_fh.flush()
-    if interprophetparser_proc.returncode != 0:
+    if interprophetparser_returncode != 0:
         progress.fail({
             "cmd": " ".join(interprophetparser_cmd),
-            "returncode": interprophetparser_proc.returncode, 
+            "returncode": interprophetparser_returncode, 
         })
-        raise NonZeroReturnValueException(interprophetparser_proc.returncode, 'InterProphetParser')
+        raise NonZeroReturnValueException(interprophetparser_returncode, 'InterProphetParser')
 
     progress.update_n_of_m(100, 100)
     progress.ready()
@@ -935,6 +1039,114 @@ def combine_search_engine_results(\
 
 
 
+def build_method_lib(\
+    event, \
+    log_fh, \
+    cwd, \
+    method, \
+    pepXMLs, \
+    decoyPrefix, \
+    DDA_DB_filename, \
+    iRT_filename, \
+    protFDR, \
+    gFDR, \
+    progress, \
+    threads=None):
+
+    # Builds the spectral library of a single method ("lib" or "libfree").
+    # Returns the library filename, or None if the analysis was cancelled.
+
+    if len(pepXMLs) > 1:
+        pepXMLFile = method+"_iprofet.peps.xml"
+        
+        combine_search_engine_results(event,
+                                        log_fh,
+                                        None,
+                                        cwd,
+                                        "DECOY_", \
+                                        pepXMLFile, \
+                                        DDA_DB_filename, \
+                                        str(threads), \
+                                        pepXMLs)
+        
+        if event and event.kill_flag:
+            return None
+            
+    else:
+        assert(len(pepXMLs) == 1)
+        pepXMLFile = pepXMLs[0]
+
+
+    mayu_folder = method+"_mayu"
+
+    os.makedirs(os.path.join(cwd, mayu_folder))
+
+    mayu_cmd = [
+        "/opt/tpp/bin/Mayu.pl",
+        "-A", "../"+pepXMLFile,
+        "-C", "../"+DDA_DB_filename,
+        "-E", decoyPrefix,
+        "-G", str(gFDR),
+        "-H", "51",
+        "-I", "2",
+        "-P", "protFDR="+str(protFDR)+":t",
+    ]
+
+    mayu_returncode = run_command(event, log_fh, mayu_cmd, cwd=os.path.join(cwd, mayu_folder))
+    if mayu_returncode is None:
+        return None
+
+    if mayu_returncode != 0:
+        progress.fail({
+            "cmd": " ".join(mayu_cmd),
+            "returncode": mayu_returncode, 
+        })
+        raise NonZeroReturnValueException(mayu_returncode, 'Mayu')
+
+
+    shell_cmd = "cat *_psm_protFDR0*.csv |cut -f 5 -d ',' |tail -n+2 |sort -u |head -n1"
+    shell_proc = start_process(log_fh, shell_cmd, stdout=subprocess.PIPE, stderr=log_fh, cwd=os.path.join(cwd, mayu_folder), shell=True)
+    if wait_processes(event, [shell_proc]) is None:
+        return None
+
+    log_fh.flush()
+    if shell_proc.returncode != 0:
+        progress.fail({
+            "cmd": shell_cmd,
+            "returncode": shell_proc.returncode, 
+        })
+        raise NonZeroReturnValueException(shell_proc.returncode, 'shell command')
+
+    cutoff = shell_proc.stdout.readline().decode("utf8").rstrip('\n')
+
+    # The lib and libfree builds run side by side in the same folder, each
+    # writes its own log instead of spectrast.log
+    spectrast_cmd1 = [
+        "/opt/tpp/bin/spectrast",
+        "-LSpecLib_"+method+".log",
+        "-cNSpecLib_"+method,
+        "-cIHCD",
+        "-cf", "\"Protein! ~ "+decoyPrefix+"\"",
+        "-cP"+cutoff,
+        "-c_IRT"+iRT_filename, 
+        "-c_IRR", pepXMLFile 
+    ]
+
+    spectrast_cmd1_returncode = run_reserved_command(event, log_fh, spectrast_cmd1, \
+        resources.estimate_memory("spectrast", [os.path.join(cwd, pepXMLFile)]), cwd=cwd)
+    if spectrast_cmd1_returncode is None:
+        return None
+
+    if spectrast_cmd1_returncode != 0:
+        progress.fail({
+            "cmd": " ".join(spectrast_cmd1),
+            "returncode": spectrast_cmd1_returncode, 
+        })
+        raise NonZeroReturnValueException(spectrast_cmd1_returncode, 'spectrast')
+
+    return "SpecLib_"+method+".splib"
+
+
 def buildlib(event, \
              log_fh, \
              progressData,\
@@ -953,119 +1165,43 @@ def buildlib(event, \
 
 
     method_pepXMLs = {"lib":libmethod_pepXMLs, "libfree":libfreemethod_pepXMLs}
-    speclibs = []
+    method_speclibs = {}
 
     progress = Progress(progressData, "percentage-indicator")
     n_steps = len(method_pepXMLs) +1
-    
-    for i, method in enumerate(method_pepXMLs):
-
-        if len(method_pepXMLs[method]) > 0:
-            
-            if len(method_pepXMLs[method]) > 1:
-                pepXMLFile = method+"_iprofet.peps.xml"
-                
-                combine_search_engine_results(event,
-                                                log_fh,
-                                                None,
-                                                cwd,
-                                                "DECOY_", \
-                                                pepXMLFile, \
-                                                DDA_DB_filename, \
-                                                threads, \
-                                                method_pepXMLs[method])
-                
-                if event and event.kill_flag:
-                    return
-                    
-            else:
-                assert(len(method_pepXMLs[method]) == 1)
-                pepXMLFile = method_pepXMLs[method][0]
-
-
-            mayu_folder = method+"_mayu"
-
-            os.makedirs(os.path.join(cwd, mayu_folder))
-
-            mayu_cmd = [
-                "/opt/tpp/bin/Mayu.pl",
-                "-A", "../"+pepXMLFile,
-                "-C", "../"+DDA_DB_filename,
-                "-E", decoyPrefix,
-                "-G", str(gFDR),
-                "-H", "51",
-                "-I", "2",
-                "-P", "protFDR="+str(protFDR)+":t",
-            ]
-
-            logline(log_fh, "Running pipeline command: "+" ".join(mayu_cmd))
-            mayu_proc = subprocess.Popen(mayu_cmd, stdout=log_fh, stderr=log_fh, cwd=os.path.join(cwd, mayu_folder))
-        
-            while True:
-                try:
-                    mayu_proc.wait(1)
-                    break
-                except subprocess.TimeoutExpired:
-                    if event and event.kill_flag:
-                        mayu_proc.kill()
-                        return
-
-            log_fh.flush()
-            if mayu_proc.returncode != 0:
-                progress.fail({
-                    "cmd": " ".join(mayu_cmd),
-                    "returncode": mayu_proc.returncode, 
-                })
-                raise NonZeroReturnValueException(mayu_proc.returncode, 'Mayu')
-
-
-            shell_cmd = "cat *_psm_protFDR0*.csv |cut -f 5 -d ',' |tail -n+2 |sort -u |head -n1"
-            logline(log_fh, "Running pipeline command: "+ shell_cmd)
-            shell_proc = subprocess.Popen(shell_cmd, stdout=subprocess.PIPE, stderr=log_fh, cwd=os.path.join(cwd, mayu_folder), shell=True)
-            shell_proc.wait()
-            log_fh.flush()
-            if shell_proc.returncode != 0:
-                progress.fail({
-                    "cmd": " ".join(shell_cmd),
-                    "returncode": shell_proc.returncode, 
-                })
-                raise NonZeroReturnValueException(shell_proc.returncode, 'shell command')
-
-            cutoff = shell_proc.stdout.readline().decode("utf8").rstrip('\n')
-
-            speclibs.append("SpecLib_"+method+".splib")
-
-            spectrast_cmd1 = [
-                "/opt/tpp/bin/spectrast",
-                "-cNSpecLib_"+method,
-                "-cIHCD",
-                "-cf", "\"Protein! ~ "+decoyPrefix+"\"",
-                "-cP"+cutoff,
-                "-c_IRT"+iRT_filename, 
-                "-c_IRR", pepXMLFile 
-            ]
-
-            logline(log_fh, "Running pipeline command: "+" ".join(spectrast_cmd1))
-            spectrast_cmd1_proc = subprocess.Popen(spectrast_cmd1, cwd=cwd, stdout=log_fh, stderr=log_fh)
-            
-            while True:
-                try:
-                    spectrast_cmd1_proc.wait(1)
-                    break
-                except subprocess.TimeoutExpired:
-                    if event and event.kill_flag:
-                        spectrast_cmd1_proc.kill()
-                        return
-
-            log_fh.flush()
-            if spectrast_cmd1_proc.returncode != 0:
-                progress.fail({
-                    "cmd": " ".join(spectrast_cmd1),
-                    "returncode": spectrast_cmd1_proc.returncode, 
-                })
-                raise NonZeroReturnValueException(spectrast_cmd1_proc.returncode, 'spectrast')
+    steps = {"done": 0}
+
+    # The lib and libfree methods share nothing until the libraries are
+    # merged, so they are built side by side with the threads split
+    # between them. Mayu is single-threaded and dominates this stage.
+
+    def make_branch(method):
+        def branch(threads):
+            method_speclibs[method] = build_method_lib(\
+                event, \
+                log_fh, \
+                cwd, \
+                method, \
+                method_pepXMLs[method], \
+                decoyPrefix, \
+                DDA_DB_filename, \
+                iRT_filename, \
+                protFDR, \
+                gFDR, \
+                progress, \
+                threads)
+            steps["done"] += 1
+            progress.update_n_of_m(steps["done"], n_steps)
+        return branch
+
+    branches = [make_branch(method) for method in method_pepXMLs if len(method_pepXMLs[method]) > 0]
+
+    run_branches(event, threads, branches)
+
+    if event and event.kill_flag:
+        return
 
-    progress.update_n_of_m(i+1, n_steps)
+    speclibs = [method_speclibs[method] for method in method_pepXMLs if method in method_speclibs]
 
 
     # Merge lib and libree method libraries
@@ -1087,25 +1223,17 @@ def buildlib(event, \
         assert (len(speclibs)==2)
         spectrast_concatlib_cm.extend(speclibs)
 
-        logline(log_fh, "Running pipeline command: "+" ".join(spectrast_concatlib_cm))
-        spectrast_concatlib_cm_proc = subprocess.Popen(spectrast_concatlib_cm, cwd=cwd, stdout=log_fh, stderr=log_fh)
-
-        while True:
-            try:
-                spectrast_concatlib_cm_proc.wait(1)
-                break
-            except subprocess.TimeoutExpired:
-                if event and event.kill_flag:
-                    spectrast_concatlib_cm_proc.kill()
-                    return
+        spectrast_concatlib_cm_returncode = run_reserved_command(event, log_fh, spectrast_concatlib_cm, \
+            resources.estimate_memory("spectrast", [os.path.join(cwd, x) for x in speclibs]), cwd=cwd)
+        if spectrast_concatlib_cm_returncode is None:
+            return
 
-        log_fh.flush()
-        if spectrast_concatlib_cm_proc.returncode != 0:
+        if spectrast_concatlib_cm_returncode != 0:
             progress.fail({
                 "cmd": " ".join(spectrast_concatlib_cm),
-                "returncode": spectrast_concatlib_cm_proc.returncode, 
+                "returncode": spectrast_concatlib_cm_returncode, 
             })
-            raise NonZeroReturnValueException(spectrast_concatlib_cm_proc.returncode, 'spectrast merge lib')
+            raise NonZeroReturnValueException(spectrast_concatlib_cm_returncode, 'spectrast merge lib')
 
         speclib = "SpecLib_merged.splib"
         
@@ -1123,25 +1251,17 @@ def buildlib(event, \
         "-cAC", speclib,
     ]
 
-    logline(log_fh, "Running pipeline command: "+" ".join(spectrast_cmd2))
-    spectrast_cmd2_proc = subprocess.Popen(spectrast_cmd2, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    
-    while True:
-        try:
-            spectrast_cmd2_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                spectrast_cmd2_proc.kill()
-                return
+    spectrast_cmd2_returncode = run_reserved_command(event, log_fh, spectrast_cmd2, \
+        resources.estimate_memory("spectrast", [os.path.join(cwd, speclib)]), cwd=cwd)
+    if spectrast_cmd2_returncode is None:
+        return
 
-    log_fh.flush()
-    if spectrast_cmd2_proc.returncode != 0:
+    if spectrast_cmd2_returncode != 0:
         progress.fail({
             "cmd": " ".join(spectrast_cmd2),
-            "returncode": spectrast_cmd2_proc.returncode, 
+            "returncode": spectrast_cmd2_returncode, 
         })
-        raise NonZeroReturnValueException(spectrast_cmd2_proc.returncode, 'spectrast')
+        raise NonZeroReturnValueException(spectrast_cmd2_returncode, 'spectrast')
 
     spectrast2tsv_cmd = [
         "spectrast2tsv.py",
@@ -1157,26 +1277,16 @@ def buildlib(event, \
         "SpecLib_cons.sptxt"
     ]    
 
-    logline(log_fh, "Running pipeline command: "+" ".join(spectrast2tsv_cmd))
-    spectrast2tsv_cmd_proc = subprocess.Popen(spectrast2tsv_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    
-    while True:
-        try:
-            spectrast2tsv_cmd_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                spectrast2tsv_cmd_proc.kill()
-                return
-
+    spectrast2tsv_cmd_returncode = run_command(event, log_fh, spectrast2tsv_cmd, cwd=cwd)
+    if spectrast2tsv_cmd_returncode is None:
+        return
 
-    log_fh.flush()
-    if spectrast2tsv_cmd_proc.returncode != 0:
+    if spectrast2tsv_cmd_returncode != 0:
         progress.fail({
             "cmd": " ".join(spectrast2tsv_cmd),
-            "returncode": spectrast2tsv_cmd_proc.returncode, 
+            "returncode": spectrast2tsv_cmd_returncode, 
         })
-        raise NonZeroReturnValueException(spectrast2tsv_cmd_proc.returncode, 'spectrast2tsv')
+        raise NonZeroReturnValueException(spectrast2tsv_cmd_returncode, 'spectrast2tsv')
 
 
     ConvertTSVToTraML_cmd = [
@@ -1186,25 +1296,16 @@ def buildlib(event, \
 
     ]
 
-    logline(log_fh, "Running pipeline command: "+" ".join(ConvertTSVToTraML_cmd))
-    ConvertTSVToTraML_proc = subprocess.Popen(ConvertTSVToTraML_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    
-    while True:
-        try:
-            ConvertTSVToTraML_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                ConvertTSVToTraML_proc.kill()
-                return
+    ConvertTSVToTraML_returncode = run_command(event, log_fh, ConvertTSVToTraML_cmd, cwd=cwd)
+    if ConvertTSVToTraML_returncode is None:
+        return
 
-    log_fh.flush()
-    if ConvertTSVToTraML_proc.returncode != 0:
+    if ConvertTSVToTraML_returncode != 0:
         progress.fail({
             "cmd": " ".join(ConvertTSVToTraML_cmd),
-            "returncode": ConvertTSVToTraML_proc.returncode, 
+            "returncode": ConvertTSVToTraML_returncode, 
         })
-        raise NonZeroReturnValueException(ConvertTSVToTraML_proc.returncode, 'TargetedFileConverter')
+        raise NonZeroReturnValueException(ConvertTSVToTraML_returncode, 'TargetedFileConverter')
 
     OpenSwathDecoyGenerator_cmd = [
         "OpenSwathDecoyGenerator",
@@ -1216,25 +1317,16 @@ def buildlib(event, \
 #        "-remove_unannotated"
         ]
 
-    logline(log_fh, "Running pipeline command: "+" ".join(OpenSwathDecoyGenerator_cmd))
-    OpenSwathDecoyGenerator_proc = subprocess.Popen(OpenSwathDecoyGenerator_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    
-    while True:
-        try:
-            OpenSwathDecoyGenerator_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                OpenSwathDecoyGenerator_proc.kill()
-                return
+    OpenSwathDecoyGenerator_returncode = run_command(event, log_fh, OpenSwathDecoyGenerator_cmd, cwd=cwd)
+    if OpenSwathDecoyGenerator_returncode is None:
+        return
 
-    log_fh.flush()
-    if OpenSwathDecoyGenerator_proc.returncode != 0:
+    if OpenSwathDecoyGenerator_returncode != 0:
         progress.fail({
             "cmd": " ".join(OpenSwathDecoyGenerator_cmd),
-            "returncode": OpenSwathDecoyGenerator_proc.returncode, 
+            "returncode": OpenSwathDecoyGenerator_returncode, 
         })
-        raise NonZeroReturnValueException(OpenSwathDecoyGenerator_proc.returncode, 'OpenSwathDecoyGenerator')    
+        raise NonZeroReturnValueException(OpenSwathDecoyGenerator_returncode, 'OpenSwathDecoyGenerator')    
 
     progress.update_n_of_m(n_steps, n_steps)
     progress.ready()
@@ -1253,90 +1345,283 @@ def buildDIAMatrix(\
     max_FDR, \
     threads, \
     irt_assay_library_traml,\
-    design_file):    
+    design_file, \
+    workers=1, \
+    reuse_samples=False):    
 
-    successfull_DIA_filenames = []
+    # With reuse_samples, samples that already have a scored result newer
+    # than the library and the DIA file are not extracted again (used when
+    # new samples are added to a project), only feature alignment and
+    # swaths2stats are run over the whole cohort.
 
     progress = Progress(progressData, "percentage-indicator")
-    n_steps = len(DIA_filenames) * 2 +1
+    n_steps = len(DIA_filenames) * 2 +2
+
+    successfull_DIA_filenames = score_DIA_samples(\
+        event, \
+        log_fh, \
+        progress, \
+        n_steps, \
+        cwd, \
+        DIA_filenames, \
+        fixed_swaths_filename, \
+        threads, \
+        irt_assay_library_traml, \
+        workers, \
+        reuse_samples)
+    if successfull_DIA_filenames is None:
+        return
+
+    if not run_feature_alignment(event, log_fh, progress, cwd, successfull_DIA_filenames, target_FDR, max_FDR):
+        return
+
+    progress.update_n_of_m(n_steps - 1, n_steps)
+
+    if not run_swaths2stats(event, log_fh, progress, cwd, design_file):
+        return
+
+    copy_result_tables(event, log_fh, cwd, successfull_DIA_filenames)
+    if event and event.kill_flag:
+        return
+
+    progress.update_n_of_m(n_steps, n_steps)
+    progress.ready()
+
+    return
+
+
+def DIA_sample_results(DIA_filename):
+    # (OpenSwathWorkflow output, pyprophet scored output) in the project
+    basename = os.path.basename(DIA_filename)
+    return basename + "-DIA.tsv", basename + "-DIA_with_dscore.csv"
+
+
+# Per-sample checkpoints. After OpenSwathWorkflow and after pyprophet a
+# marker <output>.done is written (atomically, by rename) recording the
+# size and mtime of the output and of the files it was made from. A step is
+# skipped on restart only if its marker matches all of them and the output
+# is complete (ends with a newline), so samples interrupted in the middle
+# of a step are recomputed.
+
+def stat_record(filepath):
+    st = os.stat(filepath)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def write_checkpoint(cwd, output, inputs):
+    filepath = os.path.join(cwd, output)
+    checkpoint = {
+        "output": stat_record(filepath),
+        "inputs": {os.path.join(cwd, x): stat_record(os.path.join(cwd, x)) for x in inputs},
+    }
+    tmp_filename = filepath + ".done.tmp"
+    with open(tmp_filename, "w") as fh:
+        json.dump(checkpoint, fh)
+    os.rename(tmp_filename, filepath + ".done")
+
+
+def remove_checkpoint(cwd, output):
+    remove_files(cwd, [output + ".done"])
+
+
+def is_complete_table(filepath):
+    if os.path.getsize(filepath) == 0:
+        return False
+    with open(filepath, "rb") as fh:
+        fh.seek(-1, os.SEEK_END)
+        return fh.read(1) == b"\n"
+
+
+def valid_checkpoint(cwd, output, inputs=None):
+
+    # inputs None accepts the inputs recorded in the checkpoint
+
+    filepath = os.path.join(cwd, output)
+    try:
+        with open(filepath + ".done", "r") as fh:
+            checkpoint = json.load(fh)
+
+        if inputs is not None and sorted(checkpoint["inputs"]) != sorted(os.path.join(cwd, x) for x in inputs):
+            return False
+        for input_filepath in checkpoint["inputs"]:
+            if stat_record(input_filepath) != checkpoint["inputs"][input_filepath]:
+                return False
+        if stat_record(filepath) != checkpoint["output"]:
+            return False
+        return is_complete_table(filepath)
+
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def is_scored_sample(cwd, DIA_filename, library_filename):
+
+    # Samples scored before there were checkpoints
+    tsv_filename, dscore_filename = DIA_sample_results(DIA_filename)
+    dscore_filepath = os.path.join(cwd, dscore_filename)
+    if not os.path.isfile(dscore_filepath) or os.path.getsize(dscore_filepath) == 0:
+        return False
+    mtime = os.path.getmtime(dscore_filepath)
+    for filename in [DIA_filename, os.path.join(cwd, library_filename)]:
+        if os.path.exists(filename) and os.path.getmtime(filename) > mtime:
+            return False
+    return True
+
+
+def is_extended_sample(cwd, DIA_filename):
+
+    # Samples an extend of the project reuses (see score_DIA_samples)
+    tsv_filename, dscore_filename = DIA_sample_results(DIA_filename)
+    return valid_checkpoint(cwd, dscore_filename) or \
+        is_scored_sample(cwd, DIA_filename, "SpecLib_cons_decoy.TraML")
+
+
+def score_DIA_samples(\
+    event, \
+    log_fh, \
+    progress, \
+    n_steps, \
+    cwd, \
+    DIA_filenames, \
+    fixed_swaths_filename, \
+    threads, \
+    irt_assay_library_traml, \
+    workers=1, \
+    reuse_samples=False):
+
+    # Runs OpenSwathWorkflow and pyprophet for each sample. Returns the
+    # samples that were scored successfully, None if cancelled.
 
     # REMOVE
     # for i, DIA_filename in enumerate(DIA_filenames):
     #     successfull_DIA_filenames.append(DIA_filename)
     #     progress.update_n_of_m(i+1, n_steps)
 
-    for i, DIA_filename in enumerate(DIA_filenames):
-       
-        OpenSwathWorkflow_cmd = [
+    # Several samples are extracted at once, each OpenSwathWorkflow getting
+    # its share of the thread budget. As soon as a sample's extraction has
+    # finished its -DIA.tsv is scored by pyprophet in a separate lane, so
+    # scoring overlaps the extraction of the remaining samples. A failed
+    # sample is logged and skipped.
+
+    steps = {"done": 0}
+    pyprophet_succeeded = {}
+
+    def openswath_inputs(DIA_filename):
+        return [DIA_filename, "SpecLib_cons_decoy.TraML", irt_assay_library_traml, fixed_swaths_filename]
+
+    # Samples are resumed from their checkpoints
+
+    new_DIA_filenames = []
+    extracted_DIA_filenames = []
+    for DIA_filename in DIA_filenames:
+        tsv_filename, dscore_filename = DIA_sample_results(DIA_filename)
+        if valid_checkpoint(cwd, dscore_filename, [tsv_filename]) and \
+            valid_checkpoint(cwd, tsv_filename, openswath_inputs(DIA_filename)):
+            logline(log_fh, "DIA sample " + DIA_filename + " has already been scored, reusing it.")
+            pyprophet_succeeded[DIA_filename] = True
+            steps["done"] += 2
+        elif reuse_samples and is_scored_sample(cwd, DIA_filename, "SpecLib_cons_decoy.TraML"):
+            logline(log_fh, "DIA sample " + DIA_filename + " has already been scored, reusing it.")
+            pyprophet_succeeded[DIA_filename] = True
+            steps["done"] += 2
+        elif valid_checkpoint(cwd, tsv_filename, openswath_inputs(DIA_filename)):
+            logline(log_fh, "DIA sample " + DIA_filename + " has already been extracted, scoring it.")
+            remove_checkpoint(cwd, dscore_filename)
+            extracted_DIA_filenames.append(DIA_filename)
+            steps["done"] += 1
+        else:
+            remove_checkpoint(cwd, tsv_filename)
+            remove_checkpoint(cwd, dscore_filename)
+            new_DIA_filenames.append(DIA_filename)
+    progress.update_n_of_m(steps["done"], n_steps)
+
+    if not new_DIA_filenames and not extracted_DIA_filenames:
+        return DIA_filenames
+
+    workers = max(1, min(int(workers), len(new_DIA_filenames) + len(extracted_DIA_filenames)))
+    slot_threads = [str(threads)]
+    if workers > 1:
+        slot_threads = [str(x) for x in split_threads(threads, workers)]
+
+    pool = ProcessPool(event, log_fh, workers, resources.memory_budget, executor=task_executor())
+    pool.add_lane("pyprophet", workers)
+
+    pyprophet_env = os.environ.copy()
+    # print(pyprophet_env)
+    if "PYTHONPATH" in pyprophet_env:
+        del pyprophet_env['PYTHONPATH']
+
+    def make_OpenSwathWorkflow_cmd(DIA_filename):
+        return lambda slot: [
             "OpenSwathWorkflow",
             "-in", DIA_filename,
             "-tr", "SpecLib_cons_decoy.TraML", 
             "-tr_irt", irt_assay_library_traml, 
-            "-out_tsv", os.path.basename(DIA_filename)+"-DIA.tsv", 
+            "-out_tsv", DIA_sample_results(DIA_filename)[0], 
             "-min_upper_edge_dist", "1",
             "-sort_swath_maps",
             "-swath_windows_file", fixed_swaths_filename,
             "-force",
-            "-threads", threads
+            "-threads", slot_threads[slot]
 
         ]
 
-        logline(log_fh, "Running pipeline command: "+" ".join(OpenSwathWorkflow_cmd))
-        OpenSwathWorkflow_proc = subprocess.Popen(OpenSwathWorkflow_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-        
-        while True:
-            try:
-                OpenSwathWorkflow_proc.wait(1)
-                break
-            except subprocess.TimeoutExpired:
-                if event and event.kill_flag:
-                    OpenSwathWorkflow_proc.kill()
-                    return
-
-        log_fh.flush()
-        if OpenSwathWorkflow_proc.returncode != 0:
-            #raise NonZeroReturnValueException(OpenSwathWorkflow_proc.returncode, 'OpenSwathWorkflow')
-            logline(log_fh, "DIA sample "+ DIA_filename +" failed. Skipping the sample.")
-            
-        else:
-            successfull_DIA_filenames.append(DIA_filename)
+    def produced(filename):
+        # Tools may exit with 0 without writing their output
+        filepath = os.path.join(cwd, filename)
+        return os.path.isfile(filepath) and is_complete_table(filepath)
+
+    def make_pyprophet_on_exit(DIA_filename):
+        def on_exit(returncode):
+            tsv_filename, dscore_filename = DIA_sample_results(DIA_filename)
+            if returncode != 0 or not produced(dscore_filename):
+                #raise NonZeroReturnValueException(returncode, 'pyprophet')
+                logline(log_fh, "DIA sample "+ DIA_filename +" failed. Skipping the sample.")
+                pyprophet_succeeded[DIA_filename] = False
+            else:
+                write_checkpoint(cwd, dscore_filename, [tsv_filename])
+                pyprophet_succeeded[DIA_filename] = True
+            steps["done"] += 1
+            progress.update_n_of_m(steps["done"], n_steps)
+        return on_exit
+
+    def make_OpenSwathWorkflow_on_exit(DIA_filename):
+        def on_exit(returncode):
+            steps["done"] += 1
+            if returncode != 0 or not produced(DIA_sample_results(DIA_filename)[0]):
+                #raise NonZeroReturnValueException(returncode, 'OpenSwathWorkflow')
+                logline(log_fh, "DIA sample "+ DIA_filename +" failed. Skipping the sample.")
+                pyprophet_succeeded[DIA_filename] = False
+                steps["done"] += 1
+            else:
+                write_checkpoint(cwd, DIA_sample_results(DIA_filename)[0], openswath_inputs(DIA_filename))
+                submit_pyprophet(DIA_filename)
+            progress.update_n_of_m(steps["done"], n_steps)
+        return on_exit
 
-        progress.update_n_of_m(i+1, n_steps)
+    def submit_pyprophet(DIA_filename):
+        tsv_filename = DIA_sample_results(DIA_filename)[0]
+        pyprophet_cmd = shlex.split("pyprophet --delim=tab --export.mayu " + tsv_filename + " --ignore.invalid_score_columns")
+        pyprophet_memory = resources.estimate_memory("pyprophet", [os.path.join(cwd, tsv_filename)])
+        pool.submit(pyprophet_cmd, make_pyprophet_on_exit(DIA_filename), lane="pyprophet", memory=pyprophet_memory, cwd=cwd, env=pyprophet_env)
 
-    successfull_DIA_filenames_after_pyprophet = []
+    for DIA_filename in extracted_DIA_filenames:
+        submit_pyprophet(DIA_filename)
 
-    j = i
-    n_steps = len(DIA_filenames) + len(successfull_DIA_filenames) +1
-    progress.update_n_of_m(j+1, n_steps)
+    for DIA_filename in new_DIA_filenames:
+        pool.submit(make_OpenSwathWorkflow_cmd(DIA_filename), make_OpenSwathWorkflow_on_exit(DIA_filename), \
+            memory=resources.estimate_memory("openswath", [DIA_filename]), cwd=cwd)
 
-    for i, DIA_filename in enumerate(successfull_DIA_filenames):
+    if not pool.run():
+        return None
 
-        pyprophet_cmd = shlex.split("pyprophet --delim=tab --export.mayu " + os.path.basename(DIA_filename)+"-DIA.tsv" + " --ignore.invalid_score_columns")
-        
-        logline(log_fh, "Running pipeline command: "+" ".join(pyprophet_cmd))
-        curr_env = os.environ.copy()
-        # print(curr_env)
-        if "PYTHONPATH" in curr_env:
-            del curr_env['PYTHONPATH']
-        pyprophet_proc = subprocess.Popen(pyprophet_cmd, cwd=cwd, env=curr_env, stdout=log_fh, stderr=log_fh)
-
-        while True:
-            try:
-                pyprophet_proc.wait(5)
-                break
-            except subprocess.TimeoutExpired:
-                if event and event.kill_flag:
-                    pyprophet_proc.kill()
-                    return
+    return [x for x in DIA_filenames if pyprophet_succeeded[x]]
 
 
-        log_fh.flush()
-        if pyprophet_proc.returncode != 0:
-            logline(log_fh, "DIA sample "+ DIA_filename +" failed. Skipping the sample.")              #raise NonZeroReturnValueException(pyprophet_proc.returncode, 'pyprophet')
-        else:
-            successfull_DIA_filenames_after_pyprophet.append(DIA_filename)
+def run_feature_alignment(event, log_fh, progress, cwd, DIA_filenames, target_FDR, max_FDR):
 
-        progress.update_n_of_m(i+j+1, n_steps)
+    # Aligns the scored samples into DIA-analysis-result.csv. Returns True
+    # when done, None if cancelled.
 
     feature_alignment_cmd = [
         "feature_alignment.py",
@@ -1348,62 +1633,97 @@ def buildDIAMatrix(\
         "--out", "DIA-analysis-result.csv", 
         "--in" 
     ]
-    feature_alignment_cmd.extend([ os.path.basename(x) + "-DIA_with_dscore.csv" for x in successfull_DIA_filenames_after_pyprophet])
+    feature_alignment_cmd.extend([DIA_sample_results(x)[1] for x in DIA_filenames])
 
-    logline(log_fh, "Running pipeline command: "+" ".join(feature_alignment_cmd))
-    feature_alignment_proc = subprocess.Popen(feature_alignment_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    
-    while True:
-        try:
-            feature_alignment_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                feature_alignment_proc.kill()
-                return
+    feature_alignment_returncode = run_command(event, log_fh, feature_alignment_cmd, cwd=cwd)
+    if feature_alignment_returncode is None:
+        return None
 
-    log_fh.flush()
-    if feature_alignment_proc.returncode != 0:
+    if feature_alignment_returncode != 0:
         progress.fail({
             "cmd": " ".join(feature_alignment_cmd),
-            "returncode": feature_alignment_proc.returncode, 
+            "returncode": feature_alignment_returncode, 
         })
-        raise NonZeroReturnValueException(feature_alignment_proc.returncode, 'feature_alignment')
+        raise NonZeroReturnValueException(feature_alignment_returncode, 'feature_alignment')
+
+    return True
+
+
+def run_swaths2stats(event, log_fh, progress, cwd, design_file):
+
+    # Builds the peptide and protein matrices from DIA-analysis-result.csv.
+    # Returns True when done, None if cancelled.
+    #
+    # The results are streamed into a copy with only the target rows and
+    # the columns swaths2stats uses, so that R does not load the whole file.
+    # Only this reduction is bounded by the chunk size: R still loads every
+    # target row of the copy (one per peptide and run) to build the
+    # matrices, and PECA needs all of them, so the peak memory of
+    # swaths2stats.R still grows with the number of runs times the number
+    # of peptides, only by a smaller factor (the decoy rows and the unused
+    # columns are left out).
 
+    reduced_filename = "DIA-analysis-result-reduced.tsv"
+
+    logline(log_fh, "Reducing DIA-analysis-result.csv for swaths2stats")
+    if not openswath.reduce_output(event, \
+            os.path.join(cwd, "DIA-analysis-result.csv"), \
+            os.path.join(cwd, reduced_filename)):
+        return None
 
     swaths2stats_cmd = [
         "/opt/gladiator/swaths2stats.R",
-        "--input", "DIA-analysis-result.csv"
+        "--input", reduced_filename
     ]
 
     if design_file:
         swaths2stats_cmd.extend(["--design-file", design_file])
 
-    logline(log_fh, "Running pipeline command: "+" ".join(swaths2stats_cmd))
-    swaths2stats_proc = subprocess.Popen(swaths2stats_cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    
-    while True:
-        try:
-            swaths2stats_proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                swaths2stats_proc.kill()
-                return
+    swaths2stats_returncode = run_command(event, log_fh, swaths2stats_cmd, cwd=cwd)
 
-    
-    log_fh.flush()
-    if swaths2stats_proc.returncode != 0:
+    if os.path.isfile(os.path.join(cwd, reduced_filename)):
+        os.remove(os.path.join(cwd, reduced_filename))
+
+    if swaths2stats_returncode is None:
+        return None
+
+    if swaths2stats_returncode != 0:
         progress.fail({
             "cmd": " ".join(swaths2stats_cmd),
-            "returncode": swaths2stats_proc.returncode, 
+            "returncode": swaths2stats_returncode, 
         })
-        raise NonZeroReturnValueException(swaths2stats_proc.returncode, 'swaths2stats')
+        raise NonZeroReturnValueException(swaths2stats_returncode, 'swaths2stats')
 
-    progress.update_n_of_m(n_steps, n_steps)
-    progress.ready()
+    return True
 
-    return
+
+def copy_result_tables(event, log_fh, cwd, DIA_filenames):
+
+    # Parquet copies (see tables.py) of the matrices, the aligned results
+    # and the per-sample results, written in parallel. Tables that already
+    # have an up to date copy are skipped.
+
+    if not tables.pyarrow:
+        return
+
+    filenames = ["DIA-peptide-matrix.tsv", "DIA-protein-matrix.tsv", "DIA-analysis-result.csv"]
+    for DIA_filename in DIA_filenames:
+        filenames.extend(DIA_sample_results(DIA_filename))
+    filepaths = [os.path.join(cwd, x) for x in filenames if os.path.isfile(os.path.join(cwd, x))]
+    if not filepaths:
+        return
+
+    logline(log_fh, "Writing Parquet copies of " + str(len(filepaths)) + " result tables")
+
+    workers = max(1, min(resources.io_workers(filepaths), resources.available_cpus(), len(filepaths)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(tables.convert, x): x for x in filepaths}
+        for future in concurrent.futures.as_completed(futures):
+            if not future.result():
+                logline(log_fh, "Could not write a Parquet copy of " + futures[future] + ", it is read as text.")
+            if event and event.kill_flag:
+                for x in futures:
+                    x.cancel()
 
 
 def read_swath_windows(dia_mzML):
@@ -1464,9 +1784,96 @@ def read_swath_windows(dia_mzML):
     return windows
 
 
-def create_swath_window_files(cwd, dia_mzML):
+SWATH_WINDOWS_CACHE = "swath-windows-cache.json"
+
+
+def read_all_swath_windows(event, cwd, dia_mzMLs, workers):
+
+    # Isolation windows of every DIA file, read in parallel processes (the
+    # parsing is CPU bound). The processes are spawned, not forked, as the
+    # caller has other threads running. The windows are remembered in the
+    # project by path, size and mtime so that reruns do not parse the files
+    # again. Returns None if cancelled, the event is checked after each
+    # file.
+
+    cache_filename = os.path.join(cwd, SWATH_WINDOWS_CACHE)
+    cached = {}
+    if os.path.isfile(cache_filename):
+        try:
+            with open(cache_filename, "r") as fh:
+                cached = json.load(fh)
+        except ValueError:
+            cached = {}
+
+    def file_key(filename):
+        st = os.stat(filename)
+        return [st.st_size, st.st_mtime_ns]
+
+    windows = {}
+    todo = []
+    for filename in dia_mzMLs:
+        path = os.path.abspath(filename)
+        if path in cached and cached[path]["key"] == file_key(path):
+            windows[filename] = cached[path]["windows"]
+        else:
+            todo.append(filename)
+
+    read = {}
+    workers = max(1, min(int(workers), len(todo)))
+    if workers == 1:
+        for filename in todo:
+            read[filename] = read_swath_windows(filename)
+            if event and event.kill_flag:
+                break
+    elif todo:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, \
+            mp_context=multiprocessing.get_context("spawn"))
+        futures = {executor.submit(read_swath_windows, x): x for x in todo}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                read[futures[future]] = future.result()
+                if event and event.kill_flag:
+                    break
+        finally:
+            # Files being read when cancelled finish in the background
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=not (event and event.kill_flag))
+
+    # Files read before a cancel are remembered too
+    for filename in todo:
+        if filename not in read:
+            continue
+        # As they are read back from the cache
+        file_windows = {x: list(read[filename][x]) for x in read[filename]}
+        windows[filename] = file_windows
+        cached[os.path.abspath(filename)] = {"key": file_key(filename), "windows": file_windows}
+
+    if read:
+        write_if_changed(cache_filename, json.dumps(cached, indent=1))
+
+    if event and event.kill_flag:
+        return None
+
+    return windows
 
-    windows = read_swath_windows(dia_mzML)
+
+def swath_window_scheme(windows):
+    return sorted((float(x), float(windows[x][0]), float(windows[x][1])) for x in windows)
+
+
+def mismatching_swath_windows(dia_mzMLs, windows):
+
+    # Files whose isolation window scheme differs from the first file's
+
+    scheme = swath_window_scheme(windows[dia_mzMLs[0]])
+    return [x for x in dia_mzMLs[1:] if swath_window_scheme(windows[x]) != scheme]
+
+
+def create_swath_window_files(cwd, dia_mzML, windows=None):
+
+    if windows is None:
+        windows = read_swath_windows(dia_mzML)
 
     swaths = []
     for x in windows:
@@ -1494,15 +1901,39 @@ def create_swath_window_files(cwd, dia_mzML):
 
     assert (len(swaths) == len(tswaths))
             
-    with open(os.path.join(cwd, "swath-windows.txt"), "w") as fh_swaths, open(os.path.join(cwd, "truncated-swath-windows.txt"), "w") as fh_tswaths:
-        fh_tswaths.write("LowerOffset\tHigherOffset\n")
+    # Rewritten only when they change, the files are inputs of the
+    # per-sample checkpoints
 
-        for i in range(len(swaths)):
-            fh_swaths.write(str(swaths[i][0]) + "\t" + str(swaths[i][1])  + "\n")
-            fh_tswaths.write(str(tswaths[i][0]) + "\t" + str(tswaths[i][1])  + "\n")
+    swaths_txt = ""
+    tswaths_txt = "LowerOffset\tHigherOffset\n"
+    for i in range(len(swaths)):
+        swaths_txt += str(swaths[i][0]) + "\t" + str(swaths[i][1])  + "\n"
+        tswaths_txt += str(tswaths[i][0]) + "\t" + str(tswaths[i][1])  + "\n"
+
+    write_if_changed(os.path.join(cwd, "swath-windows.txt"), swaths_txt)
+    write_if_changed(os.path.join(cwd, "truncated-swath-windows.txt"), tswaths_txt)
 
     return swaths, tswaths
             
+def choose_openswath_workers(threads, DIA_filenames):
+
+    # OpenSwathWorkflow scales sublinearly past roughly 8 threads and its
+    # loading and iRT calibration phases are mostly single-threaded, so
+    # large machines are better used by several concurrent samples. The
+    # memory budget admits the processes, this only avoids slots that
+    # could never be used.
+
+    if not threads:
+        threads = resources.available_cpus()
+
+    workers = max(1, int(threads) // OPENSWATH_THREADS_PER_WORKER)
+
+    per_worker = resources.estimate_memory("openswath", DIA_filenames)
+    workers = min(workers, max(1, resources.memory_budget.total // per_worker))
+
+    return max(1, min(workers, len(DIA_filenames)))
+
+
 def build_database(\
     event, \
     log_fh, \
@@ -1510,10 +1941,68 @@ def build_database(\
     cwd, \
     fasta_filenames, \
     database_filename, \
-    database_decoy_filename):
+    database_decoy_filename, \
+    db_cache=None):
 
     progress = Progress(progressData, "percentage-indicator")
 
+    if not db_cache:
+        return make_database(event, log_fh, progress, cwd, fasta_filenames, database_filename, database_decoy_filename)
+
+    # The same combination of FASTA files is shared by many projects, the
+    # databases are built once and linked from the cache. Analyses needing
+    # the same database wait for the one building it.
+
+    outputs = [database_filename, database_decoy_filename]
+    key = database_key(db_cache, fasta_filenames)
+
+    lock_fh = db_cache.lock_key(key, event)
+    if not lock_fh:
+        return
+
+    try:
+        if db_cache.restore(key, cwd, outputs):
+            logline(log_fh, "Sequence database restored from cache " + key)
+            progress.ready()
+            return
+
+        make_database(event, log_fh, progress, cwd, fasta_filenames, database_filename, database_decoy_filename)
+        if event and event.kill_flag:
+            return
+
+        try:
+            db_cache.store(key, cwd, outputs, "database " + " ".join(fasta_filenames))
+        except OSError as e:
+            logline(log_fh, "Adding sequence database to cache failed: " + str(e))
+
+    finally:
+        lock_fh.close()
+
+
+DECOY_DATABASE_OPTIONS = []
+
+
+def database_key(db_cache, fasta_filenames):
+
+    # The order of the files matters, the first of duplicate sequence IDs
+    # is kept
+
+    return db_cache.make_key(\
+        "database", \
+        {"decoy_options": DECOY_DATABASE_OPTIONS}, \
+        ["DecoyDatabase"], \
+        [("fasta", db_cache.content_hash(x)) for x in fasta_filenames])
+
+
+def make_database(\
+    event, \
+    log_fh, \
+    progress, \
+    cwd, \
+    fasta_filenames, \
+    database_filename, \
+    database_decoy_filename):
+
     # Combine sequence filenames
 
     IDs = set()
@@ -1542,27 +2031,18 @@ def build_database(\
             "DecoyDatabase",
             "-in", database_filename,
             "-out", database_decoy_filename,
-            ]
-    logline(log_fh, "Running pipeline command: "+" ".join(cmd))
-    proc = subprocess.Popen(cmd, cwd=cwd, stdout=log_fh, stderr=log_fh)
-    
-    while True:
-        try:
-            proc.wait(1)
-            break
-        except subprocess.TimeoutExpired:
-            if event and event.kill_flag:
-                proc.kill()
-                return
+            ] + DECOY_DATABASE_OPTIONS
+    returncode = run_command(event, log_fh, cmd, cwd=cwd)
+    if returncode is None:
+        return
 
-    log_fh.flush()
-    if proc.returncode != 0:
+    if returncode != 0:
         progress.fail({
                 "cmd": " ".join(cmd),
-                "returncode": proc.returncode, 
+                "returncode": returncode, 
             }
         )
-        raise NonZeroReturnValueException(proc.returncode, 'DecoyDatabase')
+        raise NonZeroReturnValueException(returncode, 'DecoyDatabase')
 
     progress.update_n_of_m(n_steps, n_steps)
     progress.ready()
@@ -1613,6 +2093,28 @@ def combine_DB(progressData, fasta_filenames, combined_fasta_filename):
     return
     
 
+def annotations_up_to_date(cwd, cfg):
+
+    # Whether matrix.tsv and annotations.tsv exist and were made after the
+    # table they annotate, which is rewritten when samples are added or
+    # the matrices are rerun
+
+    source = "DIA-peptide-matrix.tsv"
+    if cfg.get("annotation_from_openswath"):
+        source = "DIA-analysis-result.csv"
+
+    source_filepath = os.path.join(cwd, source)
+    if not os.path.isfile(source_filepath):
+        return False
+
+    for filename in ["matrix.tsv", "annotations.tsv"]:
+        filepath = os.path.join(cwd, filename)
+        if not os.path.isfile(filepath) or os.path.getmtime(filepath) < os.path.getmtime(source_filepath):
+            return False
+
+    return True
+
+
 def scan_project_phases(projectname, result_root):
     
     phases = {}
@@ -1788,8 +2290,7 @@ def scan_project_phases(projectname, result_root):
         if "annotation_filename" in cfg and cfg["annotation_filename"]:
             annotation_config_found = True
 
-        if annotation_config_found and os.path.isfile(os.path.join(dir, "matrix.tsv")) \
-            and os.path.isfile(os.path.join(dir, "annotations.tsv")):
+        if annotation_config_found and annotations_up_to_date(dir, cfg):
             phases["annotations"] = True
         else:
             phases["annotations"] = False
@@ -1800,6 +2301,13 @@ def scan_project_phases(projectname, result_root):
         else:
             phases["figures"] = False
 
+    # Samples with a valid checkpoint, e.g. after an interrupted
+    # buildDIAMatrix
+
+    suffix = "-DIA_with_dscore.csv"
+    phases["scored_samples"] = [x[:-len(".done")] for x in sorted(os.listdir(dir)) \
+        if x.endswith(suffix + ".done") and valid_checkpoint(dir, x[:-len(".done")])]
+
     return phases
 
 
@@ -0,0 +1,399 @@
+#! /usr/bin/env python3
+
+import sys
+import os
+import json
+import time
+import uuid
+import socket
+import signal
+import argparse
+import threading
+import subprocess
+
+
+# File system work queue for running per-file tasks (searches, DIA-Umpire,
+# OpenSwathWorkflow, pyprophet) on other nodes that mount the same
+# /run-files and /data storage.
+#
+# A task is a JSON file holding the command, its working directory and
+# environment. The coordinator writes it to pending/. A worker claims it by
+# renaming it to running/<id>@<worker>.json (only one rename can succeed),
+# runs it with its output going to logs/<id>.log and reports the exit code
+# by writing it into its claim file and renaming that to done/<id>.json.
+# The coordinator cancels a task by taking it back from pending/ or, once
+# claimed, by creating cancel/<id>.
+#
+# Workers touch workers/<worker> on every poll. A claimed task whose worker
+# has not done so for WORKER_TIMEOUT seconds (the worker died) is failed by
+# the coordinator, and so is a cancelled task that no worker has claimed
+# after CANCEL_GRACE seconds, so that waiting for a task never hangs on a
+# worker that is gone. The clocks of the machines may differ, so a worker
+# is judged by whether the mtime of its file changes, timed by the
+# coordinator's own clock. The coordinator fails a claimed task by removing
+# its claim file, which the worker then can not rename: only one of them
+# reports the task, and the worker kills it.
+#
+# Worker daemons are started with
+#
+#   workqueue.py --queue-dir /run-files/.queue --jobs 4
+
+POLL_INTERVAL = 0.5
+
+WORKER_TIMEOUT = 30
+CANCEL_GRACE = 5
+
+SUBDIRS = ["pending", "running", "done", "cancel", "logs", "workers"]
+
+
+def make_queue_dirs(queue_dir):
+    for subdir in SUBDIRS:
+        os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+
+
+def write_json(filename, data):
+    # Written under a temporary name so that readers never see partial files
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as fh:
+        json.dump(data, fh)
+    os.rename(tmp_filename, filename)
+
+
+def read_json(filename):
+    with open(filename, "r") as fh:
+        return json.load(fh)
+
+
+def claimed_filename(queue_dir, task_id, worker):
+    return os.path.join(queue_dir, "running", task_id + "@" + worker + ".json")
+
+
+def find_claim(queue_dir, task_id):
+
+    # (running file, worker) of a claimed task, None if it is not claimed
+
+    prefix = task_id + "@"
+    for filename in os.listdir(os.path.join(queue_dir, "running")):
+        if filename.startswith(prefix) and filename.endswith(".json"):
+            return os.path.join(queue_dir, "running", filename), filename[len(prefix):-len(".json")]
+    return None
+
+
+class QueueProcess:
+
+    # Coordinator side handle of a queued task, usable by
+    # supervisor.ProcessPool in place of a subprocess.Popen.
+
+    def __init__(self, queue_dir, task_id, log_fh):
+        self.queue_dir = queue_dir
+        self.task_id = task_id
+        self.log_fh = log_fh
+        self.returncode = None
+        self.finished = threading.Event()
+        self.cancelled = None
+        self.heartbeats = {}
+
+        self.exit_fd, self.exit_write_fd = os.pipe()
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def path(self, subdir, suffix=".json"):
+        return os.path.join(self.queue_dir, subdir, self.task_id + suffix)
+
+    def watch(self):
+
+        done_filename = self.path("done")
+        while not os.path.isfile(done_filename):
+            self.check_lost()
+            time.sleep(POLL_INTERVAL)
+
+        returncode = read_json(done_filename)["returncode"]
+
+        log_filename = self.path("logs", ".log")
+        if os.path.isfile(log_filename):
+            if self.log_fh:
+                with open(log_filename, "r", errors="replace") as fh:
+                    self.log_fh.write(fh.read())
+                self.log_fh.flush()
+            os.remove(log_filename)
+
+        os.remove(done_filename)
+
+        cancel_filename = self.path("cancel", "")
+        if os.path.exists(cancel_filename):
+            os.remove(cancel_filename)
+
+        self.returncode = returncode
+        self.finished.set()
+        os.close(self.exit_write_fd)
+
+    def fail(self, reason):
+        if self.log_fh:
+            self.log_fh.write("Queued task " + self.task_id + " " + reason + "\n")
+            self.log_fh.flush()
+        write_json(self.path("done"), {"returncode": -signal.SIGKILL})
+
+    def worker_alive(self, worker):
+
+        # Alive until the mtime of its file has not changed for
+        # WORKER_TIMEOUT seconds since this coordinator first saw it
+
+        try:
+            mtime = os.stat(os.path.join(self.queue_dir, "workers", worker)).st_mtime_ns
+        except OSError:
+            return False
+
+        now = time.monotonic()
+        if worker not in self.heartbeats or self.heartbeats[worker][0] != mtime:
+            self.heartbeats[worker] = (mtime, now)
+        return now - self.heartbeats[worker][1] < WORKER_TIMEOUT
+
+    def check_lost(self):
+
+        # Fails the task if its worker is gone, or if it was cancelled and
+        # is still not claimed by a worker after the grace period
+
+        claim = find_claim(self.queue_dir, self.task_id)
+        if os.path.isfile(self.path("done")):
+            return
+
+        if claim:
+            running_filename, worker = claim
+            if not self.worker_alive(worker):
+                try:
+                    os.remove(running_filename)
+                except FileNotFoundError:
+                    return
+                self.fail("lost its worker " + worker)
+            return
+
+        if self.cancelled is None or time.monotonic() - self.cancelled < CANCEL_GRACE:
+            return
+
+        try:
+            os.remove(self.path("pending"))
+        except FileNotFoundError:
+            # Claimed meanwhile, or done
+            if find_claim(self.queue_dir, self.task_id) or os.path.isfile(self.path("done")):
+                return
+        self.fail("was cancelled without a worker")
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.finished.wait()
+        return self.returncode
+
+    def kill(self):
+
+        if self.finished.is_set():
+            return
+
+        if self.cancelled is None:
+            self.cancelled = time.monotonic()
+
+        # Take the task back if no worker has claimed it yet
+
+        try:
+            os.remove(self.path("pending"))
+        except FileNotFoundError:
+            None
+        else:
+            write_json(self.path("done"), {"returncode": -signal.SIGKILL})
+            return
+
+        with open(self.path("cancel", ""), "w"):
+            None
+
+
+class QueueExecutor:
+
+    local = False
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        make_queue_dirs(queue_dir)
+
+    def start(self, log_fh, cmd, cwd=None, env=None, shell=False, **kwargs):
+
+        # The output of a task is collected by the worker and copied to
+        # log_fh once the task has finished, other redirections are not
+        # supported.
+
+        for key in ["stdout", "stderr"]:
+            if kwargs.get(key) not in [None, log_fh]:
+                raise ValueError("Queued tasks can not redirect " + key)
+
+        task_id = str(time.time_ns()) + "-" + uuid.uuid4().hex
+
+        task = {
+            "id": task_id,
+            "cmd": cmd,
+            "cwd": cwd or os.getcwd(),
+            "env": env,
+            "shell": shell,
+        }
+
+        if log_fh:
+            if shell:
+                cmd_str = cmd
+            else:
+                cmd_str = " ".join(cmd)
+            log_fh.write("Running pipeline command: " + cmd_str + " (queued as " + task_id + ")\n")
+            log_fh.flush()
+
+        write_json(os.path.join(self.queue_dir, "pending", task_id + ".json"), task)
+
+        return QueueProcess(self.queue_dir, task_id, log_fh)
+
+
+class Worker:
+
+    def __init__(self, queue_dir, jobs):
+        self.queue_dir = queue_dir
+        self.jobs = max(1, int(jobs))
+        self.name = socket.gethostname() + "-" + str(os.getpid())
+        self.running = {}
+        make_queue_dirs(queue_dir)
+        self.heartbeat()
+
+    def path(self, subdir, task_id, suffix=".json"):
+        return os.path.join(self.queue_dir, subdir, task_id + suffix)
+
+    def heartbeat(self):
+        filename = os.path.join(self.queue_dir, "workers", self.name)
+        try:
+            os.utime(filename, None)
+        except FileNotFoundError:
+            with open(filename, "w"):
+                None
+
+    def claim(self):
+
+        # Oldest task first, the ids start with the submission time
+
+        for filename in sorted(os.listdir(os.path.join(self.queue_dir, "pending"))):
+            if not filename.endswith(".json"):
+                continue
+            task_id = filename[:-len(".json")]
+            try:
+                os.rename(self.path("pending", task_id), claimed_filename(self.queue_dir, task_id, self.name))
+            except FileNotFoundError:
+                continue
+            return read_json(claimed_filename(self.queue_dir, task_id, self.name))
+
+        return None
+
+    def start(self, task):
+
+        task_id = task["id"]
+        log_fh = open(self.path("logs", task_id, ".log"), "w")
+        log_fh.write("Worker " + self.name + " running task " + task_id + "\n")
+        log_fh.flush()
+
+        try:
+            proc = subprocess.Popen(task["cmd"], cwd=task["cwd"], env=task["env"], shell=task["shell"], \
+                                    stdout=log_fh, stderr=subprocess.STDOUT)
+        except OSError as e:
+            log_fh.write(str(e) + "\n")
+            log_fh.close()
+            self.finish(task_id, 127)
+            return
+
+        self.running[task_id] = (proc, log_fh)
+
+    def finish(self, task_id, returncode):
+
+        # Not reported if the coordinator has failed the task meanwhile
+        # (removed the claim file)
+
+        filename = claimed_filename(self.queue_dir, task_id, self.name)
+        try:
+            with open(filename, "r+") as fh:
+                fh.truncate()
+                json.dump({"returncode": returncode, "worker": self.name}, fh)
+            os.rename(filename, self.path("done", task_id))
+        except FileNotFoundError:
+            print ("Task " + task_id + " was failed by the coordinator, not reporting it")
+
+        if os.path.exists(self.path("cancel", task_id, "")):
+            os.remove(self.path("cancel", task_id, ""))
+
+    def step(self):
+
+        self.heartbeat()
+
+        for task_id in list(self.running):
+            proc, log_fh = self.running[task_id]
+            cancelled = os.path.exists(self.path("cancel", task_id, "")) or \
+                not os.path.exists(claimed_filename(self.queue_dir, task_id, self.name))
+            if cancelled and proc.poll() is None:
+                proc.kill()
+            if proc.poll() is not None:
+                log_fh.close()
+                del self.running[task_id]
+                self.finish(task_id, proc.returncode)
+
+        while len(self.running) < self.jobs:
+            task = self.claim()
+            if not task:
+                break
+            self.start(task)
+
+    def stop(self):
+        for task_id in list(self.running):
+            proc, log_fh = self.running[task_id]
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            log_fh.close()
+            del self.running[task_id]
+            self.finish(task_id, proc.returncode)
+        heartbeat_filename = os.path.join(self.queue_dir, "workers", self.name)
+        if os.path.exists(heartbeat_filename):
+            os.remove(heartbeat_filename)
+
+    def run(self):
+        try:
+            while True:
+                self.step()
+                time.sleep(POLL_INTERVAL)
+        finally:
+            self.stop()
+
+
+def raise_exit(signum, frame):
+    sys.exit(1)
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description='glaDIAtor work queue worker')
+
+    parser.add_argument('--queue-dir',
+                        action='store',
+                        dest='queue_dir',
+                        required=False,
+                        default="/run-files/.queue",
+                        help='Work queue folder shared with the coordinator. [default: /run-files/.queue]')
+
+    parser.add_argument('--jobs',
+                        action='store',
+                        dest='jobs',
+                        type=int,
+                        required=False,
+                        default=1,
+                        help='Number of tasks run at the same time. [default: 1]')
+
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, raise_exit)
+
+    print ("Worker " + socket.gethostname() + "-" + str(os.getpid()) + " serving " + args.queue_dir)
+
+    try:
+        Worker(args.queue_dir, args.jobs).run()
+    except KeyboardInterrupt:
+        None
+
+    sys.exit(0)